@@ -2,23 +2,47 @@
 """ Send JSON-RPC requests.
 
 Usage:
-    json_rpc_client read_coils <starting-address> <quantity> [--slave-id=<nr> --socket=<path>]
-    json_rpc_client read_discrete_inputs <starting-address> <quantity> [--slave-id=<nr> --socket=<path>]
-    json_rpc_client read_holding_registers <starting-address> <quantity> [--slave-id=<nr> --socket=<path>]
-    json_rpc_client read_input_registers <starting-address> <quantity> [--slave-id=<nr> --socket=<path>]
-    json_rpc_client write_single_coil <address> <value> [--slave-id=<nr> --socket=<path>]
-    json_rpc_client write_single_register <address> <value> [--slave-id=<nr> --socket=<path>]
-    json_rpc_client write_multiple_coils <starting_address> <values> [--slave-id=<nr> --socket=<path>]
-    json_rpc_client write_multiple_registers <starting_address> <values> [--slave-id=<nr> --socket=<path>]
+    json_rpc_client read_coils <starting-address> <quantity> [--slave-id=<nr> --socket=<path> --tcp=<address>]
+    json_rpc_client read_discrete_inputs <starting-address> <quantity> [--slave-id=<nr> --socket=<path> --tcp=<address>]
+    json_rpc_client read_holding_registers <starting-address> <quantity> [--slave-id=<nr> --socket=<path> --tcp=<address>]
+    json_rpc_client read_input_registers <starting-address> <quantity> [--slave-id=<nr> --socket=<path> --tcp=<address>]
+    json_rpc_client write_single_coil <address> <value> [--slave-id=<nr> --socket=<path> --tcp=<address>]
+    json_rpc_client write_single_register <address> <value> [--slave-id=<nr> --socket=<path> --tcp=<address>]
+    json_rpc_client write_multiple_coils <starting_address> <values> [--slave-id=<nr> --socket=<path> --tcp=<address>]
+    json_rpc_client write_multiple_registers <starting_address> <values> [--slave-id=<nr> --socket=<path> --tcp=<address>]
+    json_rpc_client stream [<file>] [--window=<nr> --socket=<path> --tcp=<address> --stats]
 
 Options:
     -h --help                   Show this screen.
     -s --slave-id=<nr>          Id of slave [default: 1].
     --socket=</tmp/tolk.sock>   Location of Tolk's socket [default: /tmp/tolk.sock].
+    --tcp=<address>             Connect to host:port instead of socket.
+    --window=<nr>               Number of requests to keep in flight
+                                [default: 16].
+    --stats                     Print number of requests and their rate to
+                                stderr when done.
+
+Command `stream` reads newline delimited JSON-RPC requests from a file, or
+from stdin, sends them over a single connection and writes the responses to
+stdout as they arrive, one per line. Requests are pipelined: up to `--window`
+requests are in flight at a time. Notifications don't count, because they
+don't get a response. For example, to read 2 ranges of registers::
+
+    $ printf '%s\n' \
+        '{"jsonrpc": "2.0", "id": 1, "method": "read_holding_registers",
+          "params": {"starting_address": 100, "quantity": 2}}' \
+        '{"jsonrpc": "2.0", "id": 2, "method": "read_holding_registers",
+          "params": {"starting_address": 102, "quantity": 2}}' \
+        | json_rpc_client stream --window=2
+
+Requests must be on a single line.
 
 """
+import sys
 import json
+import time
 import socket
+import threading
 from uuid import uuid4
 from docopt import docopt
 from collections import namedtuple
@@ -33,8 +57,29 @@ Method = namedtuple('Method', ['name', 'type_'])
 def main():
     args = docopt(__doc__)
 
-    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-    s.connect(args['--socket'])
+    s = connect(args)
+
+    if args['stream']:
+        f = open(args['<file>']) if args['<file>'] else sys.stdin
+        try:
+            started = time.time()
+            sent, expected, received = stream(s, f, sys.stdout,
+                                              int(args['--window']))
+        finally:
+            s.close()
+            f.close()
+
+        if args['--stats']:
+            elapsed = time.time() - started
+            sys.stderr.write('Sent {0} requests and received {1} responses in '
+                             '{2:.3f} seconds, {3:.0f} requests per second.\n'
+                             .format(sent, received, elapsed,
+                                     sent / elapsed if elapsed else 0))
+
+        if received < expected:
+            sys.exit('Connection closed before all responses were received.')
+
+        return
 
     if args['read_coils']:
         method = Method(name='read_coils',  type_=READ)
@@ -75,14 +120,103 @@ def main():
     params['slave_id'] = int(args['--slave-id'])
 
     msg = get_json_rpc_message(method.name, params)
-    s.sendall(msg)
+    s.sendall(msg + '\n')
 
-    resp = json.loads(s.recv(1024))
+    # Responses are terminated by a newline and can be larger than a single
+    # read.
+    resp = json.loads(s.makefile('rb').readline())
     s.close()
 
     print(json.dumps(resp, sort_keys=True, indent=4, separators=(',', ': ')))
 
 
+def connect(args):
+    """ Return socket connected to address in --tcp or path in --socket. """
+    if args['--tcp']:
+        host, _, port = args['--tcp'].rpartition(':')
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        s.connect((host or 'localhost', int(port)))
+    else:
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.connect(args['--socket'])
+
+    return s
+
+
+def stream(s, requests, responses, window):
+    """ Send requests over socket and write responses as they arrive.
+
+    :param s: Connected socket.
+    :param requests: Iterable with lines which contain a JSON-RPC request.
+    :param responses: File to write responses to.
+    :param window: Maximum number of requests which await a response.
+    :returns: Tuple with number of requests sent, number of responses
+        expected and number of responses received.
+    """
+    in_flight = threading.Semaphore(window)
+    received = [0]
+    closed = threading.Event()
+
+    def receive():
+        try:
+            for line in iter(s.makefile('rb').readline, ''):
+                responses.write(line)
+                responses.flush()
+                received[0] += 1
+                in_flight.release()
+        finally:
+            closed.set()
+            # Unblock sender when connection closes.
+            for _ in range(window):
+                in_flight.release()
+
+    receiver = threading.Thread(target=receive)
+    receiver.daemon = True
+    receiver.start()
+
+    sent = expected = 0
+    for line in requests:
+        line = line.strip()
+        if not line:
+            continue
+
+        if expects_response(line):
+            in_flight.acquire()
+            expected += 1
+
+        if closed.is_set():
+            break
+
+        s.sendall(line + '\n')
+        sent += 1
+
+    while received[0] < expected and not closed.is_set():
+        closed.wait(0.1)
+
+    return sent, expected, received[0]
+
+
+def expects_response(line):
+    """ Return whether Tolk responds to request, or batch of requests, in
+    line. Like notifications, requests with an id of null or an empty string
+    don't get a response.
+    """
+    def has_id(request):
+        return isinstance(request, dict) and \
+            request.get('id') not in (None, '')
+
+    try:
+        request = json.loads(line)
+    except ValueError:
+        return True
+
+    if isinstance(request, list):
+        return any(has_id(r) for r in request)
+
+    return has_id(request)
+
+
 def get_json_rpc_message(method, params):
     """ Return a JSON-RPC formatted string.
 
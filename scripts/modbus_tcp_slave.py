@@ -1,56 +1,279 @@
 #!/usr/bin/env python
 """ Modbus slave listening at a port.
 
+By default the slave answers immediately and its values only change when
+they're written. To see how Tolk behaves against real devices, the slave can
+simulate many slave ids with large maps, the latency of a serial line and
+faults. Transactions are handled one at a time, like on a serial line.
+
+Every slave id has input registers and discrete inputs from address 0 and
+coils and holding registers from address `--offset`, all `--size` addresses
+long. Input registers and discrete inputs can change every
+`--change-interval` seconds, like measurements do.
+
 Usage:
-    modbus_tcp_slave.py [--host=<name> --port=<nr>]
+    modbus_tcp_slave.py [--host=<name> --port=<nr> --slaves=<ids> --size=<nr> --offset=<nr> --baudrate=<nr> --latency=<sec> --jitter=<sec> --exception-rate=<fraction> --exception-codes=<codes> --timeout-rate=<fraction> --drop-rate=<fraction> --change-interval=<sec> --seed=<nr>]
 
 Options:
     -h --help       Show this screen.
-    --host=<name>   Name of host [default: ""].
+    --host=<name>   Name of host [default: localhost].
     --port=<nr>     The port where slave is listening at [default: 502].
+    --slaves=<ids>  Slave ids, like '1,3' or '1-32' [default: 1].
+    --size=<nr>     Number of addresses of every table, at most 65536
+                    [default: 100].
+    --offset=<nr>   First address of coils and holding registers
+                    [default: 100].
+    --baudrate=<nr>  Add time to transmit request and response as RTU frames
+                    at this baudrate, 0 disables [default: 0].
+    --latency=<sec>  Number of seconds slave takes to answer [default: 0].
+    --jitter=<sec>  Maximum number of seconds added at random to latency
+                    [default: 0].
+    --exception-rate=<fraction>  Fraction of requests answered with an
+                    exception [default: 0].
+    --exception-codes=<codes>  Exception codes to pick from at random
+                    [default: 1,2,3,4,5,6,7,8,10,11].
+    --timeout-rate=<fraction>  Fraction of requests which aren't answered
+                    [default: 0].
+    --drop-rate=<fraction>  Fraction of requests after which the connection
+                    is closed without answer [default: 0].
+    --change-interval=<sec>  Number of seconds after which input registers
+                    and discrete inputs change, 0 disables [default: 0].
+    --seed=<nr>     Seed of random latency and faults [default: 0].
 
 """
 import sys
 import time
+import errno
+import random
+import socket
+import struct
+import threading
+from SocketServer import BaseRequestHandler, ThreadingTCPServer
 from docopt import docopt
 
 from logbook import Logger, StreamHandler
 from modbus_tk.utils import create_logger
 import modbus_tk.defines as cst
-from modbus_tk.modbus_tcp import TcpServer
+from modbus_tk.modbus import Databank
+from modbus_tk.modbus_tcp import TcpQuery
 
 StreamHandler(sys.stdout).push_application()
 log = Logger(__name__)
 
 logger = create_logger(name="console", record_format="%(message)s")
 
+#: Number of bits per character of an RTU frame: start bit, 8 data bits,
+#: parity or stop bit and stop bit.
+BITS_PER_CHAR = 11
+
+#: Size of the MBAP header of a Modbus TCP frame.
+MBAP_SIZE = 7
+
+#: Size of the address and CRC of a Modbus RTU frame.
+RTU_OVERHEAD = 3
+
+#: Maximum number of addresses in a table.
+MAX_ADDRESSES = 65536
+
 
 def main():
     args = docopt(__doc__)
-    server = TcpServer(port=int(args['--port']))
-    slave = server.add_slave(1)
-
-    slave.add_block(0, cst.ANALOG_INPUTS, 0, 100)
-    log.info('Add analog inputs data block from register 0 to 99 on slave 1')
-    slave.add_block(1, cst.DISCRETE_INPUTS, 0, 100)
-    log.info('Add discrete inputs data block from register 0 to 99 on slave 1')
-    slave.add_block(2, cst.COILS, 100, 100)
-    log.info('Add coils data block from register 100 to 199 on slave 1')
-    slave.add_block(3, cst.HOLDING_REGISTERS, 100, 100)
-    log.info('Add holding registers block from register 100 to 199 on slave 1')
-
-    server.start()
+
+    size = int(args['--size'])
+    offset = int(args['--offset'])
+    if not 0 < size <= MAX_ADDRESSES or \
+            offset + size > MAX_ADDRESSES:
+        sys.exit('Tables must lie within addresses 0 to 65535.')
+
+    simulator = Simulator(
+        baudrate=int(args['--baudrate']),
+        latency=float(args['--latency']),
+        jitter=float(args['--jitter']),
+        exception_rate=float(args['--exception-rate']),
+        exception_codes=[int(c) for c in args['--exception-codes'].split(',')],
+        timeout_rate=float(args['--timeout-rate']),
+        drop_rate=float(args['--drop-rate']),
+        seed=int(args['--seed']))
+
+    slave_ids = parse_ids(args['--slaves'])
+    for slave_id in slave_ids:
+        simulator.add_slave(slave_id, size, offset)
+
+    log.info('Add slaves {0} with input registers and discrete inputs from '
+             'address 0 to {1} and coils and holding registers from address '
+             '{2} to {3}.'.format(args['--slaves'], size - 1, offset,
+                                  offset + size - 1))
+
+    server = ThreadingTCPServer((args['--host'], int(args['--port'])),
+                               SimulatorHandler, bind_and_activate=False)
+    server.allow_reuse_address = True
+    server.daemon_threads = True
+    server.server_bind()
+    server.server_activate()
+    server.simulator = simulator
+
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
     log.info('TcpServer started listening at port {0}.'.format(args['--port']))
 
+    interval = float(args['--change-interval'])
+
     try:
+        tick = 0
         while True:
-            time.sleep(1)
+            if interval > 0:
+                time.sleep(interval)
+                tick += 1
+                simulator.change(tick)
+            else:
+                time.sleep(1)
     except KeyboardInterrupt:
         log.info('Received SIGINT. Exiting')
     finally:
-        server.stop()
+        server.shutdown()
+        server.server_close()
         log.info('TcpServer has stopped.')
 
 
+def parse_ids(spec):
+    """ Return list with slave ids of string like '1,3,5-8'. """
+    ids = []
+    for part in spec.split(','):
+        first, _, last = part.partition('-')
+        ids.extend(range(int(first), int(last or first) + 1))
+
+    return ids
+
+
+class Simulator(object):
+    """ Databank with slaves which answers requests with latency and faults.
+
+    :param baudrate: Baudrate of the emulated RTU line, 0 for none.
+    :param latency: Number of seconds to answer a request.
+    :param jitter: Maximum number of seconds added at random to latency.
+    :param exception_rate: Fraction of requests answered with an exception.
+    :param exception_codes: List with exception codes to pick from.
+    :param timeout_rate: Fraction of requests which aren't answered.
+    :param drop_rate: Fraction of requests after which connection is closed.
+    :param seed: Seed of random latency and faults.
+    """
+    def __init__(self, baudrate=0, latency=0, jitter=0, exception_rate=0,
+                 exception_codes=(), timeout_rate=0, drop_rate=0, seed=0):
+        self.baudrate = baudrate
+        self.latency = latency
+        self.jitter = jitter
+        self.exception_rate = exception_rate
+        self.exception_codes = exception_codes
+        self.timeout_rate = timeout_rate
+        self.drop_rate = drop_rate
+
+        self.databank = Databank()
+        self.slaves = []
+        self.random = random.Random(seed)
+
+        # Like a serial line, the simulator handles one transaction at a time.
+        self.lock = threading.Lock()
+
+    def add_slave(self, slave_id, size, offset):
+        """ Add slave with all 4 tables. """
+        slave = self.databank.add_slave(slave_id)
+
+        slave.add_block('input_registers', cst.ANALOG_INPUTS, 0, size)
+        slave.add_block('discrete_inputs', cst.DISCRETE_INPUTS, 0, size)
+        slave.add_block('coils', cst.COILS, offset, size)
+        slave.add_block('holding_registers', cst.HOLDING_REGISTERS, offset,
+                        size)
+
+        self.slaves.append((slave, size))
+
+    def change(self, tick):
+        """ Change values of input registers and discrete inputs. """
+        for slave, size in self.slaves:
+            slave.set_values('input_registers', 0,
+                             [(address + tick) & 0xFFFF
+                              for address in range(size)])
+            slave.set_values('discrete_inputs', 0,
+                             [(address + tick) % 2
+                              for address in range(size)])
+
+    def handle(self, request):
+        """ Return response to request, None when request isn't answered or
+        raise :class:`ConnectionDropped` when connection must be closed.
+        """
+        with self.lock:
+            fault = self.random.random()
+            delay = self.latency + self.random.random() * self.jitter
+
+            query = TcpQuery()
+            if fault < self.exception_rate:
+                _, pdu = query.parse_request(request)
+                function_code, = struct.unpack('>B', pdu[0])
+                response = query.build_response(struct.pack(
+                    '>BB', function_code | 0x80,
+                    self.random.choice(self.exception_codes)))
+            else:
+                response = self.databank.handle_request(query, request)
+
+            if self.baudrate:
+                chars = len(request) + len(response or '') + \
+                    2 * (RTU_OVERHEAD - MBAP_SIZE)
+                # Both frames are followed by a silence of 3.5 characters.
+                delay += (chars + 7) * BITS_PER_CHAR / float(self.baudrate)
+
+            time.sleep(delay)
+
+        fault -= self.exception_rate
+        if 0 <= fault < self.timeout_rate:
+            return None
+
+        fault -= self.timeout_rate
+        if 0 <= fault < self.drop_rate:
+            raise ConnectionDropped()
+
+        return response
+
+
+class ConnectionDropped(Exception):
+    pass
+
+
+class SimulatorHandler(BaseRequestHandler):
+    """ Handler which reads Modbus TCP requests and lets the simulator of the
+    server answer them.
+    """
+    def handle(self):
+        try:
+            while True:
+                mbap = self.recv(MBAP_SIZE)
+                if mbap is None:
+                    return
+
+                _, _, length = struct.unpack('>HHH', mbap[:6])
+                pdu = self.recv(length - 1)
+                if pdu is None:
+                    return
+
+                response = self.server.simulator.handle(mbap + pdu)
+                if response:
+                    self.request.sendall(response)
+        except ConnectionDropped:
+            log.info('Drop connection with {0}.'.format(self.client_address))
+        except socket.error as e:
+            if e.errno not in (errno.ECONNRESET, errno.EPIPE):
+                raise
+
+    def recv(self, size):
+        """ Return string of size bytes, or None when connection closes. """
+        data = ''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+
+        return data
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,531 @@
+#!/usr/bin/env python
+""" Benchmark Tolk end to end and per layer.
+
+The `load` benchmark starts a Tolk server, lets a number of clients send a
+mix of requests for a while and reports the throughput and the latency of
+the requests. By default the server proxies to `modbus_tcp_slave.py`, both
+in their own process. With `--backend=fake` the server runs in a child
+process with a fake Modbus master which answers immediately, or after
+`--latency` seconds, so only the cost of Tolk itself is measured.
+
+The `micro` benchmark measures the time of a single call of the
+:class:`tolk.Dispatcher`, with a fake master, and of encoding and decoding
+with every codec which is installed.
+
+Both write a JSON report to `--output`. Clients use a fixed seed, so runs
+with the same options send the same sequence of requests.
+
+Usage:
+    tolk_benchmark.py load [--backend=<name> --engine=<name> --workers=<nr> --transport=<name> --clients=<nr> --duration=<sec> --warmup=<sec> --mix=<spec> --quantity=<nr> --new-connections --latency=<sec> --seed=<nr> --slave-args=<args> --server-args=<args> --output=<path>]
+    tolk_benchmark.py micro [--iterations=<nr> --quantity=<nr> --output=<path>]
+
+Options:
+    -h --help           Show this screen.
+    --backend=<name>    Either 'slave', Tolk server and modbus_tcp_slave.py,
+                        or 'fake', Tolk server with a fake Modbus master
+                        [default: slave].
+    --engine=<name>     Engine of Tolk server, either 'threads' or 'reactor'
+                        [default: threads].
+    --workers=<nr>      Number of workers of Tolk server [default: 8].
+    --transport=<name>  Connect to Tolk over 'unix' or 'tcp' [default: unix].
+    --clients=<nr>      Number of concurrent clients [default: 4].
+    --duration=<sec>    Number of seconds to measure [default: 10].
+    --warmup=<sec>      Number of seconds to send requests before measuring
+                        [default: 1].
+    --mix=<spec>        Comma separated methods with their relative weight
+                        [default: read_holding_registers:9,write_multiple_registers:1].
+    --quantity=<nr>     Number of registers or coils per request, at most
+                        100 [default: 10].
+    --new-connections   Open a connection for every request, rather than a
+                        connection per client.
+    --latency=<sec>     Number of seconds a transaction of the fake Modbus
+                        master takes [default: 0].
+    --seed=<nr>         Seed of the random sequence of requests [default: 0].
+    --slave-args=<args>  Extra options of modbus_tcp_slave.py, like
+                        '--baudrate=19200 --drop-rate=0.01'.
+    --server-args=<args>  Extra options of tolk_server.py, like
+                        '--cache-ttl=1'.
+    --iterations=<nr>   Number of iterations of micro benchmarks
+                        [default: 10000].
+    --output=<path>     JSON file to write report to [default: benchmark.json].
+
+"""
+import sys
+import os
+import json
+import math
+import time
+import random
+import shlex
+import shutil
+import signal
+import socket
+import timeit
+import platform
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '../'))
+
+from docopt import docopt
+from modbus_tk.defines import (READ_COILS, READ_DISCRETE_INPUTS,
+                               READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS,
+                               WRITE_MULTIPLE_COILS, WRITE_MULTIPLE_REGISTERS)
+
+from tolk import Dispatcher, Handler
+from tolk.codec import BINARY_CODECS, get_binary_codec, get_codec
+from tolk.reactor import ReactorServer
+from tolk.server import ThreadPoolTCPServer, ThreadPoolUnixStreamServer
+
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+
+#: First address of every method, matching the blocks of modbus_tcp_slave.py.
+ADDRESSES = {
+    'read_coils': 100,
+    'read_discrete_inputs': 0,
+    'read_holding_registers': 100,
+    'read_input_registers': 0,
+    'write_single_coil': 100,
+    'write_single_register': 100,
+    'write_multiple_coils': 100,
+    'write_multiple_registers': 100,
+}
+
+#: Names of JSON codecs measured by the micro benchmark.
+JSON_CODECS = ('json', 'simplejson', 'ujson')
+
+
+def main():
+    args = docopt(__doc__)
+
+    if args['load']:
+        report = load(args)
+    else:
+        report = micro(int(args['--iterations']), int(args['--quantity']))
+
+    report['environment'] = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': multiprocessing.cpu_count(),
+    }
+
+    with open(args['--output'], 'w') as f:
+        json.dump(report, f, indent=4, sort_keys=True)
+
+    print(json.dumps(report, indent=4, sort_keys=True))
+
+
+class FakeMaster(object):
+    """ Modbus master which answers every request without a slave. Reads
+    return the lower 16 bits of the addresses, or alternating bits.
+
+    :param latency: Number of seconds a transaction takes, default 0.
+    """
+    def __init__(self, latency=0):
+        self.latency = latency
+
+    def execute(self, slave, function_code, starting_address, quantity_of_x=0,
+                output_value=0, data_format='', expected_length=-1):
+        if self.latency:
+            time.sleep(self.latency)
+
+        if function_code in (READ_COILS, READ_DISCRETE_INPUTS):
+            return tuple(address % 2 for address in
+                         range(starting_address,
+                               starting_address + quantity_of_x))
+
+        if function_code in (READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS):
+            return tuple(address & 0xFFFF for address in
+                         range(starting_address,
+                               starting_address + quantity_of_x))
+
+        if function_code in (WRITE_MULTIPLE_COILS, WRITE_MULTIPLE_REGISTERS):
+            return starting_address, len(output_value)
+
+        return starting_address, output_value
+
+
+def get_request(method, quantity, id):
+    """ Return string with JSON-RPC request of method on `quantity` values.
+    """
+    address = ADDRESSES[method]
+
+    if method.startswith('read_'):
+        params = {'starting_address': address, 'quantity': quantity}
+    elif method.startswith('write_single_'):
+        params = {'address': address, 'value': 1}
+    elif method == 'write_multiple_coils':
+        params = {'starting_address': address, 'values': [1] * quantity}
+    else:
+        params = {'starting_address': address,
+                  'values': range(quantity)}
+
+    return json.dumps({'jsonrpc': '2.0', 'method': method, 'params': params,
+                       'id': id})
+
+
+def parse_mix(spec):
+    """ Return list with (method, weight) tuples of string like
+    'read_coils:3,write_single_coil:1'.
+    """
+    mix = []
+    for item in spec.split(','):
+        method, _, weight = item.partition(':')
+        if method not in ADDRESSES:
+            sys.exit('Unknown method {0!r} in --mix.'.format(method))
+
+        mix.append((method, float(weight or 1)))
+
+    return mix
+
+
+def choose(rng, mix):
+    """ Return method picked from mix according to its weight. """
+    point = rng.random() * sum(weight for _, weight in mix)
+    for method, weight in mix:
+        point -= weight
+        if point < 0:
+            return method
+
+    return mix[-1][0]
+
+
+def free_port():
+    """ Return number of a TCP port which is free on localhost. """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    return port
+
+
+def wait_until_listening(address, family, timeout=10):
+    """ Block until a connection can be made with address. """
+    deadline = time.time() + timeout
+    while True:
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.connect(address)
+            return
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+        finally:
+            sock.close()
+
+
+def serve_fake(address, family, engine, workers, latency):
+    """ Serve Tolk with a :class:`FakeMaster` until process is terminated.
+    """
+    dispatcher = Dispatcher(FakeMaster(latency))
+
+    if engine == 'reactor':
+        server = ReactorServer(address, dispatcher, workers=workers,
+                               family=family)
+    elif family == socket.AF_UNIX:
+        server = ThreadPoolUnixStreamServer(address, Handler)
+    else:
+        server = ThreadPoolTCPServer(address, Handler)
+
+    server.dispatcher = dispatcher
+    server.workers = workers
+    server.serve_forever()
+
+
+def start_servers(args, tmpdir):
+    """ Start Tolk, and the Modbus slave it proxies to, and return tuple with
+    address and family to connect to and a function which stops them.
+    """
+    if args['--transport'] == 'tcp':
+        address, family = ('127.0.0.1', free_port()), socket.AF_INET
+    else:
+        address = os.path.join(tmpdir, 'tolk.sock')
+        family = socket.AF_UNIX
+
+    if args['--backend'] == 'fake':
+        process = multiprocessing.Process(
+            target=serve_fake,
+            args=(address, family, args['--engine'], int(args['--workers']),
+                  float(args['--latency'])))
+        process.daemon = True
+        process.start()
+
+        wait_until_listening(address, family)
+
+        def stop():
+            process.terminate()
+            process.join()
+
+        return address, family, stop
+
+    devnull = open(os.devnull, 'w')
+    modbus_port = free_port()
+
+    processes = [subprocess.Popen(
+        [sys.executable, os.path.join(SCRIPTS, 'modbus_tcp_slave.py'),
+         '--port={0}'.format(modbus_port)] +
+        shlex.split(args['--slave-args'] or ''),
+        stdout=devnull, stderr=devnull)]
+
+    def stop():
+        for process in processes:
+            process.send_signal(signal.SIGINT)
+        for process in processes:
+            process.wait()
+        devnull.close()
+
+    try:
+        wait_until_listening(('127.0.0.1', modbus_port), socket.AF_INET)
+
+        command = [sys.executable, os.path.join(SCRIPTS, 'tolk_server.py'),
+                   '--modbus-host=127.0.0.1',
+                   '--modbus-port={0}'.format(modbus_port),
+                   '--socket={0}'.format(os.path.join(tmpdir, 'tolk.sock')),
+                   '--engine={0}'.format(args['--engine']),
+                   '--workers={0}'.format(args['--workers'])]
+        if family == socket.AF_INET:
+            command.append('--tcp={0}:{1}'.format(*address))
+        command.extend(shlex.split(args['--server-args'] or ''))
+
+        processes.append(subprocess.Popen(command, stdout=devnull,
+                                          stderr=devnull))
+        wait_until_listening(address, family)
+    except:
+        stop()
+        raise
+
+    return address, family, stop
+
+
+class Client(threading.Thread):
+    """ Client which sends requests, one at a time, until deadline and
+    records the latency of every request sent after start of measurement.
+    """
+    def __init__(self, address, family, mix, quantity, reuse, seed,
+                 measure_from, deadline):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.address = address
+        self.family = family
+        self.mix = mix
+        self.quantity = quantity
+        self.reuse = reuse
+        self.rng = random.Random(seed)
+        self.measure_from = measure_from
+        self.deadline = deadline
+
+        #: List with (method, latency, failed) tuples.
+        self.samples = []
+
+    def connect(self):
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        sock.connect(self.address)
+        if self.family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        return sock, sock.makefile('rb')
+
+    def run(self):
+        connection = None
+        id = 0
+
+        while True:
+            method = self.choose()
+            id += 1
+            request = get_request(method, self.quantity, id) + '\n'
+
+            started = time.time()
+            if started >= self.deadline:
+                break
+
+            try:
+                if connection is None:
+                    connection = self.connect()
+
+                connection[0].sendall(request)
+                response = connection[1].readline()
+                failed = not response or 'error' in json.loads(response)
+            except (socket.error, ValueError):
+                failed = True
+                response = None
+
+            finished = time.time()
+
+            if connection is not None and (not self.reuse or not response):
+                self.close(connection)
+                connection = None
+
+            if started >= self.measure_from:
+                self.samples.append((method, finished - started, failed))
+
+        if connection is not None:
+            self.close(connection)
+
+    def choose(self):
+        return choose(self.rng, self.mix)
+
+    def close(self, connection):
+        connection[1].close()
+        connection[0].close()
+
+
+def load(args):
+    """ Run load benchmark and return report. """
+    clients = int(args['--clients'])
+    duration = float(args['--duration'])
+    quantity = int(args['--quantity'])
+    mix = parse_mix(args['--mix'])
+    seed = int(args['--seed'])
+
+    tmpdir = tempfile.mkdtemp(prefix='tolk-benchmark-')
+    try:
+        address, family, stop = start_servers(args, tmpdir)
+        try:
+            measure_from = time.time() + float(args['--warmup'])
+            deadline = measure_from + duration
+
+            threads = [Client(address, family, mix, quantity,
+                              not args['--new-connections'], seed + i,
+                              measure_from, deadline)
+                       for i in range(clients)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            stop()
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    samples = [sample for thread in threads for sample in thread.samples]
+
+    methods = {}
+    for method, _ in mix:
+        method_samples = [s for s in samples if s[0] == method]
+        methods[method] = summarize(method_samples, duration)
+
+    report = summarize(samples, duration)
+    report.update({
+        'benchmark': 'load',
+        'config': {
+            'backend': args['--backend'],
+            'engine': args['--engine'],
+            'workers': int(args['--workers']),
+            'transport': args['--transport'],
+            'clients': clients,
+            'duration': duration,
+            'warmup': float(args['--warmup']),
+            'mix': dict(mix),
+            'quantity': quantity,
+            'reuse_connections': not args['--new-connections'],
+            'latency': float(args['--latency']),
+            'seed': seed,
+            'slave_args': args['--slave-args'],
+            'server_args': args['--server-args'],
+        },
+        'methods': methods,
+    })
+
+    return report
+
+
+def summarize(samples, duration):
+    """ Return dictionary with number of requests and errors, throughput in
+    requests per second and latency in milliseconds of samples.
+    """
+    latencies = sorted(latency for _, latency, _ in samples)
+
+    return {
+        'requests': len(samples),
+        'errors': sum(1 for _, _, failed in samples if failed),
+        'throughput': len(samples) / duration,
+        'latency_ms': {
+            'mean': sum(latencies) / len(latencies) * 1000
+            if latencies else None,
+            'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99),
+            'p999': percentile(latencies, 0.999),
+            'max': latencies[-1] * 1000 if latencies else None,
+        },
+    }
+
+
+def percentile(latencies, q):
+    """ Return percentile q of sorted latencies in milliseconds, using the
+    nearest rank, or None when there are no latencies.
+    """
+    if not latencies:
+        return None
+
+    rank = max(int(math.ceil(q * len(latencies))), 1)
+    return latencies[rank - 1] * 1000
+
+
+def measure(func, iterations):
+    """ Return number of microseconds a call of func takes, the best of 3
+    runs.
+    """
+    return min(timeit.repeat(func, number=iterations, repeat=3)) \
+        / iterations * 1e6
+
+
+def micro(iterations, quantity):
+    """ Run micro benchmarks and return report. """
+    requests = {
+        'read_holding_registers': get_request('read_holding_registers',
+                                              quantity, 1),
+        'write_multiple_registers': get_request('write_multiple_registers',
+                                                quantity, 1),
+        'batch_of_10_reads': '[{0}]'.format(', '.join(
+            get_request('read_holding_registers', quantity, i)
+            for i in range(10))),
+    }
+
+    dispatcher = Dispatcher(FakeMaster())
+    dispatcher_usec = dict(
+        (name, measure(lambda: dispatcher.call(request), iterations))
+        for name, request in requests.items())
+
+    request = json.loads(requests['read_holding_registers'])
+    response = {'jsonrpc': '2.0', 'id': 1, 'result': range(quantity)}
+
+    codecs = {}
+    for name in JSON_CODECS:
+        try:
+            codecs[name] = get_codec(name)
+        except ImportError:
+            continue
+
+    for name in BINARY_CODECS:
+        try:
+            codecs[name] = get_binary_codec(name)
+        except ImportError:
+            continue
+
+    codec_usec = {}
+    for name, codec in codecs.items():
+        encoded = codec.dumps(request)
+        codec_usec[name] = {
+            'loads': measure(lambda: codec.loads(encoded), iterations),
+            'dumps': measure(lambda: codec.dumps(response), iterations),
+        }
+
+    return {
+        'benchmark': 'micro',
+        'config': {
+            'iterations': iterations,
+            'quantity': quantity,
+            'codec': dispatcher.codec.name,
+        },
+        'dispatcher_usec': dispatcher_usec,
+        'codec_usec': codec_usec,
+    }
+
+
+if __name__ == '__main__':
+    main()
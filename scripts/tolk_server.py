@@ -2,26 +2,79 @@
 """ Tolk
 
 Usage:
-    tolk [--socket=<path> --modbus-host=<host> --modbus-port=<nr>]
+    tolk [--socket=<path> --modbus-host=<host> --modbus-port=<nr> --modbus-window=<nr> --workers=<nr> --engine=<name> --cache-ttl=<sec> --scan=<path> --routes=<path> --points=<path> --tcp=<address> --http=<address> --slow-request=<sec> --trace-rate=<fraction> --timeout=<sec> --max-queue=<nr> --max-queue-wait=<sec> --rate-limit=<nr> --rate-burst=<nr>]
 
 Options:
     -h --help           Show this screen.
     --socket=<path>     Location of Tolk's socket [default: /tmp/tolk.sock].
     --modbus-host=<ip>  IP of Modbus slave [default: localhost].
     --modbus-port=<nr>  Port of Modbus slave [default: 502]
+    --modbus-window=<nr>  Number of requests to keep in flight on connection
+                        with Modbus slave, 1 is strict request/response
+                        [default: 1].
+    --workers=<nr>      Number of requests to dispatch concurrently [default: 8].
+    --engine=<name>     Either 'threads', a thread per connection, or
+                        'reactor', a single event loop for all connections
+                        which dispatches requests in --workers threads
+                        [default: threads].
+    --cache-ttl=<sec>   Number of seconds read values are cached, 0 disables
+                        cache [default: 0].
+    --scan=<path>       JSON file with groups of registers to scan in the
+                        background, see tolk.scanner.load_scan_groups().
+                        With --routes the default backend is scanned.
+    --routes=<path>     JSON file with Modbus masters to route requests to,
+                        see tolk.routing.load_router(). Replaces
+                        --modbus-host and --modbus-port.
+    --points=<path>     JSON file with named points, see
+                        tolk.points.load_points().
+    --tcp=<address>     Listen at host:port for clients which use the same
+                        framing as on --socket.
+    --http=<address>    Listen at host:port for JSON-RPC requests over HTTP.
+    --slow-request=<sec>  Log requests which take longer than this number of
+                        seconds with the time spent in every phase, 0
+                        disables tracing [default: 0].
+    --trace-rate=<fraction>  Fraction of requests to trace to find slow
+                        requests [default: 1].
+    --timeout=<sec>     Drop requests which haven't reached the bus after
+                        this number of seconds, unless they have their own
+                        timeout_ms, 0 disables [default: 0].
+    --max-queue=<nr>    Reject requests when this number of transactions is
+                        waiting for the bus of a backend, 0 disables. Backends
+                        of --routes can set their own max_queue
+                        [default: 0].
+    --max-queue-wait=<sec>  Reject requests which have waited this number of
+                        seconds for the bus, 0 disables [default: 0].
+    --rate-limit=<nr>   Number of requests per second a client may make over
+                        all its connections, HTTP included. Clients are
+                        identified by host, or by process for the Unix
+                        Domain Socket. 0 disables [default: 0].
+    --rate-burst=<nr>   Number of requests a client may make at once, 0
+                        means same as the rate limit [default: 0].
 
 """
 import sys
 import os
+import time
+import socket
+import threading
 sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
                                 '../'))
 
 from logbook import Logger, StreamHandler
-from modbus_tk.modbus_tcp import TcpMaster
-from SocketServer import UnixStreamServer
+from modbus_tk.defines import (READ_COILS, READ_DISCRETE_INPUTS,
+                               READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS)
 from docopt import docopt
 
 from tolk import Dispatcher, Handler
+from tolk.cache import RegisterCache
+from tolk.http_handler import HTTPHandler
+from tolk.points import load_points
+from tolk.ratelimit import RateLimiter
+from tolk.reactor import ReactorServer
+from tolk.routing import Backend, Router, create_master, load_router
+from tolk.scanner import RegisterImage, Scanner, load_scan_groups
+from tolk.server import ThreadPoolTCPServer, ThreadPoolUnixStreamServer
+from tolk.tracing import Tracer
 
 StreamHandler(sys.stdout).push_application()
 log = Logger(__name__)
@@ -30,23 +83,115 @@ log = Logger(__name__)
 def main():
     args = docopt(__doc__)
 
-    modbus_master = TcpMaster(args['--modbus-host'],
-                              int(args['--modbus-port']))
-    dispatcher = Dispatcher(modbus_master)
+    if args['--routes']:
+        router = load_router(args['--routes'])
+    else:
+        router = Router({'default': Backend(create_master({
+            'host': args['--modbus-host'],
+            'port': args['--modbus-port'],
+            'window': args['--modbus-window'],
+        }))})
 
-    server = UnixStreamServer(args['--socket'], Handler)
-    server.dispatcher = dispatcher
+    ttl = float(args['--cache-ttl'])
+    if ttl > 0:
+        for _, backend in router:
+            backend.cache = RegisterCache(dict.fromkeys(
+                [READ_COILS, READ_DISCRETE_INPUTS, READ_HOLDING_REGISTERS,
+                 READ_INPUT_REGISTERS], ttl))
+
+    scanner = None
+    if args['--scan']:
+        backend = router.backends.get(router.default)
+        if backend is None:
+            sys.exit('--scan requires a default backend.')
+
+        backend.image = RegisterImage()
+        scanner = Scanner(backend.bus, load_scan_groups(args['--scan']),
+                          backend.image)
+        scanner.start()
+
+    points = None
+    if args['--points']:
+        points = load_points(args['--points'])
+
+    tracer = None
+    slow_request = float(args['--slow-request'])
+    if slow_request > 0:
+        tracer = Tracer(float(args['--trace-rate']), slow_request)
+
+    timeout = float(args['--timeout']) or None
+
+    max_queue = int(args['--max-queue'])
+    max_queue_wait = float(args['--max-queue-wait'])
+    for _, backend in router:
+        scheduler = backend.bus.scheduler
+        if max_queue > 0 and scheduler.max_queue is None:
+            scheduler.max_queue = max_queue
+        if max_queue_wait > 0 and scheduler.max_queue_wait is None:
+            scheduler.max_queue_wait = max_queue_wait
+
+    rate_limiter = None
+    rate_limit = float(args['--rate-limit'])
+    if rate_limit > 0:
+        rate_limiter = RateLimiter(rate_limit,
+                                   float(args['--rate-burst']) or None)
+
+    dispatcher = Dispatcher(router=router, points=points, tracer=tracer,
+                            timeout=timeout, rate_limiter=rate_limiter)
+
+    workers = int(args['--workers'])
+    servers = []
+
+    if args['--engine'] == 'reactor':
+        servers.append(ReactorServer(args['--socket'], dispatcher,
+                                     workers=workers))
+        if args['--tcp']:
+            servers.append(ReactorServer(parse_address(args['--tcp']),
+                                         dispatcher, workers=workers,
+                                         family=socket.AF_INET))
+    else:
+        servers.append(ThreadPoolUnixStreamServer(args['--socket'], Handler))
+        if args['--tcp']:
+            servers.append(ThreadPoolTCPServer(parse_address(args['--tcp']),
+                                               Handler))
+
+    if args['--http']:
+        servers.append(ThreadPoolTCPServer(parse_address(args['--http']),
+                                           HTTPHandler))
+
+    for server in servers:
+        server.dispatcher = dispatcher
+        server.workers = workers
+
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+
+        log.info('Start Tolk listening at {0}.'.format(server.server_address))
 
     try:
-        log.info('Start Tolk listening at {0}.'.format(args['--socket']))
-        server.serve_forever()
+        while True:
+            time.sleep(1)
     except KeyboardInterrupt:
         log.info('Received SIGINT. Exiting')
         pass
     finally:
+        if scanner is not None:
+            scanner.stop()
+
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
         os.unlink(args['--socket'])
         log.info('Tolk has stopped')
 
 
+def parse_address(address):
+    """ Return (host, port) tuple of string like 'localhost:8502'. """
+    host, _, port = address.rpartition(':')
+    return host or '0.0.0.0', int(port)
+
+
 if __name__ == '__main__':
     main()
@@ -37,5 +37,6 @@ setup(name='Tolk',
             'json_rpc_client = scripts.json_rpc_client:main',
             'modbus_tcp_slave = scripts.modbus_tcp_slave:main',
             'tolk_server = scripts.tolk_server:main',
+            'tolk_benchmark = scripts.tolk_benchmark:main',
         ]
       })
@@ -22,8 +22,8 @@ def modbus_server():
     slave.add_block(1, DISCRETE_INPUTS, 0, 100)
     slave.set_values(1, 0, [1, 0])
 
-    slave.add_block(2, COILS, 100, 100)
-    slave.add_block(3, HOLDING_REGISTERS, 100, 100)
+    slave.add_block(2, COILS, 100, 1000)
+    slave.add_block(3, HOLDING_REGISTERS, 100, 1000)
 
     modbus_server.start()
 
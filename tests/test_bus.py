@@ -0,0 +1,109 @@
+import time
+import threading
+
+import pytest
+from mock import Mock
+from modbus_tk.modbus import Master
+from modbus_tk.utils import threadsafe_function
+
+from tolk.bus import Bus, get_bus, unlocked_execute
+from tolk.exceptions import DeadlineExceeded
+from tolk.scheduler import HIGH
+
+
+class FakeMaster(Master):
+    """ Master which sleeps instead of doing a transaction. """
+    def __init__(self, delay=0):
+        Master.__init__(self, timeout_in_sec=1)
+        self.delay = delay
+
+    @threadsafe_function
+    def execute(self, slave, function_code, starting_address,
+                quantity_of_x=0, output_value=0):
+        time.sleep(self.delay)
+        return (slave, function_code, starting_address, quantity_of_x)
+
+    def close(self):
+        pass
+
+
+def get_global_lock():
+    """ Return lock created by :func:`threadsafe_function` for
+    :meth:`FakeMaster.execute`.
+    """
+    func = FakeMaster.execute.im_func
+    return func.func_closure[func.func_code.co_freevars.index('lock')] \
+        .cell_contents
+
+
+def test_unlocked_execute():
+    """ Test if unlocked execute doesn't wait for modbus_tk's global lock. """
+    master = FakeMaster()
+    lock = get_global_lock()
+
+    with lock:
+        assert unlocked_execute(master)(1, 3, 100, 2) == (1, 3, 100, 2)
+
+
+def test_unlocked_execute_without_closure():
+    master = Mock()
+    assert unlocked_execute(master) is master.execute
+
+
+def test_get_bus():
+    master = FakeMaster()
+
+    assert get_bus(master) is get_bus(master)
+    assert get_bus(master) is not get_bus(FakeMaster())
+
+
+def run_concurrently(buses, n=2):
+    """ Execute n transactions on every bus concurrently and return
+    duration. """
+    threads = [threading.Thread(target=bus.execute, args=(1, 3, 0, 1))
+               for bus in buses for _ in range(n)]
+
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return time.time() - start
+
+
+def test_bus_serializes_transactions():
+    assert run_concurrently([Bus(FakeMaster(delay=0.05))]) >= 0.1
+
+
+def test_independent_buses_run_in_parallel():
+    buses = [Bus(FakeMaster(delay=0.05)) for _ in range(4)]
+    assert run_concurrently(buses, n=1) < 0.15
+
+
+def test_bus_runs_window_of_thread_safe_master():
+    master = FakeMaster(delay=0.05)
+    master.thread_safe = True
+    master.window = 2
+
+    assert run_concurrently([Bus(master)], n=2) < 0.1
+
+
+def test_bus_passes_priority_to_scheduler():
+    bus = Bus(FakeMaster())
+    bus.scheduler = Mock(wraps=bus.scheduler)
+
+    assert bus.execute(1, 3, 0, 1, priority=HIGH, client=7) == (1, 3, 0, 1)
+    bus.scheduler.acquire.assert_called_once_with(HIGH, 7, None, None)
+    assert bus.stats()['served']['high'] == 1
+
+
+def test_bus_drops_expired_request():
+    bus = Bus(FakeMaster())
+    bus._execute = Mock()
+
+    with pytest.raises(DeadlineExceeded):
+        bus.execute(1, 3, 0, 1, deadline=time.time() - 1)
+
+    assert not bus._execute.called
+    assert bus.stats()['dropped']['normal'] == 1
@@ -0,0 +1,86 @@
+import time
+
+from tolk.cache import LRU, MISS, RegisterCache, missing_ranges
+
+
+def test_lru_evicts_least_recently_used_key():
+    lru = LRU(max_size=2)
+    lru.set('a', 1)
+    lru.set('b', 2)
+
+    # Mark 'a' as most recently used.
+    assert lru.get('a') == 1
+
+    lru.set('c', 3)
+
+    assert 'b' not in lru
+    assert lru.get('a') == 1
+    assert lru.get('c') == 3
+    assert len(lru) == 2
+
+
+def test_lru_pop_and_clear():
+    lru = LRU(max_size=2)
+    lru.set('a', 1)
+
+    assert lru.pop('a') == 1
+    assert lru.pop('a') is None
+
+    lru.set('b', 2)
+    lru.clear()
+    assert len(lru) == 0
+
+
+def test_register_cache_get_and_put():
+    cache = RegisterCache({3: 10})
+    cache.put(1, 3, 100, (1337, 2345))
+
+    assert cache.get(1, 3, 99, 4) == [MISS, 1337, 2345, MISS]
+    assert cache.get(2, 3, 100, 1) == [MISS]
+    assert cache.get(1, 4, 100, 1) == [MISS]
+
+
+def test_register_cache_only_caches_configured_tables():
+    cache = RegisterCache({3: 10})
+    cache.put(1, 4, 100, (1337,))
+
+    assert cache.get(1, 4, 100, 1) == [MISS]
+
+
+def test_register_cache_expires_values():
+    cache = RegisterCache({3: 0.01})
+    cache.put(1, 3, 100, (1337,))
+    time.sleep(0.02)
+
+    assert cache.get(1, 3, 100, 1) == [MISS]
+
+
+def test_register_cache_is_bounded():
+    cache = RegisterCache({3: 10}, max_size=3)
+    cache.put(1, 3, 100, range(5))
+
+    assert cache.get(1, 3, 100, 5) == [MISS, MISS, 2, 3, 4]
+
+
+def test_register_cache_ignores_reads_started_before_write():
+    cache = RegisterCache({3: 10})
+
+    generation = cache.generation
+    cache.update(1, 3, 100, [1])
+    cache.put(1, 3, 100, (0,), generation)
+
+    assert cache.get(1, 3, 100, 1) == [1]
+
+
+def test_register_cache_invalidate():
+    cache = RegisterCache({3: 10})
+    cache.put(1, 3, 100, (1, 2, 3))
+    cache.invalidate(1, 3, 101, 1)
+
+    assert cache.get(1, 3, 100, 3) == [1, MISS, 3]
+
+
+def test_missing_ranges():
+    assert missing_ranges([MISS, MISS, 1, 2, MISS]) == [(0, 2), (4, 1)]
+    assert missing_ranges([0, 1]) == []
+    assert missing_ranges([]) == []
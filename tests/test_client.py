@@ -0,0 +1,186 @@
+import time
+import socket
+from threading import Thread
+
+import pytest
+from pyjsonrpc import MethodNotFound
+
+from tolk import Handler
+from tolk.client import (AsyncClient, Client, ConnectionClosed, Future,
+                         get_error)
+from tolk.exceptions import (DeadlineExceeded, IllegalDataAddress,
+                             ServerBusy)
+from tolk.server import ThreadPoolUnixStreamServer
+
+
+@pytest.yield_fixture
+def socket_path(dispatcher, tmpdir):
+    """ Yield path of socket of a running Tolk server. """
+    path = tmpdir.join('test_tolk_socket').strpath
+
+    server = ThreadPoolUnixStreamServer(path, Handler)
+    server.dispatcher = dispatcher
+
+    t = Thread(target=server.serve_forever)
+    t.start()
+
+    yield path
+
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.yield_fixture
+def client(socket_path):
+    with Client(socket_path, timeout=5) as client:
+        yield client
+
+
+def test_client(client):
+    assert client.read_input_registers(0, 2) == [1337, 2890]
+    assert client.read_discrete_inputs(0, 2) == [1, 0]
+
+    assert client.write_multiple_registers(100, [1, 2]) == [100, 2]
+    assert client.read_holding_registers(100, 2) == [1, 2]
+
+    client.write_single_coil(100, 1)
+    assert client.read_coils(100, 1, slave_id=1) == [1]
+
+    assert client.write_multiple_registers_as(100, [1.5], 'float32') == \
+        [100, 2]
+    assert client.read_holding_registers_as(100, 1, 'float32') == [1.5]
+
+    with pytest.raises(IllegalDataAddress):
+        client.read_holding_registers(5000, 1)
+
+    with pytest.raises(MethodNotFound):
+        client.call('no_such_method')
+
+
+def test_client_request_past_deadline(socket_path, dispatcher):
+    """ Test if requests of a client which gives up are dropped by Tolk
+    before they reach the bus.
+    """
+    dispatcher.bus.scheduler.acquire()
+    try:
+        with Client(socket_path, timeout=0.1) as client:
+            with pytest.raises(DeadlineExceeded):
+                client.call('read_holding_registers', starting_address=100,
+                            quantity=1, timeout_ms=20)
+    finally:
+        dispatcher.bus.scheduler.release()
+
+    assert dispatcher.bus.stats()['dropped']['normal'] == 1
+
+
+def test_client_shares_connection_between_threads(socket_path):
+    """ Test if responses of concurrent requests over one connection are
+    matched to their request.
+    """
+    client = Client(socket_path, pool_size=1, timeout=5)
+    results = {}
+
+    def read(address):
+        results[address] = client.read_holding_registers(address, 1)
+
+    client.write_multiple_registers(100, range(10))
+
+    threads = [Thread(target=read, args=(100 + i,)) for i in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert results == dict((100 + i, [i]) for i in range(10))
+    assert len(client.pool.connections) == 1
+
+    client.close()
+
+
+def test_async_client_and_batch(socket_path):
+    with AsyncClient(socket_path) as client:
+        futures = [client.read_input_registers(0, 1),
+                   client.read_input_registers(1, 1)]
+
+        assert [f.result(timeout=5) for f in futures] == [[1337], [2890]]
+
+        with client.batch() as batch:
+            registers = batch.read_input_registers(0, 2)
+            error = batch.read_holding_registers(5000, 1)
+
+        assert registers.result(timeout=5) == [1337, 2890]
+        assert isinstance(error.exception(timeout=5), IllegalDataAddress)
+
+        # A batch of one gets a single response.
+        batch = client.batch()
+        batch.read_input_registers(0, 1)
+        future, = batch.send()
+        assert future.result(timeout=5) == [1337]
+
+
+def test_client_receives_notifications(socket_path):
+    notifications = []
+    client = Client(socket_path, timeout=5,
+                    on_notification=lambda m, p: notifications.append((m, p)))
+
+    subscription = client.subscribe('input_registers', 0, 2, 0.01)
+
+    for _ in range(100):
+        if notifications:
+            break
+        time.sleep(0.01)
+
+    client.unsubscribe(subscription)
+    client.close()
+
+    method, params = notifications[0]
+    assert method == 'notify'
+    assert params['values'] == [1337, 2890]
+
+
+def test_closed_connection_fails_pending_requests(tmpdir):
+    """ Test if requests in flight fail when server closes connection. """
+    path = tmpdir.join('socket').strpath
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+
+    client = AsyncClient(path)
+    future = client.read_coils(100, 1)
+
+    conn, _ = server.accept()
+    conn.close()
+    server.close()
+
+    with pytest.raises(ConnectionClosed):
+        future.result(timeout=5)
+
+    # Timeouts don't fail a future.
+    with pytest.raises(socket.timeout):
+        Future().result(timeout=0.01)
+
+
+def test_future_callbacks():
+    calls = []
+    future = Future()
+    future.add_done_callback(calls.append)
+    future.set_result(1)
+    future.set_result(2)
+    future.add_done_callback(calls.append)
+
+    assert calls == [future, future]
+    assert future.result() == 1
+    assert future.exception() is None
+
+
+def test_get_error():
+    error = get_error({'code': -32002, 'message': 'Illegal data address.'})
+    assert isinstance(error, IllegalDataAddress)
+
+    error = get_error({'code': -32021, 'message': 'Server is busy.',
+                       'data': {'retry_after_ms': 250}})
+    assert isinstance(error, ServerBusy)
+    assert error.retry_after_ms == 250
+
+    error = get_error({'code': -1, 'message': 'Unknown.', 'data': 'x'})
+    assert (error.code, error.message, error.data) == (-1, 'Unknown.', 'x')
@@ -0,0 +1,68 @@
+import pytest
+
+from tolk.coalesce import Read, plan, split, extract, covers, overlaps
+
+
+@pytest.mark.parametrize('reads, expected', [
+    # Adjacent and overlapping reads are merged.
+    ([Read(1, 3, 100, 2), Read(1, 3, 102, 2), Read(1, 3, 103, 2)],
+     [Read(1, 3, 100, 5)]),
+    # Reads are merged regardless of their order.
+    ([Read(1, 3, 110, 1), Read(1, 3, 100, 2)], [Read(1, 3, 100, 11)]),
+    # Gaps larger than max_gap aren't filled.
+    ([Read(1, 3, 100, 2), Read(1, 3, 113, 1)],
+     [Read(1, 3, 100, 2), Read(1, 3, 113, 1)]),
+    # Reads with other slave or function code aren't merged.
+    ([Read(1, 3, 100, 2), Read(2, 3, 102, 2), Read(1, 4, 102, 2)],
+     [Read(1, 3, 100, 2), Read(1, 4, 102, 2), Read(2, 3, 102, 2)]),
+    # Frames don't exceed protocol limits.
+    ([Read(1, 3, 0, 100), Read(1, 3, 100, 50)],
+     [Read(1, 3, 0, 100), Read(1, 3, 100, 50)]),
+    ([Read(1, 1, 0, 1000), Read(1, 1, 1000, 1000), Read(1, 1, 2000, 1)],
+     [Read(1, 1, 0, 2000), Read(1, 1, 2000, 1)]),
+])
+def test_plan(reads, expected):
+    assert plan(reads) == expected
+
+
+def test_plan_with_max_gap():
+    reads = [Read(1, 3, 100, 2), Read(1, 3, 103, 1)]
+    assert plan(reads, max_gap=0) == reads
+    assert plan(reads, max_gap=1) == [Read(1, 3, 100, 4)]
+
+
+def test_split():
+    assert split(Read(1, 3, 100, 125)) == [Read(1, 3, 100, 125)]
+    assert split(Read(1, 3, 0, 300)) == [Read(1, 3, 0, 125),
+                                         Read(1, 3, 125, 125),
+                                         Read(1, 3, 250, 50)]
+    assert split(Read(1, 1, 0, 2001)) == [Read(1, 1, 0, 2000),
+                                          Read(1, 1, 2000, 1)]
+
+
+def test_extract():
+    frame = Read(1, 3, 100, 5)
+    assert extract(frame, (0, 1, 2, 3, 4), Read(1, 3, 102, 2)) == (2, 3)
+
+
+@pytest.mark.parametrize('read, expected', [
+    (Read(1, 3, 100, 5), True),
+    (Read(1, 3, 102, 3), True),
+    (Read(1, 3, 102, 4), False),
+    (Read(1, 3, 99, 1), False),
+    (Read(2, 3, 100, 1), False),
+    (Read(1, 4, 100, 1), False),
+])
+def test_covers(read, expected):
+    assert covers(Read(1, 3, 100, 5), read) == expected
+
+
+@pytest.mark.parametrize('read, expected', [
+    (Read(1, 3, 104, 10), True),
+    (Read(1, 3, 90, 11), True),
+    (Read(1, 3, 90, 10), False),
+    (Read(1, 3, 105, 1), False),
+    (Read(2, 3, 100, 1), False),
+])
+def test_overlaps(read, expected):
+    assert overlaps(Read(1, 3, 100, 5), read) == expected
@@ -0,0 +1,54 @@
+import json
+
+import pytest
+
+from tolk.codec import (REGISTERS, MsgpackCodec, get_codec, pack_bits,
+                        pack_registers, unpack_bits, unpack_registers)
+
+
+def test_get_codec():
+    codec = get_codec(['not_installed', 'json'])
+
+    assert codec.name == 'json'
+    assert codec.loads is json.loads
+    assert codec.dumps is json.dumps
+    assert get_codec().name in ('simplejson', 'json')
+
+
+def test_get_codec_without_modules():
+    with pytest.raises(ImportError):
+        get_codec('not_installed')
+
+
+def test_pack_registers():
+    assert pack_registers([1, 0xFFFF]) == '\x00\x01\xff\xff'
+    assert unpack_registers('\x00\x01\xff\xff') == [1, 0xFFFF]
+
+
+def test_pack_bits():
+    values = [1, 0, 1, 1, 0, 0, 0, 0, 1]
+
+    assert pack_bits(values) == '\x00\x09\x0d\x01'
+    assert unpack_bits('\x00\x09\x0d\x01') == values
+
+    with pytest.raises(ValueError):
+        pack_bits([0] * 0x10000)
+
+
+def test_msgpack_codec():
+    msgpack = pytest.importorskip('msgpack')
+    codec = MsgpackCodec()
+
+    request = codec.loads(msgpack.packb({
+        'method': 'write_multiple_registers',
+        'params': {'values': msgpack.ExtType(REGISTERS, '\x00\x01\x00\x02')},
+    }))
+    assert request['params']['values'] == [1, 2]
+
+    response = codec.loads(codec.dumps({
+        'result': codec.encode_result('read_coils', (1, 0, 1)),
+    }))
+    assert response['result'] == [1, 0, 1]
+
+    with pytest.raises(ValueError):
+        codec.loads('\xc1')
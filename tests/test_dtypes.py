@@ -0,0 +1,66 @@
+import pytest
+
+from tolk.dtypes import ORDERS, decode, encode, register_count
+
+
+@pytest.mark.parametrize('dtype, values', [
+    ('int16', [1, -2, 32767]),
+    ('uint16', [1, 65535]),
+    ('int32', [1, -2, 2 ** 31 - 1]),
+    ('uint32', [1, 2 ** 32 - 1]),
+    ('float32', [1.5, -2.25]),
+    ('int64', [1, -2 ** 63]),
+    ('uint64', [1, 2 ** 64 - 1]),
+    ('float64', [1.1, -2.2]),
+])
+def test_encode_and_decode(dtype, values):
+    for byte_order in ORDERS:
+        for word_order in ORDERS:
+            registers = encode(values, dtype, byte_order, word_order)
+            assert decode(registers, dtype, byte_order, word_order) == values
+
+
+@pytest.mark.parametrize('byte_order, word_order, registers', [
+    ('big', 'big', [0x0102, 0x0304]),
+    ('big', 'little', [0x0304, 0x0102]),
+    ('little', 'big', [0x0201, 0x0403]),
+    ('little', 'little', [0x0403, 0x0201]),
+])
+def test_orders(byte_order, word_order, registers):
+    assert encode([0x01020304], 'uint32', byte_order, word_order) == \
+        registers
+    assert decode(registers, 'uint32', byte_order, word_order) == \
+        [0x01020304]
+
+
+def test_string():
+    assert encode('Tolk!', 'string') == [0x546F, 0x6C6B, 0x2100]
+    assert decode([0x546F, 0x6C6B, 0x2100], 'string') == 'Tolk!'
+    assert decode([0x6F54], 'string', byte_order='little') == 'To'
+
+
+def test_register_count():
+    assert register_count('float64', 3) == 12
+    assert register_count('string', 5) == 3
+
+
+def test_invalid_arguments():
+    with pytest.raises(ValueError):
+        decode([1], 'float16')
+
+    with pytest.raises(ValueError):
+        decode([1], 'int32')
+
+    with pytest.raises(ValueError):
+        encode([1], 'int32', byte_order='middle')
+
+    with pytest.raises(ValueError):
+        encode([2 ** 16], 'uint16')
+
+
+def test_non_finite_floats_decoded_to_none():
+    registers = encode([float('nan'), float('inf'), -float('inf'), 1.5],
+                       'float64')
+
+    assert decode(registers, 'float64') == [None, None, None, 1.5]
+    assert decode([0x7F80, 0, 0x3FC0, 0], 'float32') == [None, 1.5]
@@ -0,0 +1,162 @@
+import json
+
+import pytest
+from mock import Mock
+
+from tolk.codec import BINARY_CODECS, Codec
+from tolk.framing import (MAX_PREAMBLE_SIZE, Framer, LengthPrefixFramer,
+                          Negotiator)
+
+
+@pytest.mark.parametrize('chunks, expected', [
+    (['{"id": 1}\n'], ['{"id": 1}']),
+    (['{"id": 1}\n{"id": 2}\n'], ['{"id": 1}', '{"id": 2}']),
+    (['{"id"', ': 1', '}\n'], ['{"id": 1}']),
+    (['\n\n{"id": 1}\n\n'], ['{"id": 1}']),
+    # Unterminated messages are returned once they're complete.
+    (['{"id": 1}'], ['{"id": 1}']),
+    (['{"params": {"a": 1}', '}'], ['{"params": {"a": 1}}']),
+    (['[{"id": 1}, {"id": 2}]'], ['[{"id": 1}, {"id": 2}]']),
+    # Braces and escaped quotes in strings don't end a message.
+    (['{"a": "}\\"', '}"}'], ['{"a": "}\\"}"}']),
+    (['{"a": "\\', '"}"}'], ['{"a": "\\"}"}']),
+])
+def test_feed(chunks, expected):
+    framer = Framer()
+
+    messages = []
+    for chunk in chunks:
+        messages.extend(framer.feed(chunk))
+
+    assert messages == expected
+    assert framer.buffer == ''
+
+
+def test_feed_keeps_incomplete_message():
+    framer = Framer()
+
+    assert framer.feed('{"id": 1}\n{"params": {"a": 1}') == ['{"id": 1}']
+    assert framer.buffer == '{"params": {"a": 1}'
+
+
+def test_feed_parses_large_message_once(monkeypatch):
+    """ Test if an unterminated message is parsed once, when it's complete,
+    and not after every chunk.
+    """
+    loads = Mock(side_effect=json.loads)
+    monkeypatch.setattr('tolk.framing.json.loads', loads)
+
+    framer = Framer()
+    chunks = ['{"params": ['] + ['{"a": 1}, '] * 1000 + ['{"a": 1}]}']
+
+    messages = []
+    for chunk in chunks:
+        messages.extend(framer.feed(chunk))
+
+    assert messages == [''.join(chunks)]
+    assert loads.call_count == 1
+
+
+def test_feed_collects_chunks(monkeypatch):
+    """ Test if chunks are joined once the message is complete, and if a
+    buffer which can't be a single document isn't parsed over and over.
+    """
+    loads = Mock(side_effect=json.loads)
+    monkeypatch.setattr('tolk.framing.json.loads', loads)
+
+    framer = Framer()
+    for chunk in ['{"a": '] + ['"xxxx'] * 100:
+        assert framer.feed(chunk) == []
+
+    assert len(framer._chunks) == 101
+    assert framer.feed('"}\n{"b": 1} x') == ['{"a": ' + '"xxxx' * 100 + '"}']
+
+    for chunk in [' ', '{}', ' ']:
+        assert framer.feed(chunk) == []
+    assert framer.feed('\n') == ['{"b": 1} x {} ']
+    assert loads.call_count == 0
+
+
+def test_feed_max_size():
+    framer = Framer(max_size=8)
+    assert framer.feed('{"a": 1}') == ['{"a": 1}']
+
+    with pytest.raises(ValueError):
+        framer.feed('{"a": 1, ')
+
+    with pytest.raises(ValueError):
+        Framer(max_size=8).feed('{"a": 10}\n')
+
+
+def test_encode():
+    assert Framer().encode('{"id": 1}') == '{"id": 1}\n'
+
+
+def test_length_prefix_framer():
+    framer = LengthPrefixFramer()
+
+    assert framer.feed('\x00\x00\x00\x02ab\x00\x00') == ['ab']
+    assert framer.feed('\x00\x01c\x00\x00\x00\x00') == ['c', '']
+    assert framer.buffer == ''
+    assert framer.encode('ab') == '\x00\x00\x00\x02ab'
+
+
+def test_length_prefix_framer_max_size():
+    framer = LengthPrefixFramer(max_size=4)
+
+    with pytest.raises(ValueError):
+        framer.feed('\x00\x00\x00\x05')
+
+
+class BinaryCodec(Codec):
+    """ JSON codec which pretends to be binary. """
+    json = False
+
+    def __init__(self):
+        Codec.__init__(self, json)
+
+
+@pytest.yield_fixture
+def binary_codec():
+    BINARY_CODECS['binary'] = BinaryCodec
+    yield
+    del BINARY_CODECS['binary']
+
+
+def test_negotiator_without_preamble():
+    negotiated = Mock()
+    framer = Negotiator(negotiated)
+
+    assert framer.feed('{"id": 1}\n{"id"') == ['{"id": 1}']
+    assert framer.feed(': 2}\n') == ['{"id": 2}']
+    assert framer.encode('{}') == '{}\n'
+    assert not negotiated.called
+
+
+def test_negotiator_with_preamble(binary_codec):
+    negotiated = Mock()
+    framer = Negotiator(negotiated)
+
+    assert framer.feed('\x00bin') == []
+    assert framer.feed('ary\n\x00\x00\x00\x02{}') == ['{}']
+
+    codec, preamble = negotiated.call_args[0]
+    assert codec.name == 'json'
+    assert preamble == '\x00binary\n'
+    assert framer.encode('{}') == '\x00\x00\x00\x02{}'
+
+
+def test_negotiator_with_unknown_codec():
+    negotiated = Mock()
+    framer = Negotiator(negotiated)
+
+    assert framer.feed('\x00cbor\n{"id": 1}\n') == ['{"id": 1}']
+    negotiated.assert_called_once_with(None, '\x00json\n')
+
+
+def test_negotiator_max_preamble_size():
+    framer = Negotiator(Mock())
+
+    assert framer.feed('\x00' + 'a' * (MAX_PREAMBLE_SIZE - 2)) == []
+    with pytest.raises(ValueError):
+        framer.feed('a')
@@ -0,0 +1,93 @@
+import json
+from httplib import HTTPConnection
+from threading import Thread
+
+import pytest
+
+from tolk.http_handler import HTTPHandler
+from tolk.server import ThreadPoolTCPServer
+
+
+@pytest.yield_fixture
+def http_server(dispatcher):
+    """ Yield running HTTP server. """
+    server = ThreadPoolTCPServer(('127.0.0.1', 0), HTTPHandler)
+    server.dispatcher = dispatcher
+
+    t = Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05})
+    t.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+def post(conn, body, headers=None):
+    conn.request('POST', '/', body, headers or {})
+    response = conn.getresponse()
+
+    return response.status, response.read()
+
+
+def test_keep_alive(http_server):
+    """ Test if many requests can be sent over one connection. """
+    conn = HTTPConnection(*http_server.server_address, timeout=1)
+
+    for i in range(1, 3):
+        status, body = post(conn, json.dumps({
+            'jsonrpc': '2.0', 'id': i, 'method': 'read_input_registers',
+            'params': {'starting_address': 0, 'quantity': 2}}))
+
+        assert status == 200
+        assert json.loads(body) == {'jsonrpc': '2.0', 'id': i,
+                                    'result': [1337, 2890]}
+
+    conn.close()
+
+
+def test_notification(http_server):
+    conn = HTTPConnection(*http_server.server_address, timeout=1)
+
+    assert post(conn, json.dumps({
+        'jsonrpc': '2.0', 'method': 'write_single_coil',
+        'params': {'address': 100, 'value': 1}})) == (204, '')
+
+    conn.close()
+
+
+def test_invalid_json(http_server):
+    conn = HTTPConnection(*http_server.server_address, timeout=1)
+
+    status, body = post(conn, '{"jsonrpc": ')
+
+    assert status == 200
+    assert json.loads(body)['error']['code'] == -32700
+
+    conn.close()
+
+
+def test_request_too_large(http_server, monkeypatch):
+    monkeypatch.setattr(HTTPHandler, 'max_body_size', 10)
+    conn = HTTPConnection(*http_server.server_address, timeout=1)
+
+    assert post(conn, '{"jsonrpc": "2.0"}')[0] == 413
+
+    conn.close()
+
+
+def test_metrics(http_server):
+    conn = HTTPConnection(*http_server.server_address, timeout=1)
+
+    conn.request('GET', '/metrics')
+    response = conn.getresponse()
+
+    assert response.status == 200
+    assert response.getheader('Content-Type') == 'text/plain; version=0.0.4'
+    assert 'tolk_bus_utilization_percent{backend="default"}' in \
+        response.read()
+
+    conn.request('GET', '/')
+    assert conn.getresponse().status == 404
+
+    conn.close()
@@ -1,7 +1,24 @@
 import json
+import time
 import socket
+import threading
 from uuid import uuid4
 
+import pytest
+from mock import Mock
+from modbus_tk.defines import READ_COILS, READ_HOLDING_REGISTERS
+from pyjsonrpc import JsonRpc, ParseError
+
+from tolk import Dispatcher
+from tolk.json_rpc import execute_all
+from tolk.cache import RegisterCache
+from tolk.codec import Codec, pack_bits
+from tolk.session import Session
+from tolk.points import Point, PointMap
+from tolk.ratelimit import RateLimiter
+from tolk.scanner import RegisterImage
+from tolk.scheduler import HIGH, NORMAL, LOW
+
 
 def get_json_rpc_message(method, params):
     """ Create JSON-RPC message from data en return it. """
@@ -109,6 +126,36 @@ def send_request(msg, sock):
     return msg, resp
 
 
+def test_persistent_connection(running_server):
+    """ Test if multiple newline-delimited requests can be send over a single
+    connection, including requests which don't fit in a single read.
+    """
+    sock = get_socket(running_server.server_address)
+    rfile = sock.makefile('r')
+
+    try:
+        values = [i % 2 for i in range(1000)]
+        msg = get_json_rpc_message('write_multiple_coils',
+                                   {'starting_address': 100, 'values': values})
+        assert len(msg) > 1024
+
+        sock.sendall(msg + '\n')
+        assert json.loads(rfile.readline()) == \
+            get_expected_response(msg, [100, 1000])
+
+        msgs = [get_json_rpc_message('read_coils',
+                                     {'starting_address': 100 + i,
+                                      'quantity': 2}) for i in range(3)]
+        sock.sendall(''.join([m + '\n' for m in msgs]))
+
+        for i, msg in enumerate(msgs):
+            assert json.loads(rfile.readline()) == \
+                get_expected_response(msg, values[i:i + 2])
+    finally:
+        rfile.close()
+        sock.close()
+
+
 def test_read_discrete_inputs(running_server):
     """ Test following Modbus methods:
     * methods read_discrete_inputs, function code 02.
@@ -194,3 +241,499 @@ def test_read_and_write_coils(running_server):
     sock = get_socket(running_server.server_address)
     msg, resp = read_coils(starting_address=100, quantity=2, sock=sock)
     assert json.loads(resp) == get_expected_response(msg, [0, 1])
+
+
+def test_batch_coalesces_reads(dispatcher):
+    """ Test if adjacent reads in a batch are executed as a single Modbus
+    request and every request gets its own response.
+    """
+    execute = dispatcher.bus._execute
+    dispatcher.bus._execute = Mock(side_effect=execute)
+
+    msgs = [
+        get_json_rpc_message('read_input_registers',
+                             {'starting_address': 0, 'quantity': 1}),
+        get_json_rpc_message('read_input_registers',
+                             {'starting_address': 1, 'quantity': 1}),
+        get_json_rpc_message('read_discrete_inputs', [0, 2]),
+    ]
+    batch = '[{0}]'.format(', '.join(msgs))
+
+    resp = json.loads(dispatcher.call(batch))
+
+    assert resp == [get_expected_response(msgs[0], [1337]),
+                    get_expected_response(msgs[1], [2890]),
+                    get_expected_response(msgs[2], [1, 0])]
+    assert dispatcher.bus._execute.call_count == 2
+
+
+def test_batch_reads_after_write_see_written_values(dispatcher):
+    """ Test if reads which follow a write in a batch aren't coalesced with
+    reads before the write.
+    """
+    msgs = [
+        get_json_rpc_message('read_holding_registers',
+                             {'starting_address': 100, 'quantity': 1}),
+        get_json_rpc_message('read_holding_registers',
+                             {'starting_address': 101, 'quantity': 1}),
+        get_json_rpc_message('write_single_register',
+                             {'address': 100, 'value': 5}),
+        get_json_rpc_message('read_holding_registers',
+                             {'starting_address': 100, 'quantity': 1}),
+    ]
+    batch = '[{0}]'.format(', '.join(msgs))
+
+    resp = json.loads(dispatcher.call(batch))
+
+    assert resp[0] == get_expected_response(msgs[0], [0])
+    assert resp[3] == get_expected_response(msgs[3], [5])
+
+
+def test_batch_with_failing_coalesced_read(dispatcher):
+    """ Test if reads are executed one by one when coalesced read fails. """
+    msgs = [
+        get_json_rpc_message('read_input_registers',
+                             {'starting_address': 98, 'quantity': 2}),
+        get_json_rpc_message('read_input_registers',
+                             {'starting_address': 101, 'quantity': 1}),
+    ]
+    batch = '[{0}]'.format(', '.join(msgs))
+
+    resp = json.loads(dispatcher.call(batch))
+
+    assert resp[0] == get_expected_response(msgs[0], [0, 0])
+    assert resp[1]['error']['code'] == -32002
+
+
+def test_reads_served_from_cache(modbus_master):
+    """ Test if only addresses missing from cache are read from bus and if
+    writes update the cache.
+    """
+    cache = RegisterCache({READ_COILS: 10, READ_HOLDING_REGISTERS: 10})
+    dispatcher = Dispatcher(modbus_master, cache=cache)
+
+    execute = dispatcher.bus._execute
+    dispatcher.bus._execute = Mock(side_effect=execute)
+
+    assert dispatcher.write_multiple_registers(100, [1, 2, 3]) == (100, 3)
+    assert dispatcher.read_holding_registers(100, 2) == (1, 2)
+    assert dispatcher.bus._execute.call_count == 1
+
+    # Only register 103 is missing.
+    assert dispatcher.read_holding_registers(101, 3) == (2, 3, 0)
+    assert dispatcher.bus._execute.call_args[0] == \
+        (1, READ_HOLDING_REGISTERS, 103, 1)
+
+    assert dispatcher.write_single_coil(100, 1) == (100, 0xFF00)
+    assert dispatcher.read_coils(100, 1) == (1,)
+    assert dispatcher.bus._execute.call_count == 3
+
+
+def test_reads_served_from_image(modbus_master):
+    """ Test if reads of scanned registers are served from register image. """
+    image = RegisterImage()
+    image.update(1, READ_HOLDING_REGISTERS, 100, (1337, 2345), time.time(),
+                 max_age=10)
+    dispatcher = Dispatcher(modbus_master, image=image)
+
+    assert dispatcher.read_holding_registers(100, 2) == (1337, 2345)
+    # Not scanned, so read from bus.
+    assert dispatcher.read_holding_registers(101, 2) == (0, 0)
+
+    msg = get_json_rpc_message('read_image',
+                               {'table': 'holding_registers',
+                                'starting_address': 100, 'quantity': 2})
+    resp = json.loads(dispatcher.call(msg))
+    assert resp['result']['values'] == [1337, 2345]
+    assert resp['result']['quality'] == 'good'
+
+    msg = get_json_rpc_message('read_image',
+                               {'table': 'unknown', 'starting_address': 100,
+                                'quantity': 2})
+    assert json.loads(dispatcher.call(msg))['error']['code'] == -32602
+
+
+def test_subscribe(running_server):
+    """ Test if changes of subscribed registers are pushed over connection.
+    """
+    sock = get_socket(running_server.server_address)
+    rfile = sock.makefile('r')
+
+    try:
+        msg = get_json_rpc_message('subscribe',
+                                   {'table': 'holding_registers',
+                                    'starting_address': 100, 'quantity': 2,
+                                    'interval': 0.05})
+        sock.sendall(msg + '\n')
+
+        resp = json.loads(rfile.readline())
+        subscription_id = resp['result']
+
+        notification = json.loads(rfile.readline())
+        assert notification['method'] == 'notify'
+        assert notification['params']['subscription'] == subscription_id
+        assert notification['params']['values'] == [0, 0]
+
+        msg = get_json_rpc_message('write_single_register',
+                                   {'address': 101, 'value': 1337})
+        sock.sendall(msg + '\n')
+
+        # Response of write and the notification may arrive in any order.
+        msgs = [json.loads(rfile.readline()) for _ in range(2)]
+        notification, = [m for m in msgs if m.get('method') == 'notify']
+        assert notification['params']['values'] == [0, 1337]
+
+        msg = get_json_rpc_message('unsubscribe',
+                                   {'subscription': subscription_id})
+        sock.sendall(msg + '\n')
+        assert json.loads(rfile.readline())['result'] is True
+    finally:
+        rfile.close()
+        sock.close()
+        running_server.dispatcher.subscriptions.stop()
+
+
+def test_subscribe_requires_session(dispatcher):
+    msg = get_json_rpc_message('subscribe',
+                               {'table': 'holding_registers',
+                                'starting_address': 100, 'quantity': 2,
+                                'interval': 1})
+
+    assert json.loads(dispatcher.call(msg))['error']['code'] == -32600
+
+
+def test_priority_of_requests(dispatcher):
+    """ Test if writes have a high priority by default and if priority can be
+    set per request.
+    """
+    execute = dispatcher.bus.execute
+    dispatcher.bus.execute = Mock(side_effect=execute)
+
+    dispatcher.write_single_register(100, 1)
+    dispatcher.read_holding_registers(100, 1)
+    dispatcher.read_holding_registers(100, 1, priority='low')
+
+    assert [c[1]['priority'] for c in dispatcher.bus.execute.call_args_list] \
+        == [HIGH, NORMAL, LOW]
+
+    msg = get_json_rpc_message('read_coils', {'starting_address': 100,
+                                              'quantity': 1,
+                                              'priority': 'urgent'})
+    assert json.loads(dispatcher.call(msg))['error']['code'] == -32602
+
+
+def test_requests_past_deadline_are_dropped(dispatcher):
+    """ Test if requests which haven't reached the bus before their deadline
+    are answered with an error instead of being executed.
+    """
+    dispatcher.bus.scheduler.acquire()
+    execute = dispatcher.bus._execute
+    dispatcher.bus._execute = Mock(side_effect=execute)
+
+    msg = get_json_rpc_message('read_holding_registers',
+                               {'starting_address': 100, 'quantity': 1,
+                                'timeout_ms': 50})
+    assert json.loads(dispatcher.call(msg))['error']['code'] == -32020
+
+    dispatcher.timeout = 0.05
+    msg = get_json_rpc_message('write_single_register',
+                               {'address': 100, 'value': 1})
+    assert json.loads(dispatcher.call(msg))['error']['code'] == -32020
+
+    dispatcher.bus.scheduler.release()
+    assert not dispatcher.bus._execute.called
+
+    msg = get_json_rpc_message('read_holding_registers',
+                               {'starting_address': 100, 'quantity': 1,
+                                'timeout_ms': 1000})
+    assert 'result' in json.loads(dispatcher.call(msg))
+
+    msg = get_json_rpc_message('read_holding_registers',
+                               {'starting_address': 100, 'quantity': 1,
+                                'timeout_ms': 'soon'})
+    assert json.loads(dispatcher.call(msg))['error']['code'] == -32602
+
+
+def test_requests_of_disconnected_client_are_dropped(dispatcher):
+    dispatcher.bus.scheduler.acquire()
+    threading.Timer(0.2, dispatcher.bus.scheduler.release).start()
+
+    session = Session(Mock(), connected=lambda: False)
+    msg = get_json_rpc_message('read_holding_registers',
+                               {'starting_address': 100, 'quantity': 1})
+
+    start = time.time()
+    assert json.loads(dispatcher.call(msg, session))['error']['code'] == \
+        -32020
+    assert time.time() - start < 0.2
+
+
+def test_rate_limit_per_session(dispatcher):
+    """ Test if requests over the rate limit of a session are rejected with
+    a hint when to retry, without reaching the bus.
+    """
+    dispatcher.rate_limiter = RateLimiter(rate=1, burst=2)
+    execute = dispatcher.bus._execute
+    dispatcher.bus._execute = Mock(side_effect=execute)
+
+    session = Session(Mock())
+    batch = json.dumps([json.loads(get_json_rpc_message(
+        'read_holding_registers', {'starting_address': 100 + i,
+                                   'quantity': 1})) for i in range(2)])
+
+    assert all('result' in r for r in json.loads(dispatcher.call(batch,
+                                                                 session)))
+    assert dispatcher.bus._execute.call_count == 1
+
+    for response in json.loads(dispatcher.call(batch, session)):
+        assert response['error']['code'] == -32021
+        assert 0 < response['error']['data']['retry_after_ms'] <= 2000
+
+    assert dispatcher.bus._execute.call_count == 1
+
+    # Other sessions and requests without a session aren't limited.
+    assert len(json.loads(dispatcher.call(batch, Session(Mock())))) == 2
+    assert 'result' in json.loads(dispatcher.call(batch))[0]
+
+
+def test_rate_limit_per_peer(dispatcher):
+    """ Test if sessions of the same peer share a rate limit, and if requests
+    without session are limited by their peer. """
+    dispatcher.rate_limiter = RateLimiter(rate=1, burst=1)
+    msg = get_json_rpc_message('read_holding_registers',
+                               {'starting_address': 100, 'quantity': 1})
+
+    assert 'result' in json.loads(dispatcher.call(
+        msg, Session(Mock(), peer='10.0.0.1')))
+    assert 'error' in json.loads(dispatcher.call(
+        msg, Session(Mock(), peer='10.0.0.1')))
+
+    assert 'result' in json.loads(dispatcher.call(msg, peer='10.0.0.2'))
+    assert 'error' in json.loads(dispatcher.call(msg, peer='10.0.0.2'))
+
+
+def test_rate_limit_counts_invalid_json(dispatcher):
+    """ Test if JSON which can't be parsed counts against the rate limit. """
+    dispatcher.rate_limiter = RateLimiter(rate=1, burst=1)
+
+    with pytest.raises(ParseError):
+        dispatcher.call('{"jsonrpc": ', peer='10.0.0.1')
+
+    response = json.loads(dispatcher.call('{"jsonrpc": ', peer='10.0.0.1'))
+    assert response['error']['code'] == -32021
+
+
+def test_full_queue_rejects_requests(dispatcher):
+    dispatcher.bus.scheduler.max_queue = 0
+    dispatcher.bus.scheduler.acquire()
+
+    msg = get_json_rpc_message('write_single_register',
+                               {'address': 100, 'value': 1})
+    try:
+        error = json.loads(dispatcher.call(msg))['error']
+    finally:
+        dispatcher.bus.scheduler.release()
+
+    assert error['code'] == -32021
+    assert error['data']['retry_after_ms'] > 0
+
+
+def test_oversized_requests_are_split(dispatcher):
+    """ Test if reads and writes which exceed the limits of the protocol are
+    split into multiple Modbus requests.
+    """
+    execute = dispatcher.bus._execute
+    dispatcher.bus._execute = Mock(side_effect=execute)
+
+    values = list(range(1000))
+    assert dispatcher.write_multiple_registers(100, values) == (100, 1000)
+    assert dispatcher.bus._execute.call_count == 9
+
+    assert dispatcher.read_holding_registers(100, 1000) == tuple(values)
+    assert dispatcher.bus._execute.call_count == 17
+
+
+def test_execute_all():
+    assert execute_all([lambda: 1, lambda: 2], concurrency=1) == [1, 2]
+
+    calls = [lambda i=i: time.sleep(0.05) or i for i in range(4)]
+    start = time.time()
+    assert execute_all(calls, concurrency=4) == [0, 1, 2, 3]
+    assert time.time() - start < 0.15
+
+    with pytest.raises(ZeroDivisionError):
+        execute_all([lambda: 1, lambda: 1 / 0], concurrency=2)
+
+
+def test_typed_reads_and_writes(dispatcher):
+    assert dispatcher.write_multiple_registers_as(
+        100, [21.5, -3.25], 'float32', word_order='little') == (100, 4)
+    assert dispatcher.read_holding_registers_as(
+        100, 2, 'float32', word_order='little') == [21.5, -3.25]
+    assert dispatcher.read_holding_registers_as(100, 4, 'int16') == \
+        [0, 16812, 0, -16304]
+
+    dispatcher.write_multiple_registers_as(110, 'Tolk!', 'string')
+    assert dispatcher.read_holding_registers_as(110, 5, 'string') == 'Tolk!'
+
+    # NaN isn't valid JSON.
+    dispatcher.write_multiple_registers_as(120, [float('nan')], 'float32')
+    msg = get_json_rpc_message('read_holding_registers_as',
+                               {'starting_address': 120, 'count': 1,
+                                'dtype': 'float32'})
+    assert json.loads(dispatcher.call(msg))['result'] == [None]
+
+    msg = get_json_rpc_message('read_holding_registers_as',
+                               {'starting_address': 100, 'count': 1,
+                                'dtype': 'float16'})
+    assert json.loads(dispatcher.call(msg))['error']['code'] == -32602
+
+
+def test_read_points(modbus_master):
+    dispatcher = Dispatcher(modbus_master, points=PointMap([
+        Point('temp', 'holding_registers', 100, dtype='float32'),
+        Point('speed', 'holding_registers', 104, scale=0.5),
+        Point('pump', 'coils', 100),
+    ]))
+    dispatcher.write_multiple_registers_as(100, [21.5], 'float32')
+    dispatcher.write_single_register(104, 145)
+    dispatcher.write_single_coil(100, 1)
+
+    dispatcher.bus.execute = Mock(wraps=dispatcher.bus.execute)
+
+    assert dispatcher.read_points(['temp', 'speed', 'pump']) == \
+        {'temp': 21.5, 'speed': 72.5, 'pump': 1}
+    assert dispatcher.bus.execute.call_count == 2
+
+    msg = get_json_rpc_message('read_points', {'names': ['unknown']})
+    assert json.loads(dispatcher.call(msg))['error']['code'] == -32602
+
+
+@pytest.mark.parametrize('msg', [
+    get_json_rpc_message('read_holding_registers',
+                         {'starting_address': 100, 'quantity': 2}),
+    get_json_rpc_message('read_holding_registers', [100, 2]),
+    get_json_rpc_message('write_single_coil', {'address': 100, 'value': 1}),
+    get_json_rpc_message('read_coils', {'starting_address': 100}),
+    get_json_rpc_message('read_coils', {'starting_address': 5000,
+                                        'quantity': 1}),
+    get_json_rpc_message('unknown_method', {}),
+    json.dumps({'jsonrpc': '2.0', 'method': 'read_coils',
+                'params': [100, 1]}),
+    json.dumps([json.loads(get_json_rpc_message(
+        'read_input_registers', {'starting_address': 0, 'quantity': 2}))]),
+    json.dumps([json.loads(get_json_rpc_message(
+        'read_input_registers', {'starting_address': 0, 'quantity': 2})),
+        {'jsonrpc': '2.0', 'id': 0, 'method': 'read_coils',
+         'params': {'starting_address': 100, 'quantity': 1}}]),
+    json.dumps([]),
+])
+def test_fast_path_responds_like_pyjsonrpc(dispatcher, msg):
+    """ Responses of fast path are the same as the ones of pyjsonrpc, except
+    for the tracebacks in the data of errors. """
+    def normalize(response):
+        if response is None:
+            return None
+
+        response = json.loads(response)
+        for r in response if isinstance(response, list) else [response]:
+            r.get('error', {}).pop('data', None)
+
+        return response
+
+    expected = normalize(JsonRpc.call(dispatcher, msg))
+    assert normalize(dispatcher.call(msg)) == expected
+
+
+def test_invalid_requests_in_batch_get_own_response(dispatcher):
+    """ Test if invalid requests in a batch get an error response while the
+    valid requests are dispatched as usual, rate limit included. """
+    dispatcher.rate_limiter = RateLimiter(rate=1, burst=3)
+    batch = json.dumps([
+        json.loads(get_json_rpc_message(
+            'read_holding_registers', {'starting_address': 100,
+                                       'quantity': 1, 'timeout_ms': 1000})),
+        json.loads(get_json_rpc_message('unknown_method', {})),
+        {'jsonrpc': '2.0', 'id': 2, 'method': 5},
+        'not a request',
+    ])
+
+    responses = json.loads(dispatcher.call(batch, peer='10.0.0.1'))
+    assert responses[0]['result'] == [0]
+    assert [r['error']['code'] for r in responses[1:]] == \
+        [-32601, -32600, -32600]
+    assert responses[3]['id'] is None
+
+    responses = json.loads(dispatcher.call(batch, peer='10.0.0.1'))
+    assert responses[0]['error']['code'] == -32021
+
+
+def test_invalid_json_raises_like_pyjsonrpc(dispatcher):
+    with pytest.raises(ParseError):
+        dispatcher.call('{"jsonrpc": ')
+
+
+class BinaryCodec(Codec):
+    """ JSON codec which pretends to be binary and tags results of reads. """
+    json = False
+
+    def __init__(self):
+        Codec.__init__(self, json)
+
+    def encode_result(self, method, result):
+        return {method: result}
+
+
+def test_call_with_codec_of_session(dispatcher):
+    session = Session(Mock())
+    session.codec = BinaryCodec()
+
+    response = json.loads(dispatcher.call(get_json_rpc_message(
+        'read_input_registers', {'starting_address': 0, 'quantity': 2}),
+        session))
+    assert response['result'] == {'read_input_registers': [1337, 2890]}
+
+    response = json.loads(dispatcher.call(
+        get_json_rpc_message('unknown', {}), session))
+    assert response['error']['code'] == -32601
+
+    response = json.loads(dispatcher.call('{"jsonrpc": ', session))
+    assert response['error']['code'] == -32700
+    assert response['id'] is None
+
+    response = json.loads(dispatcher.call('[]', session))
+    assert response['error']['code'] == -32600
+
+
+def test_result_which_cant_be_encoded(dispatcher):
+    """ Test if a result which the codec of session can't encode is answered
+    with an error instead of raising. """
+    session = Session(Mock())
+    session.codec = BinaryCodec()
+    session.codec.encode_result = lambda method, result: pack_bits(result)
+    dispatcher.method_table['read_coils'] = lambda **kwargs: [0] * 0x10000
+
+    response = json.loads(dispatcher.call(get_json_rpc_message(
+        'read_coils', {'starting_address': 0, 'quantity': 0x10000}), session))
+    assert response['error']['code'] == -32603
+    assert 'result' not in response
+
+
+def test_get_metrics(dispatcher):
+    dispatcher.call(get_json_rpc_message('read_coils', {
+        'starting_address': 100, 'quantity': 1}))
+    dispatcher.call(get_json_rpc_message('read_coils', {
+        'starting_address': 5000, 'quantity': 1}))
+
+    metrics = json.loads(dispatcher.call(
+        get_json_rpc_message('get_metrics', {})))['result']
+
+    assert metrics['methods']['read_coils']['requests'] == 2
+    assert metrics['methods']['read_coils']['errors'] == \
+        {'IllegalDataAddress': 1}
+    assert metrics['serialization']['count'] == 2
+
+    backend = metrics['backends']['default']
+    assert backend['slaves']['1']['transactions'] == 2
+    assert backend['slaves']['1']['errors'] == {'IllegalDataAddress': 1}
+    assert backend['queue']['running'] == 0
@@ -0,0 +1,92 @@
+from modbus_tk.modbus import ModbusError
+
+from tolk.exceptions import IllegalDataAddress
+from tolk.metrics import (BusMetrics, Histogram, Metrics, error_name,
+                          prometheus)
+
+
+def test_histogram():
+    histogram = Histogram(bounds=(1, 2, 4))
+
+    assert histogram.quantile(0.5) is None
+
+    for value in [0.5, 1, 1.5, 3, 10]:
+        histogram.observe(value)
+
+    assert histogram.counts == [2, 1, 1, 1]
+    assert histogram.quantile(0.5) == 2
+    assert histogram.quantile(0.99) == 4
+
+    snapshot = histogram.snapshot()
+    assert snapshot['count'] == 5
+    assert snapshot['sum'] == 16
+    assert snapshot['buckets'] == [[1, 2], [2, 3], [4, 4]]
+
+
+def test_error_name():
+    assert error_name(ModbusError(2)) == 'IllegalDataAddress'
+    assert error_name(IllegalDataAddress()) == 'IllegalDataAddress'
+    assert error_name(IOError()) == 'IOError'
+
+
+def test_metrics():
+    metrics = Metrics()
+    metrics.observe_request('read_coils', 0.01)
+    metrics.observe_request('read_coils', 0.02, IllegalDataAddress())
+    metrics.observe_serialization(0.0001)
+
+    snapshot = metrics.snapshot()
+
+    assert snapshot['methods']['read_coils']['requests'] == 2
+    assert snapshot['methods']['read_coils']['errors'] == \
+        {'IllegalDataAddress': 1}
+    assert snapshot['methods']['read_coils']['latency']['count'] == 2
+    assert snapshot['serialization']['count'] == 1
+
+
+def test_bus_metrics():
+    metrics = BusMetrics(capacity=2)
+    metrics.observe(1, 0.1, 6.0)
+    metrics.observe(2, 0.0, 6.0, ModbusError(2))
+
+    snapshot = metrics.snapshot()
+
+    assert snapshot['busy_seconds'] == 12.0
+    # 12 seconds of 60 seconds times 2 transactions at a time.
+    assert 9.9 < snapshot['utilization'] <= 10.0
+    assert snapshot['queue_wait']['count'] == 2
+    assert snapshot['slaves']['2'] == {
+        'transactions': 1,
+        'errors': {'IllegalDataAddress': 1},
+        'latency': snapshot['slaves']['2']['latency'],
+    }
+
+
+def test_prometheus():
+    metrics = Metrics()
+    metrics.observe_request('read_coils', 0.01, IllegalDataAddress())
+
+    bus_metrics = BusMetrics()
+    bus_metrics.observe(1, 0.0, 0.01)
+
+    snapshot = metrics.snapshot()
+    snapshot['backends'] = {'gw"1': bus_metrics.snapshot()}
+    snapshot['backends']['gw"1']['queue'] = {'queued': {'high': 0},
+                                             'dropped': {'high': 2},
+                                             'rejected': {'high': 3}}
+
+    text = prometheus(snapshot)
+
+    assert '# TYPE tolk_requests_total counter\n' \
+        'tolk_requests_total{method="read_coils"} 1\n' in text
+    assert 'tolk_errors_total{method="read_coils",' \
+        'error="IllegalDataAddress"} 1\n' in text
+    assert 'tolk_request_duration_seconds_bucket{method="read_coils",' \
+        'le="+Inf"} 1\n' in text
+    assert 'tolk_bus_transactions_total{backend="gw\\"1",slave="1"} 1\n' \
+        in text
+    assert 'tolk_bus_queued{backend="gw\\"1",priority="high"} 0\n' in text
+    assert 'tolk_bus_dropped_total{backend="gw\\"1",priority="high"} 2\n' \
+        in text
+    assert 'tolk_bus_rejected_total{backend="gw\\"1",priority="high"} 3\n' \
+        in text
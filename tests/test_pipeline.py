@@ -0,0 +1,187 @@
+import socket
+import struct
+import threading
+import time
+
+import pytest
+from modbus_tk.defines import (READ_COILS, READ_HOLDING_REGISTERS,
+                               WRITE_SINGLE_COIL, WRITE_MULTIPLE_COILS,
+                               WRITE_MULTIPLE_REGISTERS)
+from modbus_tk.modbus import ModbusError, ModbusInvalidResponseError
+
+from tolk import Dispatcher
+from tolk.bus import get_bus
+from tolk.pipeline import (MBAP, PipelinedTcpMaster, build_pdu, parse_pdu,
+                           recv_exactly)
+
+
+class FakeSlave(object):
+    """ Modbus TCP slave which collects `batch` requests and answers them in
+    reverse order. Every response contains the transaction id plus
+    `id_offset` and a single register with the transaction id as value.
+    """
+    def __init__(self, batch, id_offset=0):
+        self.batch = batch
+        self.id_offset = id_offset
+
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(1)
+        self.port = self.sock.getsockname()[1]
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        conn, _ = self.sock.accept()
+
+        try:
+            while True:
+                requests = []
+                for _ in range(self.batch):
+                    transaction_id, _, length, unit_id = \
+                        MBAP.unpack(recv_exactly(conn, MBAP.size))
+                    recv_exactly(conn, length - 1)
+                    requests.append((transaction_id, unit_id))
+
+                for transaction_id, unit_id in reversed(requests):
+                    pdu = struct.pack('>BBH', READ_HOLDING_REGISTERS, 2,
+                                      transaction_id)
+                    conn.sendall(MBAP.pack(transaction_id + self.id_offset, 0,
+                                           len(pdu) + 1, unit_id) + pdu)
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+            self.sock.close()
+
+
+def execute_concurrently(master, n):
+    """ Read a register in n threads and return list with results. """
+    results = [None] * n
+
+    def read(i):
+        try:
+            results[i] = master.execute(1, READ_HOLDING_REGISTERS, 100, 1)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=read, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return results
+
+
+def test_build_and_parse_pdu():
+    assert build_pdu(READ_COILS, 100, 10) == '\x01\x00\x64\x00\x0a'
+    assert build_pdu(WRITE_SINGLE_COIL, 100, output_value=1) == \
+        '\x05\x00\x64\xff\x00'
+    assert build_pdu(WRITE_MULTIPLE_COILS, 100, output_value=[1] * 9) == \
+        '\x0f\x00\x64\x00\x09\x02\xff\x01'
+    assert build_pdu(WRITE_MULTIPLE_REGISTERS, 100, output_value=[1, -1]) == \
+        '\x10\x00\x64\x00\x02\x04\x00\x01\xff\xff'
+
+    assert parse_pdu(READ_COILS, 3, '\x01\x01\x05') == (1, 0, 1)
+    assert parse_pdu(READ_HOLDING_REGISTERS, 2, '\x03\x04\x00\x01\x00\x02') \
+        == (1, 2)
+    assert parse_pdu(WRITE_SINGLE_COIL, 0, '\x05\x00\x64\xff\x00') == \
+        (100, 0xFF00)
+
+    with pytest.raises(ModbusError) as e:
+        parse_pdu(READ_COILS, 3, '\x81\x02')
+    assert e.value.get_exception_code() == 2
+
+
+def test_execute_against_slave(modbus_master):
+    master = PipelinedTcpMaster(port=modbus_master._port, window=4)
+
+    try:
+        assert master.execute(1, WRITE_MULTIPLE_REGISTERS, 100,
+                              output_value=[1, 2, 3]) == (100, 3)
+        assert execute_concurrently(master, 20) == [(1,)] * 20
+        assert master.window == 4
+    finally:
+        master.close()
+
+
+def test_responses_matched_by_transaction_id():
+    """ Test if requests are outstanding at the same time and if responses
+    which arrive out of order reach the right caller.
+    """
+    slave = FakeSlave(batch=4)
+    master = PipelinedTcpMaster(port=slave.port, timeout_in_sec=2, window=4)
+
+    try:
+        results = execute_concurrently(master, 8)
+        assert sorted([r[0] for r in results]) == range(1, 9)
+    finally:
+        master.close()
+
+
+def test_fall_back_to_strict_request_response():
+    """ Test if master falls back to a window of 1 when slave answers with
+    unknown transaction ids.
+    """
+    slave = FakeSlave(batch=1, id_offset=1000)
+    master = PipelinedTcpMaster(port=slave.port, timeout_in_sec=0.2, window=4)
+
+    try:
+        with pytest.raises(socket.timeout):
+            master.execute(1, READ_HOLDING_REGISTERS, 100, 1)
+
+        assert master.window == 1
+    finally:
+        master.close()
+
+
+def test_chunks_of_oversized_read_run_concurrently():
+    """ Test if a read which is split into 2 chunks keeps both chunks
+    outstanding at the same time. The slave only answers after it has
+    received 2 requests.
+    """
+    slave = FakeSlave(batch=2)
+    master = PipelinedTcpMaster(port=slave.port, timeout_in_sec=2, window=2)
+
+    try:
+        # The fake slave answers every chunk with a single register.
+        assert len(Dispatcher(master).read_holding_registers(0, 250)) == 2
+    finally:
+        master.close()
+
+
+def test_parse_pdu_validates_response():
+    with pytest.raises(ModbusInvalidResponseError):
+        parse_pdu(READ_COILS, 3, '\x03\x01\x05')
+
+    with pytest.raises(ModbusInvalidResponseError):
+        parse_pdu(WRITE_SINGLE_COIL, 0, '\x05\x00\x64')
+
+
+def test_fall_back_resizes_bus_and_recovers():
+    master = PipelinedTcpMaster(window=4)
+    bus = get_bus(master)
+
+    with master._cond:
+        master._degrade('test')
+    assert master.window == bus.scheduler.capacity == 1
+
+    master._degraded -= master.recovery
+    with master._cond:
+        master._recover()
+    assert master.window == bus.scheduler.capacity == 4
+
+
+def test_transaction_ids_of_timed_out_requests_expire():
+    master = PipelinedTcpMaster()
+    master._abandoned = dict((i, time.time()) for i in range(0x10000))
+
+    with pytest.raises(socket.error):
+        master._next_transaction_id()
+
+    master._abandoned[7] -= master.abandoned_ttl + 1
+    assert master._next_transaction_id() == 7
+    assert 7 not in master._abandoned
@@ -0,0 +1,98 @@
+import json
+
+import pytest
+from modbus_tk.defines import READ_COILS, READ_HOLDING_REGISTERS
+
+from tolk.coalesce import Read
+from tolk.points import Point, PointMap, load_points
+
+
+@pytest.fixture
+def points():
+    return PointMap([
+        Point('temp', 'holding_registers', 100, dtype='float32'),
+        Point('speed', 'holding_registers', 104, scale=0.1),
+        Point('far', 'holding_registers', 200),
+        Point('pump', 'coils', 100),
+        Point('other', 'holding_registers', 100, slave_id=2),
+        Point('remote', 'holding_registers', 100, unit='gateway-2'),
+    ])
+
+
+def test_point_read():
+    assert Point('a', 'holding_registers', 10, dtype='float64').read == \
+        Read(1, READ_HOLDING_REGISTERS, 10, 4)
+    assert Point('a', 'holding_registers', 10, dtype='string',
+                 length=5).read == Read(1, READ_HOLDING_REGISTERS, 10, 3)
+    assert Point('a', 'coils', 10, dtype='float64').read == \
+        Read(1, READ_COILS, 10, 1)
+
+
+def test_point_decode():
+    assert Point('a', 'holding_registers', 0, dtype='float32').decode(
+        [0x41AC, 0x0000]) == 21.5
+    assert Point('a', 'holding_registers', 0, dtype='int16',
+                 scale=0.5).decode([0xFFFE]) == -1.0
+    assert Point('a', 'coils', 0).decode([1]) == 1
+
+
+def test_invalid_point():
+    with pytest.raises(ValueError):
+        Point('a', 'registers', 0)
+
+    with pytest.raises(ValueError):
+        Point('a', 'holding_registers', 0, dtype='float16')
+
+    with pytest.raises(ValueError):
+        PointMap([Point('a', 'coils', 0), Point('a', 'coils', 1)])
+
+
+def test_plan(points):
+    plan = points.plan(['temp', 'speed', 'far', 'pump', 'other', 'remote'])
+
+    assert [(unit, frame) for unit, frame, _ in plan] == [
+        (None, Read(1, 1, 100, 1)),
+        (None, Read(1, 3, 100, 5)),
+        (None, Read(1, 3, 200, 1)),
+        (None, Read(2, 3, 100, 1)),
+        ('gateway-2', Read(1, 3, 100, 1)),
+    ]
+
+    assert [(offset, point.name) for offset, point in plan[1][2]] == \
+        [(0, 'temp'), (4, 'speed')]
+
+
+def test_plan_is_memoized(points):
+    assert points.plan(['temp', 'speed']) is points.plan(['speed', 'temp'])
+
+
+def test_plan_respects_max_quantity():
+    points = PointMap([Point(str(a), 'holding_registers', a)
+                       for a in range(0, 200, 5)])
+
+    plan = points.plan([str(a) for a in range(0, 200, 5)])
+
+    assert [frame for _, frame, _ in plan] == \
+        [Read(1, 3, 0, 121), Read(1, 3, 125, 71)]
+    assert sum(len(members) for _, _, members in plan) == 40
+
+
+def test_plan_unknown_point(points):
+    with pytest.raises(KeyError):
+        points.plan(['temp', 'unknown'])
+
+
+def test_load_points(tmpdir):
+    path = tmpdir.join('points.json')
+    path.write(json.dumps({
+        'temp': {'unit': 'gateway-2', 'slave_id': 3,
+                 'table': 'holding_registers', 'address': 100,
+                 'dtype': 'float32', 'word_order': 'little'},
+        'pump': {'table': 'coils', 'address': 5},
+    }))
+
+    points = load_points(path.strpath)
+
+    assert points['temp'] == Point('temp', 'holding_registers', 100, 3,
+                                   'gateway-2', 'float32', 'big', 'little')
+    assert points['pump'] == Point('pump', 'coils', 5)
@@ -0,0 +1,43 @@
+from mock import patch
+
+from tolk.ratelimit import RateLimiter, TokenBucket
+
+
+@patch('tolk.ratelimit.time')
+def test_token_bucket(time):
+    time.time.return_value = 100.0
+    bucket = TokenBucket(rate=4, burst=2)
+
+    assert bucket.take() == 0
+    assert bucket.take() == 0
+    assert bucket.take() == 0.25
+
+    time.time.return_value = 100.25
+    assert bucket.take() == 0
+    assert not bucket.full
+
+    # Bucket is never filled above its burst.
+    time.time.return_value = 200.0
+    assert bucket.full
+    assert bucket.take(2) == 0
+    assert bucket.take() > 0
+
+
+@patch('tolk.ratelimit.time')
+def test_token_bucket_debt(time):
+    """ Test if a batch larger than the burst is allowed when bucket is full
+    and if it's paid off before new requests are allowed.
+    """
+    time.time.return_value = 100.0
+    bucket = TokenBucket(rate=4, burst=2)
+
+    assert bucket.take(4) == 0
+    assert bucket.take() == 0.75
+
+
+def test_rate_limiter_per_client():
+    limiter = RateLimiter(rate=1, burst=2)
+
+    assert limiter.take('a', 2) == 0
+    assert limiter.take('a') > 0
+    assert limiter.take('b') == 0
@@ -0,0 +1,231 @@
+import time
+import socket
+from threading import Event, Thread
+
+import pytest
+from mock import Mock
+
+from tolk.reactor import ReactorServer, WorkerPool
+
+
+@pytest.yield_fixture
+def reactor(tmpdir):
+    """ Yield running ReactorServer with a dispatcher which echoes requests
+    back. """
+    dispatcher = Mock()
+    dispatcher.call = Mock(side_effect=lambda msg, session=None: msg)
+
+    server = ReactorServer(tmpdir.join('test_tolk_socket').strpath,
+                           dispatcher, workers=2)
+
+    t = Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05})
+    t.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+def connect(server):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Connect in blocking mode, so connect waits when backlog of server is
+    # full instead of failing with EAGAIN.
+    sock.connect(server.server_address)
+    sock.settimeout(1)
+
+    return sock
+
+
+def recv_lines(sock, n):
+    """ Receive n newline-terminated lines. """
+    data = ''
+    while data.count('\n') < n:
+        chunk = sock.recv(4096)
+        assert chunk
+        data += chunk
+
+    return data.splitlines()
+
+
+def test_many_idle_connections(reactor):
+    """ Test if clients are served while many other connections are idle. """
+    idle = [connect(reactor) for _ in range(200)]
+
+    sock = connect(reactor)
+    sock.sendall('{"id": 1}\n')
+    assert recv_lines(sock, 1) == ['{"id": 1}']
+
+    for s in idle + [sock]:
+        s.close()
+
+
+def test_responses_in_order_of_requests(reactor):
+    sock = connect(reactor)
+
+    msgs = ['{{"id": {0}}}'.format(i) for i in range(50)]
+    sock.sendall(''.join([m + '\n' for m in msgs]))
+
+    assert recv_lines(sock, len(msgs)) == msgs
+    sock.close()
+
+
+def test_unterminated_request(reactor):
+    """ Test if clients sending a single request without newline get a
+    response. """
+    sock = connect(reactor)
+    sock.sendall('{"id": 1}')
+
+    assert recv_lines(sock, 1) == ['{"id": 1}']
+    sock.close()
+
+
+def test_connection_closed_by_client(reactor):
+    sock = connect(reactor)
+    sock.sendall('{"id": 1}\n')
+    recv_lines(sock, 1)
+    sock.close()
+
+    for _ in range(20):
+        if not reactor.connections:
+            break
+        time.sleep(0.05)
+
+    assert reactor.connections == {}
+
+
+def test_disconnect_cancels_requests(reactor):
+    """ Test if requests of a client which disconnects aren't dispatched
+    anymore, and if the request being dispatched sees the session
+    disconnected.
+    """
+    cancelled = Event()
+
+    def call(msg, session=None):
+        timeout = time.time() + 1
+        while not session.disconnected() and time.time() < timeout:
+            time.sleep(0.01)
+
+        if session.disconnected():
+            cancelled.set()
+
+    reactor.dispatcher.call.side_effect = call
+
+    sock = connect(reactor)
+    sock.sendall('{"id": 1}\n{"id": 2}\n{"id": 3}\n')
+    time.sleep(0.1)
+    sock.close()
+
+    cancelled.wait(1)
+    assert cancelled.is_set()
+
+    for _ in range(20):
+        if not reactor.connections:
+            break
+        time.sleep(0.05)
+
+    assert reactor.connections == {}
+    assert reactor.dispatcher.call.call_count == 1
+
+
+def test_half_closed_connection(reactor):
+    """ Test if a client which shuts down its side of the connection gets
+    responses to all requests it has sent, before the connection is closed.
+    """
+    def call(msg, session=None):
+        time.sleep(0.05)
+        assert not session.disconnected()
+        return msg
+
+    reactor.dispatcher.call.side_effect = call
+
+    sock = connect(reactor)
+    msgs = ['{{"id": {0}}}'.format(i) for i in range(3)]
+    sock.sendall(''.join([m + '\n' for m in msgs]))
+    sock.shutdown(socket.SHUT_WR)
+
+    assert recv_lines(sock, len(msgs)) == msgs
+    assert sock.recv(4096) == ''
+    sock.close()
+
+
+def test_backpressure(reactor):
+    """ Test if a connection isn't read from while it has too many requests
+    waiting to be dispatched.
+    """
+    reactor.max_pending = 2
+    dispatched = Event()
+
+    def call(msg, session=None):
+        dispatched.wait(1)
+        return msg
+
+    reactor.dispatcher.call.side_effect = call
+
+    sock = connect(reactor)
+    for i in range(10):
+        sock.sendall('{{"id": {0}}}\n'.format(i))
+        time.sleep(0.02)
+
+    conn, = reactor.connections.values()
+    assert len(conn.pending) == 2
+
+    dispatched.set()
+    assert recv_lines(sock, 10) == ['{{"id": {0}}}'.format(i)
+                                    for i in range(10)]
+    sock.close()
+
+
+def test_shutdown_before_serve_forever(tmpdir):
+    server = ReactorServer(tmpdir.join('test_tolk_socket').strpath, Mock())
+    server.shutdown()
+
+    t = Thread(target=server.serve_forever)
+    t.start()
+    t.join(1)
+
+    assert not t.is_alive()
+    server.server_close()
+
+
+def test_worker_pool():
+    results = []
+    pool = WorkerPool(2)
+
+    pool.submit(results.append, 1)
+    pool.close()
+
+    for t in pool.threads:
+        t.join(1)
+
+    assert results == [1]
+
+
+def test_session_pushes_notifications(reactor):
+    """ Test if messages sent over session of connection reach client. """
+    sessions = []
+
+    def call(msg, session=None):
+        sessions.append(session)
+        return msg
+
+    reactor.dispatcher.call.side_effect = call
+
+    sock = connect(reactor)
+    sock.sendall('{"id": 1}\n')
+    assert recv_lines(sock, 1) == ['{"id": 1}']
+
+    sessions[0].notify('notify', {})
+    assert '"method": "notify"' in recv_lines(sock, 1)[0]
+
+    sock.close()
+
+
+def test_negotiate_codec(reactor):
+    """ Test if client which sends an unknown codec in its preamble falls
+    back to JSON. """
+    sock = connect(reactor)
+    sock.sendall('\x00cbor\n{"id": 1}\n')
+
+    assert recv_lines(sock, 2) == ['\x00json', '{"id": 1}']
+    sock.close()
@@ -0,0 +1,175 @@
+import json
+import threading
+from functools import partial
+
+import pytest
+from mock import Mock
+from modbus_tk.defines import READ_HOLDING_REGISTERS
+from modbus_tk.modbus_tcp import TcpMaster
+
+from tolk import Dispatcher
+from tolk.points import Point, PointMap
+from tolk.routing import Backend, NoRoute, Router, load_router
+from tolk.session import Session
+
+
+def get_router():
+    backends = dict((name, Backend(Mock())) for name in ['a', 'b'])
+    return Router(backends, routes=[(1, 31, 'a'), (32, 63, 'b')],
+                  units={'boiler': ('b', 3), 'pump': ('a', None)})
+
+
+def test_route_by_slave_id():
+    router = get_router()
+
+    assert router.route(1) == (router.backends['a'], 1)
+    assert router.route(32) == (router.backends['b'], 32)
+
+    with pytest.raises(NoRoute):
+        router.route(64)
+
+    router.default = 'a'
+    assert router.route(64) == (router.backends['a'], 64)
+
+
+def test_route_by_unit():
+    router = get_router()
+
+    assert router.route(1, 'boiler') == (router.backends['b'], 3)
+    assert router.route(5, 'pump') == (router.backends['a'], 5)
+    assert router.route(5, 'b') == (router.backends['b'], 5)
+
+    with pytest.raises(NoRoute):
+        router.route(1, 'unknown')
+
+
+def test_router_with_unknown_backend():
+    with pytest.raises(ValueError):
+        Router({'a': Backend(Mock())}, routes=[(1, 2, 'b')])
+
+
+def test_load_router(tmpdir):
+    path = tmpdir.join('routes.json')
+    path.write(json.dumps({
+        'backends': {
+            'gateway-1': {'host': '10.0.0.1', 'port': 503, 'timeout': 2},
+            'gateway-2': {'host': '10.0.0.2', 'max_queue': 50,
+                          'max_queue_wait': 2},
+        },
+        'routes': [{'slave_ids': [1, 31], 'backend': 'gateway-2'}],
+        'units': {'boiler': {'backend': 'gateway-2', 'slave_id': 3}},
+        'default': 'gateway-1',
+    }))
+
+    router = load_router(path.strpath)
+
+    master = router.backends['gateway-1'].modbus_master
+    assert isinstance(master, TcpMaster)
+    assert (master._host, master._port) == ('10.0.0.1', 503)
+    assert master.get_timeout() == 2
+
+    assert router.route(1)[0] is router.backends['gateway-2']
+    assert router.route(40)[0] is router.backends['gateway-1']
+    assert router.route(1, 'boiler') == (router.backends['gateway-2'], 3)
+
+    scheduler = router.backends['gateway-2'].bus.scheduler
+    assert (scheduler.max_queue, scheduler.max_queue_wait) == (50, 2)
+    assert router.backends['gateway-1'].bus.scheduler.max_queue is None
+
+
+def test_dispatcher_routes_requests(modbus_master):
+    """ Test if requests are executed on the master they're routed to. """
+    other = Mock()
+    other.execute.return_value = (42,)
+
+    router = Router({'local': Backend(modbus_master), 'other': Backend(other)},
+                    routes=[(2, 2, 'other')], units={'boiler': ('other', 7)},
+                    default='local')
+    dispatcher = Dispatcher(router=router)
+
+    assert dispatcher.read_holding_registers(100, 1) == (0,)
+    assert dispatcher.read_holding_registers(100, 1, slave_id=2) == (42,)
+    assert dispatcher.read_holding_registers(100, 1, unit='boiler') == (42,)
+
+    assert [c[0] for c in other.execute.call_args_list] == [
+        (2, READ_HOLDING_REGISTERS, 100, 1),
+        (7, READ_HOLDING_REGISTERS, 100, 1),
+    ]
+
+    msg = json.dumps({'jsonrpc': '2.0', 'method': 'read_coils', 'id': 1,
+                      'params': {'starting_address': 100, 'quantity': 1,
+                                 'unit': 'unknown'}})
+    assert json.loads(dispatcher.call(msg))['error']['code'] == -32602
+
+
+def test_backends_execute_in_parallel():
+    """ Test if a slow backend doesn't block requests to other backends. """
+    release = threading.Event()
+
+    slow = Mock()
+    slow.execute.side_effect = lambda *args: release.wait(2) and (1,)
+    fast = Mock()
+    fast.execute.return_value = (2,)
+
+    dispatcher = Dispatcher(router=Router({'slow': Backend(slow),
+                                           'fast': Backend(fast)}))
+
+    t = threading.Thread(target=dispatcher.read_holding_registers,
+                         args=(100, 1), kwargs={'unit': 'slow'})
+    t.start()
+
+    try:
+        assert dispatcher.read_holding_registers(100, 1, unit='fast') == (2,)
+        assert not release.is_set()
+    finally:
+        release.set()
+        t.join()
+
+
+def test_read_points_of_multiple_units():
+    """ Test if points of different units are read with the client and
+    limits of the request, though they're read by other threads. """
+    started = []
+    both = threading.Event()
+
+    def execute(value, *args, **kwargs):
+        # Hold the frames until both are read, so they're read by
+        # different threads.
+        started.append(value)
+        if len(started) == 2:
+            both.set()
+
+        both.wait(2)
+        return (value,)
+
+    backends = {}
+    for name, value in [('a', 1), ('b', 2)]:
+        master = Mock()
+        master.execute.side_effect = partial(execute, value)
+        backends[name] = Backend(master)
+        backends[name].bus.execute = Mock(wraps=backends[name].bus.execute)
+
+    dispatcher = Dispatcher(
+        router=Router(backends, default='a'),
+        points=PointMap([Point('x', 'holding_registers', 100, unit='a'),
+                         Point('y', 'holding_registers', 100, unit='b')]))
+
+    session = Session(Mock())
+    msg = json.dumps({'jsonrpc': '2.0', 'method': 'read_points', 'id': 1,
+                      'params': {'names': ['x', 'y'], 'timeout_ms': 1000}})
+    assert json.loads(dispatcher.call(msg, session))['result'] == \
+        {'x': 1, 'y': 2}
+
+    for backend in backends.values():
+        _, kwargs = backend.bus.execute.call_args
+        assert kwargs['client'] == session.id
+        assert kwargs['deadline'] is not None
+        assert kwargs['cancelled'] == session.disconnected
+
+
+def test_dispatcher_requires_master_or_router(modbus_master):
+    with pytest.raises(ValueError):
+        Dispatcher()
+
+    with pytest.raises(ValueError):
+        Dispatcher(modbus_master, router=get_router())
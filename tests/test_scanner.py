@@ -0,0 +1,171 @@
+import json
+import time
+
+from mock import Mock
+from modbus_tk.defines import READ_COILS, READ_HOLDING_REGISTERS
+from modbus_tk.modbus import ModbusError
+
+from tolk.coalesce import Read
+from tolk.scanner import (GOOD, STALE, BAD, ScanGroup, RegisterImage,
+                          Scanner, compile_frames, load_scan_groups)
+from tolk.scheduler import LOW
+
+
+def test_load_scan_groups(tmpdir):
+    path = tmpdir.join('scan.json')
+    path.write(json.dumps([{'table': 'coils', 'starting_address': 100,
+                            'quantity': 10, 'interval': 0.5}]))
+
+    assert load_scan_groups(path.strpath) == \
+        [ScanGroup(1, READ_COILS, 100, 10, 0.5)]
+
+
+def test_compile_frames():
+    frames = compile_frames([
+        ScanGroup(1, READ_HOLDING_REGISTERS, 100, 10, 1),
+        ScanGroup(1, READ_HOLDING_REGISTERS, 112, 4, 1),
+        ScanGroup(1, READ_HOLDING_REGISTERS, 300, 4, 1),
+        ScanGroup(1, READ_HOLDING_REGISTERS, 116, 4, 2),
+    ])
+
+    assert frames == [
+        (Read(1, READ_HOLDING_REGISTERS, 100, 16), 1, 0),
+        (Read(1, READ_HOLDING_REGISTERS, 300, 4), 1, 0.5),
+        (Read(1, READ_HOLDING_REGISTERS, 116, 4), 2, 0),
+    ]
+
+
+def test_compile_frames_splits_oversized_groups():
+    frames = compile_frames([ScanGroup(1, READ_HOLDING_REGISTERS, 0, 300, 1)])
+
+    assert [frame for frame, _, _ in frames] == [
+        Read(1, READ_HOLDING_REGISTERS, 0, 125),
+        Read(1, READ_HOLDING_REGISTERS, 125, 125),
+        Read(1, READ_HOLDING_REGISTERS, 250, 50),
+    ]
+
+
+def test_register_image_lookup():
+    image = RegisterImage()
+    image.update(1, 3, 100, (1, 2), time.time(), max_age=10)
+
+    assert image.lookup(1, 3, 100, 2) == (1, 2)
+    assert image.lookup(1, 3, 100, 3) is None
+
+    image.update(1, 3, 102, (3,), time.time() - 20, max_age=10)
+    assert image.lookup(1, 3, 100, 3) is None
+
+    image.mark_bad(1, 3, 100, 1)
+    assert image.lookup(1, 3, 100, 1) is None
+
+
+def test_register_image_overwrite():
+    image = RegisterImage()
+    image.update(1, 3, 100, (1, 2), time.time(), max_age=10)
+    image.overwrite(1, 3, 101, [3, 4])
+
+    assert image.lookup(1, 3, 100, 2) == (1, 3)
+    assert image.lookup(1, 3, 102, 1) is None
+
+
+def test_register_image_snapshot():
+    image = RegisterImage()
+    now = time.time()
+    image.update(1, 3, 100, (1, 2), now - 1, max_age=10)
+
+    snapshot = image.snapshot(1, 3, 100, 2)
+    assert snapshot['values'] == [1, 2]
+    assert snapshot['timestamp'] == now - 1
+    assert snapshot['age'] >= 1
+    assert snapshot['quality'] == GOOD
+
+    image.update(1, 3, 100, (1,), now - 20, max_age=10)
+    assert image.snapshot(1, 3, 100, 2)['quality'] == STALE
+
+    assert image.snapshot(1, 3, 100, 3)['quality'] == BAD
+    assert image.snapshot(1, 3, 100, 3)['values'] == [1, 2, None]
+
+
+def test_scanner_fills_image():
+    bus = Mock()
+    bus.execute = Mock(return_value=(1, 2))
+    image = RegisterImage()
+
+    scanner = Scanner(bus, [ScanGroup(1, 3, 100, 2, 0.02)], image)
+    scanner.start()
+    time.sleep(0.1)
+    scanner.stop()
+
+    assert bus.execute.call_count > 1
+    bus.execute.assert_called_with(1, 3, 100, 2, priority=LOW)
+    assert image.lookup(1, 3, 100, 2) == (1, 2)
+
+
+def test_scanner_marks_failed_scans_bad():
+    bus = Mock()
+    bus.execute = Mock(side_effect=IOError)
+    image = RegisterImage()
+    image.update(1, 3, 100, (1, 2), time.time(), max_age=10)
+
+    Scanner(bus, [], image).scan(Read(1, 3, 100, 2), 1)
+
+    assert image.snapshot(1, 3, 100, 2)['quality'] == BAD
+
+
+def test_scanner_scans_groups_of_failing_frame():
+    """ Test if groups of a merged frame which fails with an exception
+    response are scanned one by one, instead of marking them all bad.
+    """
+    def execute(slave_id, function_code, starting_address, quantity,
+                priority):
+        if quantity > 2:
+            raise ModbusError(2)
+        return (starting_address,) * quantity
+
+    bus = Mock()
+    bus.execute = Mock(side_effect=execute)
+    image = RegisterImage()
+
+    scanner = Scanner(bus, [ScanGroup(1, 3, 100, 2, 1),
+                            ScanGroup(1, 3, 104, 2, 1)], image)
+    frame, interval, _ = scanner.frames[0]
+    assert frame == Read(1, 3, 100, 6)
+
+    for _ in range(2):
+        scanner.scan(frame, interval)
+        assert image.lookup(1, 3, 100, 2) == (100, 100)
+        assert image.lookup(1, 3, 104, 2) == (104, 104)
+
+    # The merged frame is tried only once.
+    assert [c[0][3] for c in bus.execute.call_args_list] == [6, 2, 2, 2, 2]
+
+
+def test_scanner_scans_groups_split_over_frames():
+    """ Test if every address of a group which is split over multiple frames
+    is scanned when those frames are scanned as their groups.
+    """
+    def execute(slave_id, function_code, starting_address, quantity,
+                priority):
+        return (starting_address,) * quantity
+
+    bus = Mock()
+    bus.execute = Mock(side_effect=execute)
+    image = RegisterImage()
+
+    scanner = Scanner(bus, [ScanGroup(1, 3, 100, 11, 1),
+                            ScanGroup(1, 3, 115, 186, 1)], image)
+
+    # Merged frame of both groups, split at address 225.
+    frames = [Read(1, 3, 100, 125), Read(1, 3, 225, 76)]
+    assert [scanner._parts(frame, 1) for frame in frames] == [
+        [Read(1, 3, 100, 11), Read(1, 3, 115, 110)],
+        [Read(1, 3, 225, 76)],
+    ]
+
+    for frame in frames:
+        scanner._unmerged.add(frame)
+        scanner.scan(frame, 1)
+
+    assert image.lookup(1, 3, 100, 11) == (100,) * 11
+    assert image.lookup(1, 3, 115, 110) == (115,) * 110
+    assert image.lookup(1, 3, 225, 76) == (225,) * 76
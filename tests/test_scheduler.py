@@ -0,0 +1,186 @@
+import time
+import threading
+
+import pytest
+
+from tolk.exceptions import DeadlineExceeded, RequestCancelled, ServerBusy
+from tolk.scheduler import HIGH, NORMAL, LOW, Scheduler
+
+
+def run_queued(scheduler, transactions):
+    """ Queue transactions while bus is busy and return names of
+    transactions in the order they've been granted the bus.
+
+    :param transactions: List with (name, priority, client) tuples.
+    """
+    order = []
+
+    def run(name, priority, client):
+        scheduler.acquire(priority, client)
+        order.append(name)
+        scheduler.release()
+
+    scheduler.acquire()
+
+    threads = []
+    for transaction in transactions:
+        t = threading.Thread(target=run, args=transaction)
+        t.start()
+        threads.append(t)
+
+        # Wait until transaction has been queued, to control order.
+        while len(scheduler.waiting) < len(threads):
+            time.sleep(0.001)
+
+    scheduler.release()
+
+    for t in threads:
+        t.join()
+
+    return order
+
+
+def test_high_priority_first():
+    order = run_queued(Scheduler(), [
+        ('read-1', NORMAL, 1),
+        ('scan', LOW, None),
+        ('read-2', NORMAL, 1),
+        ('write', HIGH, 2),
+    ])
+
+    assert order == ['write', 'read-1', 'read-2', 'scan']
+
+
+def test_fair_between_clients():
+    order = run_queued(Scheduler(), [('a', NORMAL, 'a')] * 4 +
+                                    [('b', NORMAL, 'b')] * 2)
+
+    assert order == ['a', 'b', 'a', 'b', 'a', 'a']
+
+
+def test_weighted_fair_between_clients():
+    order = run_queued(Scheduler(weights={'a': 2}),
+                       [('a', NORMAL, 'a')] * 4 + [('b', NORMAL, 'b')] * 2)
+
+    assert order == ['a', 'a', 'b', 'a', 'a', 'b']
+
+
+def test_waiting_transactions_are_promoted():
+    scheduler = Scheduler(aging=0.05)
+    order = []
+
+    def run(name, priority):
+        scheduler.acquire(priority)
+        order.append(name)
+        scheduler.release()
+
+    scheduler.acquire()
+
+    threads = [threading.Thread(target=run, args=('scan', LOW)),
+               threading.Thread(target=run, args=('write', HIGH))]
+
+    threads[0].start()
+    time.sleep(0.15)
+    threads[1].start()
+
+    while len(scheduler.waiting) < 2:
+        time.sleep(0.001)
+
+    scheduler.release()
+    for t in threads:
+        t.join()
+
+    # Scan has waited long enough to be promoted to high priority, and it
+    # was queued before write.
+    assert order == ['scan', 'write']
+
+
+def test_stats():
+    scheduler = Scheduler(capacity=2)
+    scheduler.acquire(HIGH)
+    scheduler.acquire(LOW)
+
+    stats = scheduler.stats()
+    assert stats['running'] == 2
+    assert stats['served'] == {'high': 1, 'normal': 0, 'low': 1}
+    assert stats['queued'] == {'high': 0, 'normal': 0, 'low': 0}
+
+
+def test_deadline_drops_waiting_transaction():
+    scheduler = Scheduler()
+    scheduler.acquire()
+
+    start = time.time()
+    with pytest.raises(DeadlineExceeded):
+        scheduler.acquire(deadline=time.time() + 0.05)
+
+    assert 0.05 <= time.time() - start < 0.5
+    assert scheduler.waiting == []
+    assert scheduler.stats()['dropped'] == {'high': 0, 'normal': 1, 'low': 0}
+
+    # Bus is released to the transactions which are still waiting.
+    scheduler.release()
+    scheduler.acquire(deadline=time.time() + 1)
+    assert scheduler.running == 1
+
+
+def test_cancelled_transaction_is_dropped():
+    scheduler = Scheduler()
+    scheduler.acquire()
+
+    gone = []
+    errors = []
+
+    def run():
+        try:
+            scheduler.acquire(LOW, cancelled=lambda: bool(gone))
+        except RequestCancelled as e:
+            errors.append(e)
+
+    t = threading.Thread(target=run)
+    t.start()
+    while not scheduler.waiting:
+        time.sleep(0.001)
+
+    gone.append(True)
+    t.join()
+
+    assert len(errors) == 1
+    assert scheduler.waiting == []
+    assert scheduler.stats()['dropped']['low'] == 1
+
+
+def test_full_queue_rejects_transaction():
+    scheduler = Scheduler(max_queue=1)
+    scheduler.acquire()
+    scheduler.release(0.1)
+
+    scheduler.acquire()
+    t = threading.Thread(target=scheduler.acquire)
+    t.start()
+    while not scheduler.waiting:
+        time.sleep(0.001)
+
+    try:
+        with pytest.raises(ServerBusy) as e:
+            scheduler.acquire(HIGH)
+    finally:
+        scheduler.release()
+        t.join()
+
+    # Queue is worked off after the running and the waiting transaction,
+    # which take 55 ms each on average.
+    assert e.value.retry_after_ms == 110
+    assert scheduler.stats()['rejected'] == {'high': 1, 'normal': 0,
+                                             'low': 0}
+
+
+def test_transaction_waiting_too_long_is_rejected():
+    scheduler = Scheduler(max_queue_wait=0.05)
+    scheduler.acquire()
+
+    with pytest.raises(ServerBusy):
+        scheduler.acquire(LOW)
+
+    assert scheduler.waiting == []
+    assert scheduler.stats()['rejected']['low'] == 1
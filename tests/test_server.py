@@ -3,12 +3,21 @@ tests of :class:`tolk.Dispatcher` are executed.
 
 See test coverage if you don't believe me.
 """
+import json
+import time
 import socket
+from threading import Thread
 
 import pytest
 import errno
 from mock import Mock, patch
-from tolk import Handler
+from tolk import Dispatcher, Handler
+from tolk.codec import BINARY_CODECS, Codec
+from tolk.exceptions import ServerBusy
+from tolk.routing import Backend, Router
+from tolk.server import (ThreadPoolTCPServer, ThreadPoolUnixStreamServer,
+                         share_workers)
+from tolk.tracing import Tracer
 
 
 class TestHandler:
@@ -19,10 +28,11 @@ class TestHandler:
 
         """
         mock_request = Mock()
+        mock_request.recv = Mock(return_value='{"id": 1}\n')
         mock_request.sendall = Mock(side_effect=socket.error())
 
         with pytest.raises(socket.error) as exinfo:
-            Handler(mock_request, Mock(), Mock()).handle()
+            Handler(mock_request, Mock(), get_mock_server()).handle()
 
 
     def test_handle_epipe_socket_error(self):
@@ -31,6 +41,231 @@ class TestHandler:
 
         """
         mock_request = Mock()
+        mock_request.recv = Mock(return_value='{"id": 1}\n')
         mock_request.sendall = Mock(side_effect=socket.error(errno.EPIPE, 'Raise socket error EPIPE'))
 
-        assert Handler(mock_request, Mock(), Mock()).handle() is None
+        assert Handler(mock_request, Mock(), get_mock_server()).handle() is None
+
+    def test_handle_message_split_over_multiple_reads(self):
+        """ Test if message is dispatched once it has been received
+        completely and if connection is closed when client closes it.
+
+        """
+        mock_request = Mock()
+        mock_request.recv = Mock(side_effect=['{"id"', ': 1}\n', ''])
+        server = get_mock_server()
+
+        Handler(mock_request, Mock(), server)
+
+        assert server.dispatcher.call.call_count == 1
+        assert server.dispatcher.call.call_args[0][0] == '{"id": 1}'
+        mock_request.sendall.assert_called_once_with('{"result": 1}\n')
+
+    def test_handle_notification(self):
+        """ Test if nothing is send back when dispatcher returns no response.
+
+        """
+        mock_request = Mock()
+        mock_request.recv = Mock(side_effect=['{"method": "x"}\n', ''])
+        server = get_mock_server()
+        server.dispatcher.call.return_value = None
+
+        Handler(mock_request, Mock(), server)
+
+        assert not mock_request.sendall.called
+
+    def test_handle_binary_codec(self):
+        """ Test if client can negotiate a binary codec with a preamble. """
+        mock_request = Mock()
+        mock_request.recv = Mock(side_effect=['\x00binary\n\x00\x00',
+                                              '\x00\x02{}', ''])
+        server = get_mock_server()
+
+        BINARY_CODECS['binary'] = lambda: Codec(json)
+        try:
+            Handler(mock_request, Mock(), server)
+        finally:
+            del BINARY_CODECS['binary']
+
+        msg, session = server.dispatcher.call.call_args[0]
+        assert msg == '{}'
+        assert session.codec.name == 'json'
+        assert [c[0][0] for c in mock_request.sendall.call_args_list] == \
+            ['\x00binary\n', '\x00\x00\x00\x0d{"result": 1}']
+
+    def test_handle_traces_read_and_send(self):
+        """ Test if reading a request and sending its response are traced.
+        """
+        mock_request = Mock()
+        mock_request.recv = Mock(side_effect=['{"id"', ': 1}\n', ''])
+        server = get_mock_server()
+        tracer = server.dispatcher.tracer = Tracer()
+        tracer.end = Mock(wraps=tracer.end)
+
+        Handler(mock_request, Mock(), server)
+
+        trace, = tracer.end.call_args[0]
+        assert [phase for phase, _ in trace.phases] == ['read', 'send']
+
+    def test_connected(self):
+        """ Test if a closed connection is detected without consuming
+        requests which are pending, and if a client which only has shut down
+        its side of the connection is still connected.
+
+        """
+        request, client = socket.socketpair()
+        with patch.object(Handler, 'handle'):
+            handler = Handler(request, Mock(), get_mock_server())
+
+        assert handler.connected()
+
+        client.sendall('{"id": 1}\n')
+        client.shutdown(socket.SHUT_WR)
+        assert handler.connected()
+        assert handler.request.recv(1024) == '{"id": 1}\n'
+        assert handler.connected()
+
+        client.close()
+        assert not handler.connected()
+
+
+def get_mock_server():
+    """ Return mock of server with a dispatcher. """
+    server = Mock()
+    server.dispatcher.call = Mock(return_value='{"result": 1}')
+    server.dispatcher.tracer = None
+    server.dispatch = server.dispatcher.call
+
+    return server
+
+
+class TestThreadPoolUnixStreamServer:
+    def test_serve_connections_concurrently(self, tmpdir):
+        """ Test if a second client is served while first client keeps its
+        connection open.
+
+        """
+        socket_path = tmpdir.join('test_tolk_socket').strpath
+
+        server = ThreadPoolUnixStreamServer(socket_path, Handler)
+        server.dispatcher = get_mock_server().dispatcher
+        server.workers = 2
+
+        t = Thread(target=server.serve_forever)
+        t.start()
+
+        try:
+            socks = []
+            for _ in range(2):
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.settimeout(1)
+                sock.connect(socket_path)
+                socks.append(sock)
+
+            for sock in reversed(socks):
+                sock.sendall('{"id": 1}\n')
+                assert sock.recv(1024) == '{"result": 1}\n'
+
+            for sock in socks:
+                sock.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+def test_more_connections_than_workers(tmpdir):
+    """ Test if idle connections don't lock out other clients when there are
+    more connections than workers, and if no more than `workers` requests
+    are dispatched at a time.
+
+    """
+    socket_path = tmpdir.join('test_tolk_socket').strpath
+
+    server = ThreadPoolUnixStreamServer(socket_path, Handler)
+    server.dispatcher = get_mock_server().dispatcher
+    server.workers = 2
+
+    active = []
+    concurrency = []
+
+    def call(msg, session=None, peer=None):
+        active.append(msg)
+        concurrency.append(len(active))
+        time.sleep(0.05)
+        active.pop()
+        return '{"result": 1}'
+
+    server.dispatcher.call = Mock(side_effect=call)
+
+    t = Thread(target=server.serve_forever)
+    t.start()
+
+    try:
+        socks = []
+        for _ in range(4):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(1)
+            sock.connect(socket_path)
+            socks.append(sock)
+
+        for sock in socks:
+            sock.sendall('{"id": 1}\n')
+
+        for sock in socks:
+            assert sock.recv(1024) == '{"result": 1}\n'
+            sock.close()
+
+        assert max(concurrency) == 2
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_thread_pool_tcp_server():
+    """ Test if clients can connect over TCP with the same framing as over a
+    Unix Domain Socket. """
+    server = ThreadPoolTCPServer(('127.0.0.1', 0), Handler)
+    server.dispatcher = get_mock_server().dispatcher
+
+    t = Thread(target=server.serve_forever)
+    t.start()
+
+    try:
+        sock = socket.create_connection(server.server_address, 1)
+        for _ in range(2):
+            sock.sendall('{"id": 1}\n')
+            assert sock.recv(1024) == '{"result": 1}\n'
+
+        sock.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_share_workers():
+    """ Test if every backend holds no more than its share of workers. """
+    backends = dict((name, Backend(Mock(thread_safe=False)))
+                    for name in ['a', 'b', 'c'])
+    backends['c'].bus.scheduler.max_queue = 1
+    dispatcher = Dispatcher(router=Router(backends, default='a'))
+
+    share_workers(dispatcher, 8)
+
+    assert [backends[name].bus.scheduler.max_queue
+            for name in ['a', 'b', 'c']] == [1, 1, 1]
+
+    # A backend which has used its share rejects requests right away.
+    scheduler = backends['a'].bus.scheduler
+    scheduler.acquire()
+    waiting = Thread(target=scheduler.acquire)
+    waiting.start()
+    while not scheduler.waiting:
+        time.sleep(0.01)
+
+    try:
+        with pytest.raises(ServerBusy):
+            scheduler.acquire()
+    finally:
+        scheduler.release()
+        waiting.join()
+        scheduler.release()
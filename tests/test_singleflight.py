@@ -0,0 +1,96 @@
+import time
+import threading
+
+import pytest
+from mock import Mock
+
+from tolk.exceptions import DeadlineExceeded, IllegalDataAddress
+from tolk.singleflight import SingleFlight
+
+
+def call_concurrently(in_flight, func, n=5):
+    """ Call func n times concurrently with the same key. Return list with
+    results and exceptions. """
+    results = []
+
+    def target():
+        try:
+            results.append(in_flight.do('key', func, 1))
+        except Exception as e:
+            results.append(e)
+
+    threads = [threading.Thread(target=target) for _ in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return results
+
+
+def slow(result):
+    """ Return Mock which returns result, or raises it, after a while. """
+    def func(*args):
+        time.sleep(0.1)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    return Mock(side_effect=func)
+
+
+def test_concurrent_calls_are_shared():
+    in_flight = SingleFlight()
+    func = slow((1337, 2345))
+
+    assert call_concurrently(in_flight, func) == [(1337, 2345)] * 5
+    func.assert_called_once_with(1)
+    assert len(in_flight) == 0
+
+
+def test_exception_is_raised_for_every_caller():
+    in_flight = SingleFlight()
+    error = IllegalDataAddress()
+
+    results = call_concurrently(in_flight, slow(error))
+
+    assert results == [error] * 5
+
+
+def test_sequential_calls_are_not_shared():
+    in_flight = SingleFlight()
+    func = Mock(return_value=1)
+
+    in_flight.do('key', func)
+    in_flight.do('key', func)
+
+    assert func.call_count == 2
+
+
+def test_failed_call_is_not_remembered():
+    in_flight = SingleFlight()
+
+    with pytest.raises(ValueError):
+        in_flight.do('key', Mock(side_effect=ValueError))
+
+    assert in_flight.do('key', Mock(return_value=1)) == 1
+
+
+def test_waiters_retry_failure_particular_to_leader():
+    """ Test if a call which fails with an exception in `retry` isn't shared,
+    but made again by the waiters. """
+    in_flight = SingleFlight(retry=DeadlineExceeded)
+    calls = []
+
+    def func(*args):
+        calls.append(args)
+        time.sleep(0.1)
+        if len(calls) == 1:
+            raise DeadlineExceeded()
+        return 2
+
+    results = call_concurrently(in_flight, Mock(side_effect=func), n=3)
+
+    assert len([r for r in results if isinstance(r, DeadlineExceeded)]) == 1
+    assert results.count(2) == 2
+    assert len(calls) == 2
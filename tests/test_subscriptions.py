@@ -0,0 +1,223 @@
+import os
+import json
+import time
+import socket
+from threading import Event
+
+import pytest
+from mock import Mock
+from modbus_tk.defines import READ_HOLDING_REGISTERS
+from modbus_tk.modbus import ModbusError
+
+from tolk.session import Session, SessionClosed, get_peer
+from tolk.subscriptions import SubscriptionManager
+
+
+def get_session():
+    """ Return session which collects sent messages in a list. """
+    sent = []
+    session = Session(sent.append)
+    session.sent = sent
+
+    return session
+
+
+def get_manager(read):
+    """ Return SubscriptionManager without polling thread, so tests can poll
+    by hand. """
+    manager = SubscriptionManager(read)
+    manager.stop()
+
+    return manager
+
+
+def get_notifications(session):
+    return [json.loads(msg)['params'] for msg in session.sent]
+
+
+def test_session_notify():
+    session = get_session()
+    session.notify('notify', {'values': [1]})
+
+    assert json.loads(session.sent[0]) == \
+        {'jsonrpc': '2.0', 'method': 'notify', 'params': {'values': [1]}}
+
+
+def test_session_closed():
+    session = get_session()
+    session.close()
+
+    with pytest.raises(SessionClosed):
+        session.send('{}')
+
+
+def test_session_closed_on_send_failure():
+    session = Session(Mock(side_effect=IOError))
+
+    with pytest.raises(IOError):
+        session.send('{}')
+
+    assert session.closed
+
+
+def test_poll_notifies_changes_beyond_deadband():
+    read = Mock(return_value=[100, 200])
+    manager = get_manager(read)
+    session = get_session()
+
+    subscription_id = manager.subscribe(session, 1, READ_HOLDING_REGISTERS,
+                                        100, 2, interval=60, deadband=5)
+    poll, = manager.polls.values()
+
+    manager.poll(poll)
+    read.return_value = [104, 200]
+    manager.poll(poll)
+    read.return_value = [106, 200]
+    manager.poll(poll)
+
+    notifications = get_notifications(session)
+    assert [n['values'] for n in notifications] == [[100, 200], [106, 200]]
+    assert notifications[0]['subscription'] == subscription_id
+
+
+def test_subscriptions_share_poll():
+    read = Mock(return_value=[1])
+    manager = get_manager(read)
+    sessions = [get_session(), get_session()]
+
+    ids = [manager.subscribe(session, 1, READ_HOLDING_REGISTERS, 100, 1, 60)
+           for session in sessions]
+    assert len(manager.polls) == 1
+
+    manager.poll(list(manager.polls.values())[0])
+    assert read.call_count == 1
+    assert all(len(session.sent) == 1 for session in sessions)
+
+    assert not manager.unsubscribe(ids[0], sessions[1])
+    assert manager.unsubscribe(ids[0], sessions[0])
+    assert len(manager.polls) == 1
+
+    assert manager.unsubscribe(ids[1])
+    assert len(manager.polls) == 0
+
+
+def test_poll_notifies_error_once():
+    read = Mock(side_effect=ModbusError(2))
+    manager = get_manager(read)
+    session = get_session()
+
+    manager.subscribe(session, 1, READ_HOLDING_REGISTERS, 100, 1, 60)
+    poll, = manager.polls.values()
+
+    manager.poll(poll)
+    manager.poll(poll)
+
+    notifications = get_notifications(session)
+    assert len(notifications) == 1
+    assert notifications[0]['error']['code'] == -32002
+
+    read.side_effect = None
+    read.return_value = [1]
+    manager.poll(poll)
+
+    assert get_notifications(session)[1]['values'] == [1]
+
+
+def test_closed_session_is_unsubscribed():
+    manager = get_manager(Mock(return_value=[1]))
+    session = get_session()
+
+    manager.subscribe(session, 1, READ_HOLDING_REGISTERS, 100, 1, 60)
+    poll, = manager.polls.values()
+
+    session.close()
+    manager.poll(poll)
+
+    assert session.sent == []
+    assert manager.polls == {}
+
+
+def test_subscriptions_polled_in_background():
+    manager = SubscriptionManager(Mock(side_effect=[[1], [2], [2]] * 10))
+    session = get_session()
+
+    manager.subscribe(session, 1, READ_HOLDING_REGISTERS, 100, 1, 0.01)
+
+    timeout = time.time() + 2
+    while len(session.sent) < 2 and time.time() < timeout:
+        time.sleep(0.01)
+
+    manager.stop()
+
+    assert [n['values'] for n in get_notifications(session)][:2] == [[1], [2]]
+
+
+def test_subscriptions_share_poll_at_smallest_interval():
+    read = Mock(return_value=[1])
+    manager = get_manager(read)
+    slow, fast = get_session(), get_session()
+
+    manager.subscribe(slow, 1, READ_HOLDING_REGISTERS, 100, 1, interval=60)
+    manager.subscribe(fast, 1, READ_HOLDING_REGISTERS, 100, 1, interval=1)
+    poll, = manager.polls.values()
+    assert poll.interval == 1
+
+    manager.poll(poll)
+    read.return_value = [2]
+    manager.poll(poll)
+
+    # Session which subscribed with a larger interval isn't notified more
+    # often than it asked for.
+    assert [n['values'] for n in get_notifications(fast)] == [[1], [2]]
+    assert [n['values'] for n in get_notifications(slow)] == [[1]]
+
+
+def test_backends_polled_by_own_thread():
+    manager = SubscriptionManager(Mock(return_value=[1]),
+                                  lambda slave_id, unit: unit)
+    session = get_session()
+
+    for unit in ['a', 'b', 'a']:
+        manager.subscribe(session, 1, READ_HOLDING_REGISTERS, 100, 1, 60,
+                          unit=unit)
+    manager.stop()
+
+    assert sorted(manager._pollers) == ['a', 'b']
+    assert len(manager.polls) == 2
+
+
+def test_session_closed_when_notifications_fall_behind():
+    blocked = Event()
+    session = Session(lambda msg: blocked.wait(), max_notifications=2)
+
+    try:
+        # Sender blocks on first notification.
+        session.notify('notify', {})
+        while session._outbox:
+            time.sleep(0.01)
+
+        session.notify('notify', {})
+        session.notify('notify', {})
+
+        with pytest.raises(SessionClosed):
+            session.notify('notify', {})
+
+        assert session.closed
+    finally:
+        blocked.set()
+
+
+def test_get_peer():
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind('\x00tolk-test-peer-{0}'.format(os.getpid()))
+    server.listen(1)
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(server.getsockname())
+    sock, address = server.accept()
+
+    try:
+        assert get_peer(None, ('10.0.0.1', 5000)) == '10.0.0.1'
+        assert get_peer(sock, address) == ('pid', os.getpid())
+    finally:
+        for s in (sock, client, server):
+            s.close()
@@ -0,0 +1,149 @@
+import json
+import time
+from threading import Event, Thread
+
+from logbook import TestHandler
+from mock import Mock
+
+from tolk import Dispatcher
+from tolk import tracing
+from tolk.json_rpc import execute_all
+from tolk.singleflight import SingleFlight
+from tolk.tracing import Trace, Tracer, format_trace
+
+
+def test_tracer_samples_requests():
+    tracer = Tracer(sample_rate=0)
+    assert tracer.begin() is None
+    assert tracing.current() is None
+
+    tracer = Tracer(sample_rate=1)
+    trace = tracer.begin()
+    assert tracing.current() is trace
+
+    tracer.end(trace)
+    assert tracing.current() is None
+    assert trace.finished is not None
+
+
+def test_trace_breakdown():
+    trace = Trace('abc')
+    trace.add('parse', 0.001)
+    trace.add('modbus', 0.01)
+    trace.add('modbus', 0.02)
+    trace.finished = trace.started + 0.05
+
+    breakdown = trace.breakdown()
+
+    assert [phase for phase, _ in breakdown] == ['parse', 'modbus', 'other']
+    assert abs(breakdown[1][1] - 0.03) < 1e-6
+    assert abs(breakdown[2][1] - 0.019) < 1e-6
+
+
+def test_format_trace():
+    trace = Trace('abc')
+    trace.methods = ['read_coils']
+    trace.request_ids = [1]
+    trace.add('modbus', 0.1)
+    trace.finished = trace.started + 0.1
+
+    assert format_trace(trace) == \
+        'Slow request abc read_coils (id 1) took 100.0 ms: modbus 100.0 ms, ' \
+        'other 0.0 ms'
+
+
+def test_tracer_logs_slow_requests():
+    tracer = Tracer(slow_threshold=0.05)
+
+    with TestHandler() as handler:
+        trace = tracer.begin()
+        tracer.end(trace)
+
+        assert not handler.records
+
+        trace = tracer.begin()
+        trace.started -= 0.1
+        tracer.end(trace)
+
+        record, = handler.records
+        assert record.level_name == 'WARNING'
+        assert record.message.startswith('Slow request {0} '
+                                         .format(trace.id))
+
+
+def test_dispatcher_traces_phases(modbus_master):
+    dispatcher = Dispatcher(modbus_master,
+                            tracer=Tracer(slow_threshold=0))
+
+    with TestHandler() as handler:
+        dispatcher.call(json.dumps({'jsonrpc': '2.0', 'id': 7,
+                                    'method': 'read_coils',
+                                    'params': {'starting_address': 100,
+                                               'quantity': 2}}))
+
+    message, = [r.message for r in handler.records
+                if r.channel == 'tolk.tracing']
+
+    assert 'read_coils (id 7)' in message
+    for phase in ['parse', 'queue', 'modbus', 'encode', 'other']:
+        assert ' {0} '.format(phase) in message
+
+
+def test_dispatcher_respects_sampling_decision(modbus_master):
+    """ Test if a request which a handler decided not to sample isn't sampled
+    again by the dispatcher. """
+    tracer = Tracer(sample_rate=0)
+    dispatcher = Dispatcher(modbus_master, tracer=tracer)
+
+    trace = tracer.begin()
+    tracer.begin = Mock()
+    try:
+        dispatcher.call(json.dumps({'jsonrpc': '2.0', 'id': 1,
+                                    'method': 'read_coils',
+                                    'params': {'starting_address': 100,
+                                               'quantity': 2}}))
+    finally:
+        tracer.end(trace)
+
+    assert not tracer.begin.called
+    assert not tracing.decided()
+
+
+def test_trace_attached_to_worker_threads():
+    trace = Trace('abc')
+    previous = tracing.attach(trace)
+    try:
+        assert execute_all([tracing.current] * 4, concurrency=4) == \
+            [trace] * 4
+    finally:
+        tracing.attach(previous)
+
+
+def test_shared_call_recorded_in_trace_of_every_caller():
+    in_flight = SingleFlight()
+    started, finish = Event(), Event()
+    traces = [Trace('leader'), Trace('follower')]
+
+    def func():
+        started.set()
+        finish.wait()
+        tracing.current().add('modbus', 0.1)
+
+    def target(trace):
+        tracing.attach(trace)
+        in_flight.do('key', func)
+
+    leader = Thread(target=target, args=(traces[0],))
+    leader.start()
+    started.wait()
+
+    follower = Thread(target=target, args=(traces[1],))
+    follower.start()
+    while not in_flight._calls['key'].waiters:
+        time.sleep(0.01)
+
+    finish.set()
+    leader.join()
+    follower.join()
+
+    assert [t.phases for t in traces] == [[('modbus', 0.1)]] * 2
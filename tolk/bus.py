@@ -0,0 +1,151 @@
+""" Serialized access to Modbus masters.
+
+A Modbus link, be it a serial line or a TCP connection, can only carry one
+transaction at a time. :class:`Bus` wraps a :class:`modbus_tk.modbus.Master`
+and guards it with a lock, so transactions of concurrent callers never
+interleave.
+
+Masters which handle concurrent transactions themselves, like
+:class:`tolk.pipeline.PipelinedTcpMaster`, have an attribute `thread_safe`
+which is True. Up to `window` of their transactions run at the same time.
+
+"""
+import time
+import types
+import threading
+from functools import partial
+from weakref import WeakKeyDictionary
+
+from tolk import tracing
+from tolk.metrics import BusMetrics
+from tolk.scheduler import NORMAL, Scheduler
+
+_buses = WeakKeyDictionary()
+_buses_lock = threading.Lock()
+
+
+def get_bus(modbus_master):
+    """ Return :class:`Bus` for Modbus master. Every master has exactly one
+    bus, so callers using the same master share the same lock.
+
+    :param modbus_master: Instance of :class:`modbus_tk.modbus.Master`.
+    :returns: Instance of :class:`Bus`.
+    """
+    with _buses_lock:
+        try:
+            return _buses[modbus_master]
+        except KeyError:
+            bus = _buses[modbus_master] = Bus(modbus_master)
+            return bus
+
+
+def unlocked_execute(modbus_master):
+    """ Return :meth:`execute` of Modbus master without modbus_tk's lock.
+
+    modbus_tk decorates :meth:`modbus_tk.modbus.Master.execute` with
+    :func:`modbus_tk.utils.threadsafe_function`. That decorator creates one
+    lock which is shared by *all* masters in the process, so transactions on
+    independent links would wait for each other. :class:`Bus` locks per
+    master, which makes the global lock redundant.
+
+    :param modbus_master: Instance of :class:`modbus_tk.modbus.Master`.
+    :returns: Callable with same signature as :meth:`execute`.
+    """
+    execute = modbus_master.execute
+
+    if not isinstance(execute, types.MethodType) or \
+            not isinstance(execute.im_func, types.FunctionType):
+        return execute
+
+    code = execute.im_func.func_code
+    closure = execute.im_func.func_closure
+
+    if closure is None or 'fcn' not in code.co_freevars:
+        return execute
+
+    func = closure[code.co_freevars.index('fcn')].cell_contents
+    return partial(func, modbus_master)
+
+
+class Bus(object):
+    """ Execute Modbus transactions on a master one at a time.
+
+        >>> bus = Bus(TcpMaster('localhost', 502))
+        >>> bus.execute(1, READ_HOLDING_REGISTERS, 100, 2)
+        (1337, 2345)
+
+    Transactions waiting for the bus are scheduled by priority and fairly
+    between clients, see :mod:`tolk.scheduler`. Every transaction is recorded
+    in :attr:`metrics`, see :class:`tolk.metrics.BusMetrics`.
+
+    Use :func:`get_bus` to obtain the bus of a master instead of creating
+    instances directly.
+
+    :param modbus_master: Instance of :class:`modbus_tk.modbus.Master`.
+    """
+    def __init__(self, modbus_master):
+        self.modbus_master = modbus_master
+        self.thread_safe = getattr(modbus_master, 'thread_safe', False)
+
+        # Thread safe masters carry up to `window` transactions at a time.
+        capacity = getattr(modbus_master, 'window', 1) \
+            if self.thread_safe else 1
+        self.scheduler = Scheduler(capacity)
+        self.metrics = BusMetrics(capacity)
+
+        self._execute = unlocked_execute(modbus_master)
+
+    def execute(self, *args, **kwargs):
+        """ Execute Modbus request. Accepts the same arguments as
+        :meth:`modbus_tk.modbus.Master.execute` and 4 keyword arguments:
+
+        :param priority: Priority class, default
+            :data:`tolk.scheduler.NORMAL`.
+        :param client: Hashable identifying client, default None.
+        :param deadline: Time after which request is dropped when it hasn't
+            reached the bus yet, default None.
+        :param cancelled: Callable which returns True when request should be
+            dropped, default None.
+        :raises tolk.exceptions.DeadlineExceeded: When request has been
+            dropped. See :meth:`tolk.scheduler.Scheduler.acquire`.
+        :raises tolk.exceptions.ServerBusy: When request has been rejected
+            because the queue is full.
+        """
+        priority = kwargs.pop('priority', NORMAL)
+        client = kwargs.pop('client', None)
+        deadline = kwargs.pop('deadline', None)
+        cancelled = kwargs.pop('cancelled', None)
+
+        error = None
+        enqueued = time.time()
+        self.scheduler.acquire(priority, client, deadline, cancelled)
+        started = time.time()
+        try:
+            return self._execute(*args, **kwargs)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            finished = time.time()
+            self.scheduler.release(finished - started)
+            self.metrics.observe(args[0] if args else kwargs.get('slave'),
+                                 started - enqueued, finished - started,
+                                 error)
+
+            trace = tracing.current()
+            if trace is not None:
+                trace.add('queue', started - enqueued)
+                trace.add('modbus', finished - started)
+
+    def resize(self, capacity):
+        """ Change number of transactions the bus carries at a time, for
+        instance when a pipelined master changes its window.
+        """
+        self.scheduler.resize(capacity)
+        self.metrics.capacity = capacity
+
+    def stats(self):
+        """ Return statistics of queue of bus. See
+        :meth:`tolk.scheduler.Scheduler.stats`.
+        """
+        return self.scheduler.stats()
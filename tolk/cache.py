@@ -0,0 +1,208 @@
+""" Cache of register and coil values.
+
+Many points change only every few seconds, but are polled much more often.
+:class:`RegisterCache` remembers every value read from the bus for a limited
+time, per table::
+
+    from modbus_tk.defines import READ_COILS, READ_HOLDING_REGISTERS
+
+    cache = RegisterCache({READ_COILS: 0.5, READ_HOLDING_REGISTERS: 2},
+                          max_size=100000)
+    dispatcher = Dispatcher(modbus_master, cache=cache)
+
+Values are cached per address, so a read which partially overlaps cached
+values only needs to fetch the missing addresses from the bus. When the cache
+is full the least recently used addresses are evicted.
+
+Writes through :class:`tolk.Dispatcher` update the cache, so a client always
+reads its own writes.
+
+"""
+import time
+import threading
+
+#: Returned by :meth:`RegisterCache.get` for addresses which aren't cached.
+MISS = None
+
+
+class LRU(object):
+    """ Mapping with a maximum size which evicts least recently used keys.
+    Not thread safe.
+
+    :param max_size: Maximum number of keys.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+
+        # Keys map to links of a circular doubly linked list, ordered from
+        # least to most recently used. A link is a [prev, next, key, value]
+        # list.
+        self._links = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None]
+
+    def get(self, key, default=None):
+        """ Return value of key and mark key as most recently used. """
+        link = self._links.get(key)
+        if link is None:
+            return default
+
+        self._unlink(link)
+        self._append(link)
+
+        return link[3]
+
+    def set(self, key, value):
+        """ Set value of key and evict least recently used key when full. """
+        link = self._links.get(key)
+        if link is not None:
+            link[3] = value
+            self._unlink(link)
+            self._append(link)
+            return
+
+        if len(self._links) >= self.max_size:
+            oldest = self._root[1]
+            self._unlink(oldest)
+            del self._links[oldest[2]]
+
+        link = [None, None, key, value]
+        self._links[key] = link
+        self._append(link)
+
+    def pop(self, key, default=None):
+        """ Remove key and return its value. """
+        link = self._links.pop(key, None)
+        if link is None:
+            return default
+
+        self._unlink(link)
+        return link[3]
+
+    def clear(self):
+        self._links.clear()
+        self._root[:] = [self._root, self._root, None, None]
+
+    def _append(self, link):
+        last = self._root[0]
+        link[0], link[1] = last, self._root
+        last[1] = self._root[0] = link
+
+    def _unlink(self, link):
+        prev, next_ = link[0], link[1]
+        prev[1], next_[0] = next_, prev
+
+    def __contains__(self, key):
+        return key in self._links
+
+    def __len__(self):
+        return len(self._links)
+
+
+class RegisterCache(object):
+    """ Thread safe cache of values per slave, function code and address.
+
+    :param ttl: Dictionary which maps function codes of read requests to the
+        number of seconds values are valid. Reads with other function codes
+        aren't cached.
+    :param max_size: Maximum number of addresses to cache, default 100000.
+    """
+    def __init__(self, ttl, max_size=100000):
+        self.ttl = dict(ttl)
+        self.entries = LRU(max_size)
+        self.lock = threading.Lock()
+
+        # Incremented on every write, so reads which have been started
+        # before a write don't store stale values. See :meth:`put`.
+        self.generation = 0
+
+    def caches(self, function_code):
+        """ Return whether values of function code are cached. """
+        return function_code in self.ttl
+
+    def get(self, slave_id, function_code, starting_address, quantity):
+        """ Return list with cached values. Addresses without valid value
+        have value :data:`MISS`.
+        """
+        now = time.time()
+        values = []
+
+        with self.lock:
+            for address in range(starting_address,
+                                 starting_address + quantity):
+                key = (slave_id, function_code, address)
+                entry = self.entries.get(key)
+
+                if entry is None:
+                    values.append(MISS)
+                elif entry[1] < now:
+                    self.entries.pop(key)
+                    values.append(MISS)
+                else:
+                    values.append(entry[0])
+
+        return values
+
+    def put(self, slave_id, function_code, starting_address, values,
+            generation=None):
+        """ Store values read from bus.
+
+        :param generation: Value of :attr:`generation` before read has been
+            started. Values aren't stored when a write happened in the mean
+            time, because they might be stale.
+        """
+        if not self.caches(function_code):
+            return
+
+        expires = time.time() + self.ttl[function_code]
+
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+
+            for address, value in enumerate(values, starting_address):
+                self.entries.set((slave_id, function_code, address),
+                                 (value, expires))
+
+    def update(self, slave_id, function_code, starting_address, values):
+        """ Store values which have been written to slave. """
+        with self.lock:
+            self.generation += 1
+
+        self.put(slave_id, function_code, starting_address, values)
+
+    def invalidate(self, slave_id, function_code, starting_address, quantity):
+        """ Remove values from cache. """
+        with self.lock:
+            self.generation += 1
+
+            for address in range(starting_address,
+                                 starting_address + quantity):
+                self.entries.pop((slave_id, function_code, address))
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+
+def missing_ranges(values):
+    """ Return list with (offset, quantity) tuples of consecutive misses.
+
+        >>> missing_ranges([MISS, MISS, 1, 2, MISS])
+        [(0, 2), (4, 1)]
+    """
+    ranges = []
+    start = None
+
+    for offset, value in enumerate(values):
+        if value is MISS and start is None:
+            start = offset
+        elif value is not MISS and start is not None:
+            ranges.append((start, offset - start))
+            start = None
+
+    if start is not None:
+        ranges.append((start, len(values) - start))
+
+    return ranges
@@ -0,0 +1,568 @@
+""" Client of Tolk.
+
+:class:`Client` has a method for every JSON-RPC method of
+:class:`tolk.Dispatcher`::
+
+    >>> client = Client('/tmp/tolk.sock')
+    >>> client.read_holding_registers(100, 2, slave_id=3)
+    [1337, 2890]
+    >>> client.read_holding_registers(5000, 2)
+    Traceback (most recent call last):
+    ...
+    IllegalDataAddress: JsonRpcError(-32002): The data address received in
+    the request is not an allowable address for the server.
+
+Errors are raised as the exceptions of :mod:`tolk.exceptions` and
+:mod:`pyjsonrpc`.
+
+The client keeps a pool of persistent connections. Every request carries a
+unique id and responses are matched to requests by their id, so threads
+share a connection without waiting for each other's responses. A connection
+is only added to the pool when all connections have requests in flight.
+
+:class:`AsyncClient` has the same methods, but they return a :class:`Future`
+instead of waiting for the response::
+
+    >>> client = AsyncClient('/tmp/tolk.sock')
+    >>> futures = [client.read_coils(address, 8) for address in [100, 200]]
+    >>> [future.result(timeout=1) for future in futures]
+    [[0, 1, 0, 0, 0, 0, 0, 0], [1, 1, 0, 0, 0, 0, 0, 0]]
+
+Requests can be combined in a batch, which is sent as a single JSON-RPC batch
+request. Reads in a batch are coalesced by Tolk, see :mod:`tolk.coalesce`::
+
+    >>> with client.batch() as batch:
+    ...     coils = batch.read_coils(100, 8)
+    ...     registers = batch.read_holding_registers(100, 2)
+    >>> registers.result()
+    [1337, 2890]
+
+"""
+import socket
+import itertools
+import threading
+from logbook import Logger
+from pyjsonrpc import JsonRpcError
+from pyjsonrpc.rpcerror import jsonrpcerrors
+
+from tolk.codec import get_codec
+from tolk.exceptions import modbus_mapping
+
+log = Logger(__name__)
+
+#: Maps codes of JSON-RPC errors to their exception.
+ERRORS = dict(jsonrpcerrors)
+ERRORS.update((cls.code, cls) for cls in modbus_mapping.values())
+
+
+class ConnectionClosed(IOError):
+    """ Raised for requests which were in flight when their connection
+    closed.
+    """
+    pass
+
+
+class Future(object):
+    """ Result of a request which may not have arrived yet. """
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        """ Return whether result or exception has been set. """
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """ Return result, or raise exception of request.
+
+        :param timeout: Number of seconds to wait, default None, which waits
+            forever.
+        :raises socket.timeout: When result didn't arrive in time.
+        """
+        self._done.wait(timeout)
+        if not self._done.is_set():
+            raise socket.timeout('No response in {0} seconds.'
+                                 .format(timeout))
+
+        if self._exception is not None:
+            raise self._exception
+
+        return self._result
+
+    def exception(self, timeout=None):
+        """ Return exception of request, or None when it succeeded. """
+        try:
+            self.result(timeout)
+        except socket.timeout:
+            raise
+        except Exception as e:
+            return e
+
+    def add_done_callback(self, callback):
+        """ Call callback with future when it's done, or immediately when
+        it's done already.
+        """
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+
+        callback(self)
+
+    def set_result(self, result):
+        self._set(result, None)
+
+    def set_exception(self, exception):
+        self._set(None, exception)
+
+    def _set(self, result, exception):
+        with self._lock:
+            if self.done():
+                return
+
+            self._result = result
+            self._exception = exception
+            self._done.set()
+
+            callbacks, self._callbacks = self._callbacks, []
+
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                log.exception('Callback of future failed.')
+
+
+class Connection(object):
+    """ Persistent connection with Tolk which can be used by many threads at
+    once.
+
+    :param address: Path of Unix Domain Socket or (host, port) tuple.
+    :param codec: :class:`tolk.codec.Codec` to encode requests and decode
+        responses.
+    :param on_notification: Callable which is called with method and params
+        of every notification, default None. See :mod:`tolk.subscriptions`.
+    """
+    def __init__(self, address, codec, on_notification=None):
+        self.codec = codec
+        self.on_notification = on_notification
+        self.closed = False
+
+        if isinstance(address, basestring):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        self.sock.connect(address)
+
+        # Maps ids of requests in flight to their future.
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+
+        self._reader = threading.Thread(target=self._read)
+        self._reader.daemon = True
+        self._reader.start()
+
+    @property
+    def pending(self):
+        """ Number of requests awaiting a response. """
+        return len(self._pending)
+
+    def send(self, message, futures):
+        """ Send request, or batch of requests.
+
+        :param message: Dictionary with request, or list with requests.
+        :param futures: Dictionary which maps ids of requests to their
+            :class:`Future`.
+        :raises ConnectionClosed: When connection has been closed.
+        """
+        data = self.codec.dumps(message) + '\n'
+
+        with self._lock:
+            if self.closed:
+                raise ConnectionClosed('Connection has been closed.')
+            self._pending.update(futures)
+
+        try:
+            with self._send_lock:
+                self.sock.sendall(data)
+        except socket.error as e:
+            self.close(ConnectionClosed('Connection failed: {0}'.format(e)))
+            raise ConnectionClosed('Connection failed: {0}'.format(e))
+
+    def forget(self, id):
+        """ Stop waiting for response of request. """
+        with self._lock:
+            self._pending.pop(id, None)
+
+    def close(self, error=None):
+        """ Close connection and fail requests in flight. """
+        with self._lock:
+            if self.closed:
+                return
+
+            self.closed = True
+            pending, self._pending = self._pending, {}
+
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+        for future in pending.values():
+            future.set_exception(error or
+                                 ConnectionClosed('Connection closed.'))
+
+    def _read(self):
+        f = self.sock.makefile('rb')
+        try:
+            for line in iter(f.readline, ''):
+                try:
+                    message = self.codec.loads(line)
+                except ValueError:
+                    log.error('Invalid response: {0!r}'.format(line))
+                    continue
+
+                for response in (message if isinstance(message, list)
+                                 else [message]):
+                    self._dispatch(response)
+        except socket.error:
+            pass
+        finally:
+            f.close()
+            self.close()
+
+    def _dispatch(self, response):
+        if not isinstance(response, dict):
+            return
+
+        if 'id' not in response:
+            if self.on_notification is not None:
+                try:
+                    self.on_notification(response.get('method'),
+                                         response.get('params'))
+                except Exception:
+                    log.exception('Handling notification failed.')
+            return
+
+        with self._lock:
+            future = self._pending.pop(response['id'], None)
+
+        if future is None:
+            return
+
+        if 'error' in response:
+            future.set_exception(get_error(response['error']))
+        else:
+            future.set_result(response.get('result'))
+
+
+class Pool(object):
+    """ Pool of persistent connections.
+
+    :param address: Path of Unix Domain Socket or (host, port) tuple.
+    :param size: Maximum number of connections, default 4.
+    :param codec: See :class:`Connection`.
+    :param on_notification: See :class:`Connection`.
+    """
+    def __init__(self, address, size=4, codec=None, on_notification=None):
+        self.address = address
+        self.size = size
+        self.codec = codec or get_codec()
+        self.on_notification = on_notification
+
+        self.connections = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        """ Return connection with the fewest requests in flight. Opens a new
+        connection when all connections are busy and the pool isn't full.
+        """
+        with self._lock:
+            self.connections = [c for c in self.connections if not c.closed]
+
+            if self.connections:
+                connection = min(self.connections,
+                                 key=lambda c: c.pending)
+                if not connection.pending or \
+                        len(self.connections) >= self.size:
+                    return connection
+
+            connection = Connection(self.address, self.codec,
+                                    self.on_notification)
+            self.connections.append(connection)
+
+            return connection
+
+    def close(self):
+        """ Close all connections. """
+        with self._lock:
+            connections, self.connections = self.connections, []
+
+        for connection in connections:
+            connection.close()
+
+
+class Methods(object):
+    """ Methods of :class:`tolk.Dispatcher`. Subclasses implement
+    :meth:`_request`. Parameters which are None are left out of requests, so
+    Tolk applies its defaults.
+    """
+    def call(self, method, **params):
+        """ Call JSON-RPC method with params. """
+        return self._request(method, dict((k, v) for k, v in params.items()
+                                          if v is not None))
+
+    def _request(self, method, params):
+        raise NotImplementedError
+
+    def read_coils(self, starting_address, quantity, slave_id=None,
+                   unit=None, priority=None):
+        """ See :meth:`tolk.Dispatcher.read_coils`. """
+        return self.call('read_coils', starting_address=starting_address,
+                         quantity=quantity, slave_id=slave_id, unit=unit,
+                         priority=priority)
+
+    def read_discrete_inputs(self, starting_address, quantity, slave_id=None,
+                             unit=None, priority=None):
+        """ See :meth:`tolk.Dispatcher.read_discrete_inputs`. """
+        return self.call('read_discrete_inputs',
+                         starting_address=starting_address,
+                         quantity=quantity, slave_id=slave_id, unit=unit,
+                         priority=priority)
+
+    def read_holding_registers(self, starting_address, quantity,
+                               slave_id=None, unit=None, priority=None):
+        """ See :meth:`tolk.Dispatcher.read_holding_registers`. """
+        return self.call('read_holding_registers',
+                         starting_address=starting_address,
+                         quantity=quantity, slave_id=slave_id, unit=unit,
+                         priority=priority)
+
+    def read_input_registers(self, starting_address, quantity, slave_id=None,
+                             unit=None, priority=None):
+        """ See :meth:`tolk.Dispatcher.read_input_registers`. """
+        return self.call('read_input_registers',
+                         starting_address=starting_address,
+                         quantity=quantity, slave_id=slave_id, unit=unit,
+                         priority=priority)
+
+    def read_holding_registers_as(self, starting_address, count, dtype,
+                                  byte_order=None, word_order=None,
+                                  slave_id=None, unit=None, priority=None):
+        """ See :meth:`tolk.Dispatcher.read_holding_registers_as`. """
+        return self.call('read_holding_registers_as',
+                         starting_address=starting_address, count=count,
+                         dtype=dtype, byte_order=byte_order,
+                         word_order=word_order, slave_id=slave_id, unit=unit,
+                         priority=priority)
+
+    def read_input_registers_as(self, starting_address, count, dtype,
+                                byte_order=None, word_order=None,
+                                slave_id=None, unit=None, priority=None):
+        """ See :meth:`tolk.Dispatcher.read_input_registers_as`. """
+        return self.call('read_input_registers_as',
+                         starting_address=starting_address, count=count,
+                         dtype=dtype, byte_order=byte_order,
+                         word_order=word_order, slave_id=slave_id, unit=unit,
+                         priority=priority)
+
+    def read_points(self, names, priority=None):
+        """ See :meth:`tolk.Dispatcher.read_points`. """
+        return self.call('read_points', names=names, priority=priority)
+
+    def read_image(self, table, starting_address, quantity, slave_id=None,
+                   unit=None):
+        """ See :meth:`tolk.Dispatcher.read_image`. """
+        return self.call('read_image', table=table,
+                         starting_address=starting_address,
+                         quantity=quantity, slave_id=slave_id, unit=unit)
+
+    def write_single_coil(self, address, value, slave_id=None, unit=None,
+                          priority=None):
+        """ See :meth:`tolk.Dispatcher.write_single_coil`. """
+        return self.call('write_single_coil', address=address, value=value,
+                         slave_id=slave_id, unit=unit, priority=priority)
+
+    def write_single_register(self, address, value, slave_id=None,
+                              unit=None, priority=None):
+        """ See :meth:`tolk.Dispatcher.write_single_register`. """
+        return self.call('write_single_register', address=address,
+                         value=value, slave_id=slave_id, unit=unit,
+                         priority=priority)
+
+    def write_multiple_coils(self, starting_address, values, slave_id=None,
+                             unit=None, priority=None):
+        """ See :meth:`tolk.Dispatcher.write_multiple_coils`. """
+        return self.call('write_multiple_coils',
+                         starting_address=starting_address, values=values,
+                         slave_id=slave_id, unit=unit, priority=priority)
+
+    def write_multiple_registers(self, starting_address, values,
+                                 slave_id=None, unit=None, priority=None):
+        """ See :meth:`tolk.Dispatcher.write_multiple_registers`. """
+        return self.call('write_multiple_registers',
+                         starting_address=starting_address, values=values,
+                         slave_id=slave_id, unit=unit, priority=priority)
+
+    def write_multiple_registers_as(self, starting_address, values, dtype,
+                                    byte_order=None, word_order=None,
+                                    slave_id=None, unit=None, priority=None):
+        """ See :meth:`tolk.Dispatcher.write_multiple_registers_as`. """
+        return self.call('write_multiple_registers_as',
+                         starting_address=starting_address, values=values,
+                         dtype=dtype, byte_order=byte_order,
+                         word_order=word_order, slave_id=slave_id, unit=unit,
+                         priority=priority)
+
+    def subscribe(self, table, starting_address, quantity, interval,
+                  deadband=None, slave_id=None, unit=None):
+        """ See :meth:`tolk.Dispatcher.subscribe`. Notifications are passed
+        to the `on_notification` callable of the client.
+        """
+        return self.call('subscribe', table=table,
+                         starting_address=starting_address,
+                         quantity=quantity, interval=interval,
+                         deadband=deadband, slave_id=slave_id, unit=unit)
+
+    def unsubscribe(self, subscription):
+        """ See :meth:`tolk.Dispatcher.unsubscribe`. """
+        return self.call('unsubscribe', subscription=subscription)
+
+    def get_metrics(self):
+        """ See :meth:`tolk.Dispatcher.get_metrics`. """
+        return self.call('get_metrics')
+
+
+class AsyncClient(Methods):
+    """ Client whose methods return a :class:`Future` with the result.
+
+    :param address: Path of Unix Domain Socket or (host, port) tuple.
+    :param pool_size: Maximum number of connections, default 4.
+    :param codec: :class:`tolk.codec.Codec` to encode requests, default the
+        one returned by :func:`tolk.codec.get_codec`.
+    :param on_notification: Callable which is called with method and params
+        of every notification, default None.
+    """
+    def __init__(self, address, pool_size=4, codec=None,
+                 on_notification=None):
+        self.pool = Pool(address, pool_size, codec, on_notification)
+        self._ids = itertools.count(1)
+
+    def _request(self, method, params):
+        return self._send(method, params)[2]
+
+    def _send(self, method, params):
+        """ Send request and return tuple with connection, id and future of
+        request.
+        """
+        id = next(self._ids)
+        future = Future()
+        connection = self.pool.get()
+
+        connection.send(
+            {'jsonrpc': '2.0', 'method': method, 'params': params, 'id': id},
+            {id: future})
+
+        return connection, id, future
+
+    def batch(self):
+        """ Return :class:`Batch` of requests. """
+        return Batch(self)
+
+    def close(self):
+        """ Close all connections. """
+        self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Client(AsyncClient):
+    """ Client whose methods wait for the response and return its result.
+
+    :param timeout: Number of seconds to wait for a response, default None,
+        which waits forever. Requests carry the timeout as `timeout_ms`, so
+        Tolk drops them when they haven't reached the bus in time.
+
+    See :class:`AsyncClient` for the other parameters.
+    """
+    def __init__(self, address, pool_size=4, codec=None,
+                 on_notification=None, timeout=None):
+        AsyncClient.__init__(self, address, pool_size, codec,
+                             on_notification)
+        self.timeout = timeout
+
+    def _request(self, method, params):
+        if self.timeout is not None:
+            params.setdefault('timeout_ms',
+                              max(int(self.timeout * 1000), 1))
+
+        connection, id, future = self._send(method, params)
+
+        try:
+            return future.result(self.timeout)
+        except socket.timeout:
+            connection.forget(id)
+            raise
+
+
+class Batch(Methods):
+    """ Requests which are sent as a single JSON-RPC batch request. Methods
+    return a :class:`Future`, which gets its result after the batch has been
+    sent. The batch is sent when leaving the `with` block, or by
+    :meth:`send`.
+
+    :param client: :class:`AsyncClient` which sends the batch.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.requests = []
+        self.futures = {}
+
+    def _request(self, method, params):
+        id = next(self.client._ids)
+        future = self.futures[id] = Future()
+
+        self.requests.append({'jsonrpc': '2.0', 'method': method,
+                              'params': params, 'id': id})
+
+        return future
+
+    def send(self):
+        """ Send requests and return list with their futures, in order of the
+        requests.
+        """
+        requests, self.requests = self.requests, []
+        futures, self.futures = self.futures, {}
+
+        if requests:
+            self.client.pool.get().send(requests, futures)
+
+        return [futures[request['id']] for request in requests]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.send()
+
+
+def get_error(error):
+    """ Return exception of error of JSON-RPC response. """
+    cls = ERRORS.get(error.get('code'))
+    if cls is None:
+        return JsonRpcError(error.get('message'), error.get('data'),
+                            error.get('code'))
+
+    return cls(error.get('message'), error.get('data'))
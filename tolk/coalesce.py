@@ -0,0 +1,132 @@
+""" Coalescing of reads into as few Modbus requests as possible.
+
+Every Modbus request costs a round trip, which is expensive on a slow serial
+line. Reads on the same slave with the same function code whose address ranges
+are adjacent, or nearly so, can be merged into a single request::
+
+    >>> plan([Read(1, 3, 100, 2), Read(1, 3, 102, 2), Read(1, 3, 110, 1)])
+    [Read(slave_id=1, function_code=3, starting_address=100, quantity=11)]
+
+The merged requests never exceed the maximum quantity the Modbus protocol
+allows for a single request. Reads which do exceed it can be split::
+
+    >>> split(Read(1, 3, 0, 300))
+    [Read(slave_id=1, function_code=3, starting_address=0, quantity=125),
+     Read(slave_id=1, function_code=3, starting_address=125, quantity=125),
+     Read(slave_id=1, function_code=3, starting_address=250, quantity=50)]
+
+"""
+from collections import namedtuple
+
+from modbus_tk.defines import (READ_COILS, READ_DISCRETE_INPUTS,
+                               READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS,
+                               WRITE_MULTIPLE_COILS, WRITE_MULTIPLE_REGISTERS)
+
+#: Maximum quantity a single read request can carry per function code.
+MAX_QUANTITY = {
+    READ_COILS: 2000,
+    READ_DISCRETE_INPUTS: 2000,
+    READ_HOLDING_REGISTERS: 125,
+    READ_INPUT_REGISTERS: 125,
+}
+
+#: Maximum quantity a single write request can carry per function code.
+MAX_WRITE_QUANTITY = {
+    WRITE_MULTIPLE_COILS: 1968,
+    WRITE_MULTIPLE_REGISTERS: 123,
+}
+
+#: Function codes of read requests per table name.
+TABLES = {
+    'coils': READ_COILS,
+    'discrete_inputs': READ_DISCRETE_INPUTS,
+    'holding_registers': READ_HOLDING_REGISTERS,
+    'input_registers': READ_INPUT_REGISTERS,
+}
+
+Read = namedtuple('Read', ['slave_id', 'function_code', 'starting_address',
+                           'quantity'])
+
+
+def plan(reads, max_gap=10):
+    """ Return list with minimal number of reads which cover all given reads.
+
+    :param reads: Iterable with :class:`Read` instances.
+    :param max_gap: Maximum number of unrequested addresses between 2 reads
+        for them to be merged, default 10.
+    :returns: List with :class:`Read` instances.
+    """
+    groups = {}
+    for read in reads:
+        groups.setdefault((read.slave_id, read.function_code), []).append(read)
+
+    frames = []
+    for (slave_id, function_code), group in sorted(groups.items()):
+        limit = MAX_QUANTITY.get(function_code, 1)
+        group.sort(key=lambda r: r.starting_address)
+
+        start = end = None
+        for read in group:
+            read_end = read.starting_address + read.quantity
+
+            if start is not None and \
+                    read.starting_address <= end + max_gap and \
+                    max(end, read_end) - start <= limit:
+                end = max(end, read_end)
+                continue
+
+            if start is not None:
+                frames.append(Read(slave_id, function_code, start,
+                                   end - start))
+
+            start, end = read.starting_address, read_end
+
+        frames.append(Read(slave_id, function_code, start, end - start))
+
+    return frames
+
+
+def split(read):
+    """ Return list with reads of at most the maximum quantity of the
+    protocol which together cover read.
+
+    :param read: :class:`Read` to split.
+    :returns: List with :class:`Read` instances.
+    """
+    limit = MAX_QUANTITY.get(read.function_code)
+    if limit is None or read.quantity <= limit:
+        return [read]
+
+    end = read.starting_address + read.quantity
+    return [read._replace(starting_address=start,
+                          quantity=min(limit, end - start))
+            for start in range(read.starting_address, end, limit)]
+
+
+def extract(frame, values, read):
+    """ Return values of read from values of frame which covers read.
+
+    :param frame: :class:`Read` which has been executed.
+    :param values: Sequence with result of frame.
+    :param read: :class:`Read` which is covered by frame.
+    :returns: Sequence with values.
+    """
+    offset = read.starting_address - frame.starting_address
+    return values[offset:offset + read.quantity]
+
+
+def covers(frame, read):
+    """ Return whether frame covers all addresses of read. """
+    return frame.slave_id == read.slave_id and \
+        frame.function_code == read.function_code and \
+        frame.starting_address <= read.starting_address and \
+        read.starting_address + read.quantity <= \
+        frame.starting_address + frame.quantity
+
+
+def overlaps(frame, read):
+    """ Return whether frame covers any address of read. """
+    return frame.slave_id == read.slave_id and \
+        frame.function_code == read.function_code and \
+        frame.starting_address < read.starting_address + read.quantity and \
+        read.starting_address < frame.starting_address + frame.quantity
@@ -0,0 +1,201 @@
+""" Codecs to decode requests and encode responses.
+
+Decoding requests and encoding responses takes a considerable part of the
+time needed to serve a small read. A C accelerated JSON library is used when
+it's installed, otherwise the :mod:`json` module of the standard library::
+
+    >>> codec = get_codec()
+    >>> codec.name
+    'simplejson'
+    >>> codec.dumps({'jsonrpc': '2.0', 'id': 1, 'result': [1337]})
+    '{"jsonrpc": "2.0", "id": 1, "result": [1337]}'
+
+:mod:`simplejson` produces exactly the same output as :mod:`json`. `ujson` is
+faster still, but it formats floats with less precision, so it's only used
+when asked for by name.
+
+Machine to machine clients can use MessagePack instead of JSON, see
+:class:`MsgpackCodec`. Requests and responses carry the same fields as their
+JSON-RPC counterparts, but registers are packed as an array of 16 bit
+integers and coils as a bitfield.
+
+"""
+import struct
+
+
+class Codec(object):
+    """ JSON codec of a module with a `loads` and a `dumps` function.
+
+    :param module: Module, like :mod:`json`.
+    """
+    #: Whether codec encodes JSON text.
+    json = True
+
+    def __init__(self, module):
+        self.name = module.__name__
+        self.loads = module.loads
+        self.dumps = module.dumps
+
+    def encode_result(self, method, result):
+        """ Return result of method in the form to encode. """
+        return result
+
+    def __repr__(self):
+        return '<Codec {0}>'.format(self.name)
+
+
+#: Names of modules tried by :func:`get_codec`, in order of preference.
+DEFAULT_CODECS = ('simplejson', 'json')
+
+
+def get_codec(names=DEFAULT_CODECS):
+    """ Return :class:`Codec` of the first module which can be imported.
+
+    :param names: Name of module, or sequence with names of modules, default
+        :data:`DEFAULT_CODECS`.
+    :raises ImportError: When none of the modules can be imported.
+    """
+    if isinstance(names, basestring):
+        names = [names]
+
+    for name in names:
+        try:
+            return Codec(__import__(name))
+        except ImportError:
+            continue
+
+    raise ImportError('None of the JSON modules {0} is installed.'
+                      .format(', '.join(names)))
+
+
+#: MessagePack extension type of an array of registers.
+REGISTERS = 1
+
+#: MessagePack extension type of an array of bits.
+BITS = 2
+
+#: Extension types of the results of methods.
+RESULT_TYPES = {
+    'read_coils': BITS,
+    'read_discrete_inputs': BITS,
+    'read_holding_registers': REGISTERS,
+    'read_input_registers': REGISTERS,
+}
+
+
+class MsgpackCodec(Codec):
+    """ Binary codec which encodes messages with MessagePack. Requires
+    msgpack 0.4 or later.
+
+    Results of reads are encoded as extension types. Registers are an
+    extension of type :data:`REGISTERS` which holds 16 bit unsigned integers
+    in big endian. Coils and discrete inputs are an extension of type
+    :data:`BITS` which holds the number of bits as 16 bit unsigned integer
+    followed by the bits, least significant bit first, like Modbus packs
+    coils. Clients can pass values of writes as extension types too.
+
+    :raises ImportError: When msgpack isn't installed.
+    """
+    json = False
+
+    def __init__(self):
+        import msgpack
+
+        self.name = 'msgpack'
+        self._msgpack = msgpack
+
+        # msgpack 0.5.2 replaced the `encoding` argument with `raw`.
+        try:
+            msgpack.unpackb(msgpack.packb(''), raw=False)
+            self._unpack_options = {'raw': False}
+        except TypeError:
+            self._unpack_options = {'encoding': 'utf-8'}
+
+    def loads(self, data):
+        """ Return message decoded from data.
+
+        :raises ValueError: When data isn't valid MessagePack.
+        """
+        try:
+            return self._msgpack.unpackb(data, ext_hook=self._ext_hook,
+                                         **self._unpack_options)
+        except Exception as e:
+            # Exceptions of msgpack differ between versions.
+            raise ValueError('Invalid MessagePack: {0}'.format(e))
+
+    def dumps(self, message):
+        """ Return data with encoded message. """
+        return self._msgpack.packb(message, use_bin_type=False)
+
+    def encode_result(self, method, result):
+        ext_type = RESULT_TYPES.get(method)
+        if ext_type == REGISTERS:
+            return self._msgpack.ExtType(REGISTERS, pack_registers(result))
+
+        if ext_type == BITS:
+            return self._msgpack.ExtType(BITS, pack_bits(result))
+
+        return result
+
+    def _ext_hook(self, code, data):
+        if code == REGISTERS:
+            return unpack_registers(data)
+
+        if code == BITS:
+            return unpack_bits(data)
+
+        return self._msgpack.ExtType(code, data)
+
+
+#: Binary codecs per name.
+BINARY_CODECS = {
+    'msgpack': MsgpackCodec,
+}
+
+
+def get_binary_codec(name):
+    """ Return instance of binary codec.
+
+    :param name: Name of codec, see :data:`BINARY_CODECS`.
+    :raises KeyError: When codec doesn't exist.
+    :raises ImportError: When library of codec isn't installed.
+    """
+    return BINARY_CODECS[name]()
+
+
+def pack_registers(values):
+    """ Return string with values packed as 16 bit unsigned integers in big
+    endian.
+    """
+    return struct.pack('>{0}H'.format(len(values)), *values)
+
+
+def unpack_registers(data):
+    """ Return list with 16 bit unsigned integers packed in data. """
+    return list(struct.unpack('>{0}H'.format(len(data) // 2), data))
+
+
+def pack_bits(values):
+    """ Return string with number of values followed by values packed as
+    bits, least significant bit first.
+
+    :raises ValueError: When there are more than 0xFFFF values.
+    """
+    if len(values) > 0xFFFF:
+        raise ValueError('Can\'t pack {0} bits, the maximum is {1}.'
+                         .format(len(values), 0xFFFF))
+
+    data = bytearray((len(values) + 7) // 8)
+    for i, value in enumerate(values):
+        if value:
+            data[i // 8] |= 1 << (i % 8)
+
+    return struct.pack('>H', len(values)) + str(data)
+
+
+def unpack_bits(data):
+    """ Return list with bits packed in data. See :func:`pack_bits`. """
+    count, = struct.unpack('>H', data[:2])
+    data = bytearray(data[2:])
+
+    return [(data[i // 8] >> (i % 8)) & 1 for i in range(count)]
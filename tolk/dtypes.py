@@ -0,0 +1,158 @@
+""" Conversion between 16 bit registers and typed values.
+
+Values wider than 16 bits span multiple consecutive registers. Devices differ
+in the order in which they store the bytes within a register and the order
+of the registers, or words, within a value::
+
+    >>> decode([0x4049, 0x0FDB], 'float32')
+    [3.1415927410125732]
+    >>> decode([0x0FDB, 0x4049], 'float32', word_order='little')
+    [3.1415927410125732]
+    >>> encode([3.1415927410125732], 'float32')
+    [16457, 4059]
+
+A string is stored as 2 ASCII characters per register:
+
+    >>> decode([0x546F, 0x6C6B], 'string')
+    'Tolk'
+
+Floats which are NaN or infinite can't be represented in JSON, so they're
+decoded to None:
+
+    >>> decode([0x7FC0, 0x0000], 'float32')
+    [None]
+
+Registers are converted in bulk with :mod:`array` and :mod:`struct`, so large
+arrays are decoded in a single pass without a Python loop per value.
+
+"""
+import sys
+import math
+import struct
+from array import array
+
+#: Format character of :mod:`struct` and number of registers per type.
+DTYPES = {
+    'int16': ('h', 1),
+    'uint16': ('H', 1),
+    'int32': ('i', 2),
+    'uint32': ('I', 2),
+    'float32': ('f', 2),
+    'int64': ('q', 4),
+    'uint64': ('Q', 4),
+    'float64': ('d', 4),
+    'string': ('s', 1),
+}
+
+ORDERS = ('big', 'little')
+
+
+def check(dtype, byte_order='big', word_order='big'):
+    """ Raise ValueError when dtype or order isn't valid. """
+    if dtype not in DTYPES:
+        raise ValueError('Unknown dtype {0!r}, use one of {1}.'
+                         .format(dtype, ', '.join(sorted(DTYPES))))
+
+    if byte_order not in ORDERS or word_order not in ORDERS:
+        raise ValueError('Byte and word order must be either big or little.')
+
+
+def register_count(dtype, count):
+    """ Return number of registers which store count values of dtype. A
+    string of count characters takes count / 2 registers, rounded up.
+    """
+    check(dtype)
+
+    if dtype == 'string':
+        return (count + 1) // 2
+
+    return count * DTYPES[dtype][1]
+
+
+def decode(registers, dtype, byte_order='big', word_order='big'):
+    """ Return list with values stored in registers, or a string for dtype
+    `string`. Trailing NUL characters of strings are stripped. Floats which
+    are NaN or infinite are None.
+
+    :param registers: Sequence with values of registers.
+    :param dtype: Name of type, see :data:`DTYPES`.
+    :param byte_order: Order of bytes within a register, default 'big'.
+    :param word_order: Order of registers within a value, default 'big'.
+    """
+    check(dtype, byte_order, word_order)
+    fmt, size = DTYPES[dtype]
+
+    if len(registers) % size:
+        raise ValueError('{0} registers don\'t hold a whole number of {1}.'
+                         .format(len(registers), dtype))
+
+    words = array('H', registers)
+
+    if byte_order == 'little':
+        words.byteswap()
+
+    if word_order == 'little' and size > 1:
+        words = reverse_words(words, size)
+
+    # Registers are stored in native byte order, the values in big endian.
+    if sys.byteorder == 'little':
+        words.byteswap()
+
+    data = words.tostring()
+
+    if dtype == 'string':
+        return data.rstrip('\x00')
+
+    values = list(struct.unpack('>{0}{1}'.format(len(registers) // size,
+                                                 fmt), data))
+
+    if fmt in 'fd':
+        values = [None if math.isnan(v) or math.isinf(v) else v
+                  for v in values]
+
+    return values
+
+
+def encode(values, dtype, byte_order='big', word_order='big'):
+    """ Return list with registers which store values. The reverse of
+    :func:`decode`.
+
+    :param values: Sequence with values, or a string for dtype `string`.
+    :raises ValueError: When values don't fit dtype.
+    """
+    check(dtype, byte_order, word_order)
+    fmt, size = DTYPES[dtype]
+
+    if dtype == 'string':
+        data = str(values)
+        if len(data) % 2:
+            data += '\x00'
+    else:
+        try:
+            data = struct.pack('>{0}{1}'.format(len(values), fmt), *values)
+        except struct.error as e:
+            raise ValueError(str(e))
+
+    words = array('H')
+    words.fromstring(data)
+
+    if sys.byteorder == 'little':
+        words.byteswap()
+
+    if word_order == 'little' and size > 1:
+        words = reverse_words(words, size)
+
+    if byte_order == 'little':
+        words.byteswap()
+
+    return words.tolist()
+
+
+def reverse_words(words, size):
+    """ Return array with order of every group of size words reversed. """
+    reversed_words = array('H', words)
+
+    for i in range(size):
+        reversed_words[i::size] = words[size - 1 - i::size]
+
+    return reversed_words
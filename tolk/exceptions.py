@@ -121,3 +121,42 @@ class GatewayTargetDeviceFailedToRespond(JsonRpcError):
 
 jsonrpcerrors[GatewayTargetDeviceFailedToRespond.code] = GatewayTargetDeviceFailedToRespond
 modbus_mapping[11] = GatewayTargetDeviceFailedToRespond
+
+
+class DeadlineExceeded(JsonRpcError):
+    code = -32020
+    message = 'Deadline of request passed before it reached the bus. ' \
+              'The request has not been executed.'
+
+
+jsonrpcerrors[DeadlineExceeded.code] = DeadlineExceeded
+
+
+class RequestCancelled(DeadlineExceeded):
+    message = 'Client disconnected before request reached the bus. The ' \
+              'request has not been executed.'
+
+
+class ServerBusy(JsonRpcError):
+    code = -32021
+    message = 'Server is busy, retry later.'
+
+    @property
+    def retry_after_ms(self):
+        """ Number of milliseconds after which client may retry, or None. """
+        if isinstance(self.data, dict):
+            return self.data.get('retry_after_ms')
+
+
+jsonrpcerrors[ServerBusy.code] = ServerBusy
+
+
+def server_busy(retry_after):
+    """ Return :class:`ServerBusy` error which tells client to retry after
+    a number of seconds.
+    """
+    retry_after_ms = max(int(round(retry_after * 1000)), 1)
+
+    return ServerBusy('Server is busy, retry after {0} ms.'
+                      .format(retry_after_ms),
+                      {'retry_after_ms': retry_after_ms})
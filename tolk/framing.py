@@ -0,0 +1,343 @@
+""" Framing of JSON-RPC messages on a stream socket.
+
+A client can keep a connection to Tolk open and stream many requests over it.
+Every message, request or response, is terminated by a newline::
+
+    {"jsonrpc": "2.0", "method": "read_coils", "params": [100, 2], "id": 1}\\n
+    {"jsonrpc": "2.0", "method": "read_coils", "params": [102, 2], "id": 2}\\n
+
+JSON never contains a raw newline inside a string, so a newline can't occur
+in the middle of a serialized message.
+
+Clients which send a single message without a trailing newline and wait for
+the response are still supported. Such an unterminated message is dispatched
+as soon as the buffered bytes form a complete JSON document. The nesting of
+the buffered bytes is tracked as they arrive, so a large message is parsed
+only once it looks complete.
+
+Clients can ask for a binary codec instead of JSON by starting the
+connection with a preamble. See :class:`Negotiator`.
+
+"""
+import re
+import json
+import struct
+
+from tolk.codec import get_binary_codec
+
+DELIMITER = '\n'
+
+#: First byte of a preamble. JSON-RPC messages never start with it.
+PREAMBLE_MARKER = '\x00'
+
+# Length prefix of binary messages.
+LENGTH = struct.Struct('>I')
+
+#: Maximum number of bytes of a message, default of both framers.
+MAX_SIZE = 16 * 1024 * 1024
+
+#: Maximum number of bytes of a preamble.
+MAX_PREAMBLE_SIZE = 64
+
+# Characters which change the nesting of a JSON document.
+_TOKENS = re.compile(r'[][{}"\\]')
+
+
+class Framer(object):
+    """ Reassemble messages from arbitrarily sized chunks of a byte stream.
+
+        >>> framer = Framer()
+        >>> framer.feed('{"id": 1}\\n{"i')
+        ['{"id": 1}']
+        >>> framer.feed('d": 2}\\n')
+        ['{"id": 2}']
+
+    Chunks of a message are collected in a list and joined once the message
+    is complete, so a large message is copied only once.
+
+    :param delimiter: String which terminates every message, default newline.
+    :param max_size: Maximum number of bytes of a message, default 16 MiB.
+    """
+    def __init__(self, delimiter=DELIMITER, max_size=MAX_SIZE):
+        self.delimiter = delimiter
+        self.max_size = max_size
+
+        self._chunks = []
+        self._size = 0
+        self._reset()
+
+    def _reset(self):
+        """ Reset state of scan of buffer. """
+        # Number of bytes of buffer which have been scanned, the nesting
+        # depth at that point, whether it's inside a string, the position of
+        # the byte after an escape, the end of the last top level object or
+        # array, whether buffer can't be a single JSON document anymore and
+        # the end of the document which failed to parse last.
+        self._scanned = 0
+        self._depth = 0
+        self._in_string = False
+        self._escaped = 0
+        self._closed = None
+        self._invalid = False
+        self._failed = None
+
+    @property
+    def buffer(self):
+        """ String with bytes of message which hasn't been completed yet. """
+        if len(self._chunks) > 1:
+            self._chunks = [''.join(self._chunks)]
+
+        return self._chunks[0] if self._chunks else ''
+
+    def _set_buffer(self, data):
+        self._chunks = [data] if data else []
+        self._size = len(data)
+        self._reset()
+
+    def feed(self, data):
+        """ Append data to buffer and return list with complete messages.
+
+        :param data: String with bytes received from socket.
+        :returns: List with messages, without delimiter. Empty messages are
+            skipped.
+        :raises ValueError: When a message exceeds the maximum size.
+        """
+        messages = []
+        if self.delimiter in data:
+            self._chunks.append(data)
+            chunks = ''.join(self._chunks).split(self.delimiter)
+            self._set_buffer(chunks.pop())
+            messages = [chunk for chunk in chunks if chunk.strip()]
+        elif data:
+            self._chunks.append(data)
+            self._size += len(data)
+
+        for message in messages:
+            if len(message) > self.max_size:
+                raise ValueError('Message exceeds maximum of {0} bytes.'
+                                 .format(self.max_size))
+
+        if self._size > self.max_size:
+            raise ValueError('Message exceeds maximum of {0} bytes.'
+                             .format(self.max_size))
+
+        if self.is_unterminated_message():
+            messages.append(self.buffer)
+            self._set_buffer('')
+
+        return messages
+
+    def is_unterminated_message(self):
+        """ Return whether buffer holds a complete JSON document which hasn't
+        been terminated by a delimiter.
+
+        Only the bytes which have been added since the last call are scanned.
+        The buffer is parsed only when it ends with a top level object or
+        array which has been closed, and not again until that changes.
+        """
+        self._scan()
+
+        if self._invalid or self._closed is None or self._depth != 0 or \
+                self._closed == self._failed:
+            return False
+
+        try:
+            json.loads(self.buffer)
+        except ValueError:
+            self._failed = self._closed
+            return False
+
+        return True
+
+    def _scan(self):
+        """ Track nesting of bytes of buffer which haven't been scanned. """
+        # Find first chunk which hasn't been scanned completely, from the
+        # end, so every chunk is visited only once.
+        i, base = len(self._chunks), self._size
+        while i > 0 and base > self._scanned:
+            i -= 1
+            base -= len(self._chunks[i])
+
+        for chunk in self._chunks[i:]:
+            self._scan_chunk(chunk, base, max(self._scanned - base, 0))
+            base += len(chunk)
+
+        self._scanned = self._size
+
+    def _scan_chunk(self, chunk, base, start):
+        """ Track nesting of bytes of chunk from start on. The chunk starts
+        at position base of buffer.
+        """
+        for match in _TOKENS.finditer(chunk, start):
+            i = base + match.start()
+            if i < self._escaped:
+                continue
+
+            token = match.group()
+            if self._in_string:
+                if token == '\\':
+                    self._escaped = i + 2
+                elif token == '"':
+                    self._in_string = False
+            elif token == '"':
+                self._in_string = True
+            elif token in '{[':
+                if self._depth == 0 and self._closed is not None:
+                    # Second top level document.
+                    self._invalid = True
+                self._depth += 1
+            else:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._closed = i + 1
+
+        if self._depth == 0 and self._closed is not None and \
+                chunk[max(self._closed - base, start):].strip():
+            # Bytes after the top level document.
+            self._invalid = True
+
+    def encode(self, message):
+        """ Return message terminated with delimiter.
+
+        :param message: String with a serialized message.
+        :returns: String ready to be written to socket.
+        """
+        return message + self.delimiter
+
+
+class LengthPrefixFramer(object):
+    """ Reassemble binary messages which are prefixed with their length, a
+    32 bit unsigned integer in big endian::
+
+        >>> framer = LengthPrefixFramer()
+        >>> framer.feed('\\x00\\x00\\x00\\x02\\x81\\xa0\\x00')
+        ['\\x81\\xa0']
+        >>> framer.encode('\\x81\\xa0')
+        '\\x00\\x00\\x00\\x02\\x81\\xa0'
+
+    :param max_size: Maximum number of bytes of a message, default 16 MiB.
+    """
+    def __init__(self, max_size=MAX_SIZE):
+        self.max_size = max_size
+
+        self._chunks = []
+        self._size = 0
+        # Number of bytes needed before the next message can be complete.
+        self._needed = LENGTH.size
+
+    @property
+    def buffer(self):
+        """ String with bytes of message which hasn't been completed yet. """
+        return ''.join(self._chunks)
+
+    def feed(self, data):
+        """ Append data to buffer and return list with complete messages.
+
+        :raises ValueError: When a message exceeds the maximum size.
+        """
+        if data:
+            self._chunks.append(data)
+            self._size += len(data)
+
+        if self._size < self._needed:
+            return []
+
+        buf = ''.join(self._chunks)
+
+        messages = []
+        offset = 0
+        while len(buf) - offset >= LENGTH.size:
+            size, = LENGTH.unpack_from(buf, offset)
+            if size > self.max_size:
+                raise ValueError('Message of {0} bytes exceeds maximum of {1} '
+                                 'bytes.'.format(size, self.max_size))
+
+            end = offset + LENGTH.size + size
+            if len(buf) < end:
+                break
+
+            messages.append(buf[offset + LENGTH.size:end])
+            offset = end
+
+        buf = buf[offset:]
+        self._chunks = [buf] if buf else []
+        self._size = len(buf)
+        self._needed = LENGTH.size if len(buf) < LENGTH.size else \
+            LENGTH.size + LENGTH.unpack_from(buf)[0]
+
+        return messages
+
+    def encode(self, message):
+        """ Return message prefixed with its length. """
+        return LENGTH.pack(len(message)) + message
+
+
+class Negotiator(object):
+    """ Pick framing and codec of a connection from the first bytes a client
+    sends.
+
+    A client which wants a binary codec starts the connection with a preamble:
+    a NUL byte, the name of the codec and a newline, like `\\x00msgpack\\n`.
+    Tolk answers with the same preamble and from then on both sides send
+    messages encoded with that codec, prefixed with their length. See
+    :class:`LengthPrefixFramer`. When the codec isn't available Tolk answers
+    with `\\x00json\\n` and the connection continues with JSON.
+
+    Without preamble a connection carries newline delimited JSON, so existing
+    clients keep working.
+
+    :param negotiated: Callable which is called with the codec, or None for
+        JSON, and the preamble to send to the client when the client has sent
+        a preamble.
+    """
+    def __init__(self, negotiated):
+        self.negotiated = negotiated
+        self.framer = None
+        self.buffer = ''
+
+    def feed(self, data):
+        """ Append data to buffer and return list with complete messages.
+
+        :raises ValueError: When preamble is longer than
+            :data:`MAX_PREAMBLE_SIZE`, or a message longer than
+            :data:`MAX_SIZE`.
+        """
+        if self.framer is not None:
+            return self.framer.feed(data)
+
+        self.buffer += data
+        if not self.buffer:
+            return []
+
+        if not self.buffer.startswith(PREAMBLE_MARKER):
+            self.framer = Framer()
+            return self.framer.feed(self.buffer)
+
+        end = self.buffer.find(DELIMITER, 0, MAX_PREAMBLE_SIZE)
+        if end < 0:
+            if len(self.buffer) >= MAX_PREAMBLE_SIZE:
+                raise ValueError('Preamble exceeds {0} bytes.'
+                                 .format(MAX_PREAMBLE_SIZE))
+            return []
+
+        name, data = self.buffer[1:end], self.buffer[end + 1:]
+
+        try:
+            codec = get_binary_codec(name)
+            self.framer = LengthPrefixFramer()
+        except (KeyError, ImportError):
+            name, codec = 'json', None
+            self.framer = Framer()
+
+        self.negotiated(codec, PREAMBLE_MARKER + name + DELIMITER)
+
+        return self.framer.feed(data)
+
+    @property
+    def pending(self):
+        """ Whether part of a message has been buffered. """
+        return bool((self.framer or self).buffer)
+
+    def encode(self, message):
+        """ Return message framed for the negotiated protocol. """
+        return (self.framer or Framer()).encode(message)
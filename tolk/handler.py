@@ -2,11 +2,16 @@
 :class:`tolk.Dispatcher`.
 
 """
+import time
 import socket
+import select
 import errno
 from logbook import Logger
 from SocketServer import BaseRequestHandler
 
+from tolk.framing import Negotiator
+from tolk.session import Session, SessionClosed, get_peer
+
 log = Logger(__name__)
 
 
@@ -38,18 +43,134 @@ class Handler(BaseRequestHandler):
         server.serve_forever()
 
     """
+    #: Maximum number of bytes to read from socket at once.
+    buffer_size = 4096
+
+    #: Maximum number of notifications waiting to be sent to a client which
+    #: doesn't read its connection, before the connection is dropped.
+    max_notifications = 100
+
     def handle(self):
-        """ Direct incoming requests to server's dispatcher and return response
+        """ Direct incoming requests to server's dispatcher and return responses
         back to client.
+
+        The connection stays open until the client closes it, so a client can
+        stream many newline-delimited requests over one connection. Partial
+        reads are buffered until a message is complete, so messages can be of
+        arbitrary size. Clients can negotiate a binary codec with a
+        preamble. See :mod:`tolk.framing`.
+
+        Notifications can be pushed to the client while the connection is
+        open, see :class:`tolk.session.Session`. Requests of a client which
+        disconnects while they wait for the bus are dropped, see
+        :meth:`connected`.
+
+        When the dispatcher has a :class:`tolk.tracing.Tracer`, the time it
+        took to read a request and to send its response are part of the
+        trace of the request.
         """
-        self.data = self.request.recv(1024).strip()
-        log.debug('<-- {0}'.format(self.data))
+        def negotiated(codec, preamble):
+            session.codec = codec
+            self.request.sendall(preamble)
+
+        framer = Negotiator(negotiated)
+        session = Session(lambda msg: self.request.sendall(framer.encode(msg)),
+                          self.connected, self.max_notifications,
+                          get_peer(self.request, self.client_address))
+
+        # Time at which the first part of the message being read arrived.
+        # Waiting for the client to start a message isn't part of reading it.
+        receiving = None
+
+        try:
+            while True:
+                try:
+                    data = self.request.recv(self.buffer_size)
+                except socket.error as e:
+                    if e.errno == errno.ECONNRESET:
+                        return
+                    raise
+
+                if not data:
+                    return
+
+                received = time.time()
+                if receiving is None:
+                    receiving = received
+
+                try:
+                    messages = framer.feed(data)
+                except ValueError as e:
+                    log.error('Close connection: {0}'.format(e))
+                    return
+
+                if messages:
+                    read = received - receiving
+                    receiving = received if framer.pending else None
 
-        resp = self.server.dispatcher.call(self.data)
+                for msg in messages:
+                    if not self.respond(msg, session, read):
+                        return
+        finally:
+            session.close()
+
+    def connected(self):
+        """ Return whether client is still connected. While a request is
+        dispatched nobody reads from the socket, so the socket is polled for
+        a hangup or an error without consuming data or blocking. A client
+        which has only shut down its side of the connection is still
+        connected, because it may be waiting for its responses.
+        """
+        try:
+            poller = select.poll()
+            poller.register(self.request, select.POLLHUP | select.POLLERR)
+            return not poller.poll(0)
+        except (select.error, socket.error, ValueError):
+            return False
+
+    def respond(self, msg, session, read=0.0):
+        """ Dispatch a single message and send response to client.
+
+        :param msg: String with JSON-RPC request.
+        :param session: :class:`tolk.session.Session` of connection.
+        :param read: Number of seconds it took to read message, default 0.
+        :returns: False if response could not be sent because client has
+            closed connection, otherwise True.
+        """
+        tracer = getattr(self.server.dispatcher, 'tracer', None)
+        trace = tracer.begin() if tracer is not None else None
+
+        try:
+            return self._respond(msg, session, read, trace)
+        finally:
+            if tracer is not None:
+                tracer.end(trace)
+
+    def _respond(self, msg, session, read, trace):
+        log.debug('<-- {0}'.format(msg))
+
+        if trace is not None:
+            trace.add('read', read)
+
+        # Servers of :mod:`tolk.server` limit the number of requests which
+        # are dispatched concurrently.
+        dispatch = getattr(self.server, 'dispatch', None) or \
+            self.server.dispatcher.call
+        resp = dispatch(msg, session)
         log.debug('--> {0}'.format(resp))
 
+        # Notifications don't have a response.
+        if resp is None:
+            return True
+
+        started = time.time()
         try:
-            self.request.sendall(resp)
+            session.send(resp)
+            if trace is not None:
+                trace.add('send', time.time() - started)
+        except SessionClosed as e:
+            log.error('Close connection: {0}'.format(e))
+            return False
         except socket.error as e:
             # Catches broken pipe errors, errno 32. This is when client
             # terminates connection, but server still tries to send data to
@@ -58,5 +179,7 @@ class Handler(BaseRequestHandler):
                 log.error('[Errno {0}]: Handler could not send response to '
                           'client.'.format(errno.EPIPE))
 
-                return
+                return False
             raise
+
+        return True
@@ -0,0 +1,109 @@
+""" Handler for JSON-RPC requests over HTTP.
+
+Clients which can't keep a socket open, or which live behind an HTTP proxy,
+can POST JSON-RPC requests to a :class:`tolk.server.ThreadPoolTCPServer` with
+:class:`HTTPHandler`::
+
+    server = ThreadPoolTCPServer(('0.0.0.0', 8080), HTTPHandler)
+    server.dispatcher = Dispatcher(TcpMaster('localhost', 502))
+
+    server.serve_forever()
+
+.. code:: bash
+
+    $ curl -d '{"jsonrpc": "2.0", "method": "read_coils", "id": 1,
+                "params": {"starting_address": 100, "quantity": 2}}' \\
+        http://localhost:8080/
+
+Connections are kept alive, so a client can send many requests over one
+connection. Subscriptions aren't available over HTTP, because responses can't
+be pushed.
+
+Metrics are served at `/metrics` in the Prometheus text format, see
+:mod:`tolk.metrics`.
+
+"""
+from BaseHTTPServer import BaseHTTPRequestHandler
+from logbook import Logger
+from pyjsonrpc import JsonRpcError
+
+from tolk.json_rpc import error_response
+from tolk.metrics import prometheus
+from tolk.session import get_peer
+
+log = Logger(__name__)
+
+
+class HTTPHandler(BaseHTTPRequestHandler):
+    """ Handler which dispatches JSON-RPC requests in the body of POST
+    requests to the :class:`tolk.Dispatcher` instance in attribute
+    :attr:`dispatcher` of the server.
+    """
+    protocol_version = 'HTTP/1.1'
+    server_version = 'Tolk'
+
+    #: Number of seconds after which an idle connection is closed, so it
+    #: doesn't occupy a thread forever.
+    timeout = 60
+
+    #: Maximum number of bytes of a request body.
+    max_body_size = 16 * 1024 * 1024
+
+    def do_POST(self):
+        """ Dispatch JSON-RPC request in body and respond with JSON-RPC
+        response, or with 204 No Content when request didn't require a
+        response.
+        """
+        try:
+            length = int(self.headers.get('Content-Length'))
+        except (TypeError, ValueError):
+            self.send_error(411)
+            return
+
+        if length > self.max_body_size:
+            self.send_error(413)
+            self.close_connection = 1
+            return
+
+        msg = self.rfile.read(length)
+        log.debug('<-- {0}'.format(msg))
+
+        try:
+            dispatch = getattr(self.server, 'dispatch', None) or \
+                self.server.dispatcher.call
+            resp = dispatch(msg, peer=get_peer(self.request,
+                                               self.client_address))
+        except JsonRpcError as e:
+            # Requests which can't be parsed.
+            resp = self.server.dispatcher.codec.dumps(error_response(e))
+
+        log.debug('--> {0}'.format(resp))
+
+        if resp is None:
+            self.send_response(204)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(resp)))
+        self.end_headers()
+        self.wfile.write(resp)
+
+    def do_GET(self):
+        """ Respond with metrics in the Prometheus text format. """
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = prometheus(self.server.dispatcher.get_metrics())
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug('{0} {1}'.format(self.client_address[0], format % args))
@@ -1,25 +1,715 @@
+import sys
+import time
+import itertools
+import threading
+import traceback
+from functools import partial
+from logbook import Logger
+
 from modbus_tk.defines import (READ_COILS, READ_DISCRETE_INPUTS,
                                READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS,
                                WRITE_SINGLE_COIL, WRITE_SINGLE_REGISTER,
                                WRITE_MULTIPLE_COILS, WRITE_MULTIPLE_REGISTERS)
-from pyjsonrpc import JsonRpc, rpcmethod
-from tolk.exceptions import json_rpc_error
+from modbus_tk.modbus import ModbusError
+from pyjsonrpc import (JsonRpc, InternalError, InvalidParams, InvalidRequest,
+                       JsonRpcError, MethodNotFound, ParseError, rpcmethod)
+from tolk import coalesce, dtypes, tracing
+from tolk.codec import get_codec
+from tolk.cache import MISS, missing_ranges
+from tolk.exceptions import (DeadlineExceeded, ServerBusy, json_rpc_error,
+                             server_busy)
+from tolk.metrics import Metrics
+from tolk.routing import Backend, NoRoute, Router
+from tolk.scheduler import HIGH, NORMAL, LOW, PRIORITIES
+from tolk.singleflight import SingleFlight
+from tolk.subscriptions import SubscriptionManager
+
+log = Logger(__name__)
+
+#: Function codes of the read methods.
+READ_METHODS = {
+    'read_coils': READ_COILS,
+    'read_discrete_inputs': READ_DISCRETE_INPUTS,
+    'read_holding_registers': READ_HOLDING_REGISTERS,
+    'read_input_registers': READ_INPUT_REGISTERS,
+}
+
+#: Names of the methods which write.
+WRITE_METHODS = frozenset([
+    'write_single_coil',
+    'write_single_register',
+    'write_multiple_coils',
+    'write_multiple_registers',
+    'write_multiple_registers_as',
+])
+
+#: Function codes of the read requests which return the values written by
+#: write requests.
+WRITE_TABLES = {
+    WRITE_SINGLE_COIL: READ_COILS,
+    WRITE_MULTIPLE_COILS: READ_COILS,
+    WRITE_SINGLE_REGISTER: READ_HOLDING_REGISTERS,
+    WRITE_MULTIPLE_REGISTERS: READ_HOLDING_REGISTERS,
+}
 
 
 class Dispatcher(JsonRpc):
-    def __init__(self, modbus_master):
-        self.modbus_master = modbus_master
+    """ Dispatch JSON-RPC requests to a Modbus master.
+
+    Reads in a batch request on the same slave with the same function code
+    are coalesced into as few Modbus requests as possible when their address
+    ranges are at most `max_gap` addresses apart. See :mod:`tolk.coalesce`.
+    Only reads before the first write of a batch are coalesced, so reads
+    after a write return the written values.
+
+    Identical reads of concurrent clients share a single Modbus request. See
+    :mod:`tolk.singleflight`.
+
+    Reads can be served from a :class:`tolk.cache.RegisterCache`. Only the
+    addresses missing from the cache are read from the bus. Writes update the
+    cache.
+
+    Reads of addresses which are scanned by a :class:`tolk.scanner.Scanner`
+    are served from its :class:`tolk.scanner.RegisterImage`, as long as the
+    scanned values are fresh.
+
+    Clients with a persistent connection can subscribe on changes of a range
+    of addresses. See :mod:`tolk.subscriptions`.
+
+    Requests can be routed to multiple Modbus masters by a
+    :class:`tolk.routing.Router`. Every method accepts a `unit` parameter to
+    select a unit of the router.
+
+    Writes have a high priority on the bus, reads a normal priority and polls
+    of subscriptions a low priority. Every method accepts a `priority`
+    parameter to override the default. See :mod:`tolk.scheduler`.
+
+    Every method accepts a `timeout_ms` parameter with the number of
+    milliseconds the client is willing to wait, default `timeout`. Requests
+    which haven't reached the bus when their deadline passes, or whose client
+    has disconnected, are dropped and answered with a
+    :class:`tolk.exceptions.DeadlineExceeded` error, so the bus doesn't do
+    work for clients which are gone.
+
+    A :class:`tolk.ratelimit.RateLimiter` limits the number of requests per
+    peer: the host of a TCP or HTTP client, or the process of a client of a
+    Unix Domain Socket, so all connections of a client share a limit.
+    Requests over the limit, like requests which don't fit in the bounded
+    queue of a bus, are rejected with a :class:`tolk.exceptions.ServerBusy`
+    error which tells the client when to retry. Requests without peer and
+    session aren't limited.
+
+    Named points of a :class:`tolk.points.PointMap` can be read with
+    :meth:`read_points`.
+
+    Requests are counted and timed per method, see :meth:`get_metrics`. A
+    :class:`tolk.tracing.Tracer` can trace the phases of a sample of requests
+    and log the slow ones.
+
+    Valid requests are dispatched through a table of methods which is built
+    once, with the fastest JSON codec available. See :mod:`tolk.codec`.
+    Responses and error codes are the same as the ones of
+    :meth:`pyjsonrpc.JsonRpc.call`, invalid requests in a batch get their own
+    error response.
+
+    :param modbus_master: Instance of :class:`modbus_tk.modbus.Master`.
+        Required when no router is given.
+    :param max_gap: Maximum number of unrequested addresses between 2 reads
+        of a batch for them to be merged, default 10. Use -1 to disable
+        coalescing.
+    :param cache: Instance of :class:`tolk.cache.RegisterCache`, default None.
+    :param image: Instance of :class:`tolk.scanner.RegisterImage`, default
+        None.
+    :param router: Instance of :class:`tolk.routing.Router`, default None.
+        Backends of the router have their own cache and image, so use either
+        router or modbus_master, cache and image.
+    :param points: Instance of :class:`tolk.points.PointMap`, default None.
+        Required for :meth:`read_points`.
+    :param codec: Instance of :class:`tolk.codec.Codec` to decode requests
+        and encode responses, default the one returned by
+        :func:`tolk.codec.get_codec`.
+    :param tracer: Instance of :class:`tolk.tracing.Tracer`, default None.
+    :param timeout: Number of seconds a request may take to reach the bus
+        when it has no `timeout_ms` parameter, default None, which means no
+        deadline.
+    :param rate_limiter: Instance of :class:`tolk.ratelimit.RateLimiter`,
+        default None.
+    """
+    def __init__(self, modbus_master=None, max_gap=10, cache=None,
+                 image=None, router=None, points=None, codec=None,
+                 tracer=None, timeout=None, rate_limiter=None):
+        if router is None:
+            if modbus_master is None:
+                raise ValueError('Either modbus_master or router is '
+                                 'required.')
+
+            router = Router({'default': Backend(modbus_master, cache, image)})
+        elif modbus_master is not None or cache is not None or \
+                image is not None:
+            raise ValueError('Backends of router have their own master, '
+                             'cache and image.')
+
+        self.router = router
+        self.points = points
+        self.codec = codec or get_codec()
+        self.metrics = Metrics()
+        self.tracer = tracer
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.max_gap = max_gap
+        self.subscriptions = SubscriptionManager(
+            self._poll, lambda slave_id, unit: self._route(slave_id, unit)[0])
+
+        # Attributes of the default backend, if any.
+        backend = router.backends.get(router.default)
+        self.modbus_master = getattr(backend, 'modbus_master', None)
+        self.bus = getattr(backend, 'bus', None)
+        self.in_flight = getattr(backend, 'in_flight', None)
+        self.cache = getattr(backend, 'cache', None)
+        self.image = getattr(backend, 'image', None)
+
+        # :attr:`JsonRpc.methods` is a class attribute which caches bound
+        # methods, so without a dict per instance all dispatchers would end up
+        # calling the methods of the first dispatcher.
+        self.methods = {}
+
+        #: Maps names of JSON-RPC methods to bound methods.
+        self.method_table = dict(
+            (name, getattr(self, name)) for name in dir(type(self))
+            if getattr(getattr(type(self), name), 'rpcmethod', False))
+
+        # Results of coalesced reads of the batch being dispatched by the
+        # current thread, its session and peer, the deadline of its request
+        # and the error of a batch which exceeds the rate limit of the peer.
+        self._local = threading.local()
 
         super(JsonRpc, self).__init__()
 
+    def call(self, json_request, session=None, peer=None):
+        """ Dispatch JSON-RPC request, or batch of requests, and return
+        response.
+
+        :param json_request: String with JSON-RPC request, or a request
+            encoded with the codec of session.
+        :param session: :class:`tolk.session.Session` of client which sent
+            request, default None. Required for subscriptions. When the
+            session has negotiated a binary codec, requests are decoded and
+            responses encoded with that codec.
+        :param peer: Hashable which identifies client when request has no
+            session, like the host of an HTTP client, default None. Requests
+            are rate limited per peer, see :meth:`_peer`.
+        :returns: String with JSON-RPC response, or None when request didn't
+            require a response.
+        """
+        codec = getattr(session, 'codec', None) or self.codec
+
+        # Requests of a :class:`tolk.handler.Handler` are traced from the
+        # moment they are read from the socket, other requests from here. The
+        # handler has decided already whether its request is sampled.
+        begin = self.tracer is not None and not tracing.decided()
+        if begin:
+            trace = self.tracer.begin()
+
+        self._local.session = session
+        self._local.peer = peer
+        try:
+            return self._call(json_request, codec)
+        finally:
+            self._local.session = None
+            self._local.peer = None
+            if begin:
+                self.tracer.end(trace)
+
+    def _call(self, json_request, codec):
+        """ Dispatch request on the fast path. Every request of a batch gets
+        its own response, requests which aren't valid or which call a method
+        that isn't in the method table get an error response. JSON which
+        can't be parsed is passed on to :meth:`pyjsonrpc.JsonRpc.call`, which
+        raises a :class:`pyjsonrpc.rpcerror.ParseError`.
+
+        Every request counts against the rate limit of the peer, valid or
+        not, including JSON which can't be parsed. See :meth:`_limit`.
+        """
+        started = time.time()
+        try:
+            data = codec.loads(json_request)
+        except ValueError as e:
+            rejected = self._limit(1)
+            if rejected is not None:
+                return codec.dumps(error_response(rejected))
+
+            if codec.json:
+                return JsonRpc.call(self, json_request)
+
+            return codec.dumps(error_response(ParseError(data=str(e))))
+
+        requests = data if isinstance(data, list) else [data]
+
+        if not requests:
+            # Like pyjsonrpc, an empty JSON batch isn't answered.
+            if codec.json:
+                return None
+
+            return codec.dumps(error_response(InvalidRequest()))
+
+        self._local.rejected = self._limit(len(requests))
+
+        if isinstance(data, list) and self.max_gap >= 0 and \
+                self._local.rejected is None:
+            # Reads after a write must see the written values, so only the
+            # reads before the first write are coalesced.
+            reads = list(itertools.takewhile(
+                lambda r: not isinstance(r, dict) or
+                r.get('method') not in WRITE_METHODS, requests))
+
+            self._local.deadline = self._batch_deadline(reads, started)
+            self._local.prefetched = self._prefetch(reads)
+
+        decoding = time.time() - started
+
+        trace = tracing.current()
+        if trace is not None:
+            trace.add('parse', decoding)
+            for request in requests:
+                if isinstance(request, dict):
+                    trace.methods.append(unicode(request.get('method')))
+                    if request.get('id') is not None:
+                        trace.request_ids.append(request['id'])
+
+        try:
+            responses = [response
+                         for response in [self._dispatch(request, codec,
+                                                         started)
+                                          for request in requests]
+                         if response is not None]
+        finally:
+            self._local.prefetched = []
+            self._local.deadline = None
+            self._local.rejected = None
+
+        if not responses:
+            self.metrics.observe_serialization(decoding)
+            return None
+
+        started = time.time()
+
+        # Like pyjsonrpc, a batch with a single request gets a single
+        # response.
+        if len(requests) == 1:
+            msg = codec.dumps(responses[0])
+        else:
+            msg = codec.dumps(responses)
+
+        encoding = time.time() - started
+        if trace is not None:
+            trace.add('encode', encoding)
+
+        self.metrics.observe_serialization(decoding + encoding)
+        return msg
+
+    def _dispatch(self, request, codec, received=None):
+        """ Call method of request and return dictionary with response, or
+        None when request is a notification. Responses are identical to the
+        ones of :meth:`pyjsonrpc.JsonRpc.call`. Requests which aren't a
+        dictionary get an invalid request error without id.
+
+        :param request: Dictionary with JSON-RPC request.
+        :param codec: :class:`tolk.codec.Codec` which encodes response.
+        :param received: Time at which request was received, default now.
+        """
+        if not isinstance(request, dict):
+            log.error(u'{0} -- {1!r}'.format(unicode(InvalidRequest()),
+                                             request))
+            return error_response(InvalidRequest())
+
+        response = {'jsonrpc': request.get('jsonrpc') or '2.0'}
+
+        params = request.get('params') or []
+        args, kwargs = [], {}
+        if isinstance(params, list):
+            args = params
+        elif isinstance(params, dict):
+            args = params.pop('__args', [])
+            kwargs = params
+
+        timeout_ms = kwargs.pop('timeout_ms', None)
+
+        method = request.get('method')
+        started = time.time()
+        try:
+            if not isinstance(method, basestring):
+                raise InvalidRequest(data=u'Method name: {0!r}'.format(method))
+
+            if method not in self.method_table:
+                raise MethodNotFound(data=u"Method name: '{0}'"
+                                     .format(method))
+
+            if getattr(self._local, 'rejected', None) is not None:
+                raise self._local.rejected
+
+            self._local.deadline = self._deadline(timeout_ms,
+                                                  received or started)
+            result = self.method_table[method](*args, **kwargs)
+            if result is not None:
+                response['result'] = codec.encode_result(method, result)
+        except TypeError as e:
+            data = ''.join(traceback.format_exception(*sys.exc_info()))
+            if 'takes exactly' in unicode(e) and 'arguments' in unicode(e):
+                error = InvalidParams(data=data)
+            else:
+                error = InternalError(data=data)
+        except JsonRpcError as e:
+            error = e
+        except BaseException as e:
+            error = InternalError(data=getattr(e, 'data', None) or ''.join(
+                traceback.format_exception(*sys.exc_info())))
+        else:
+            error = None
+
+        if isinstance(method, basestring) and method in self.method_table:
+            self.metrics.observe_request(method, time.time() - started, error)
+
+        if error is not None:
+            log.error(u'{0} -- {1!r}'.format(unicode(error), error.data))
+            response['error'] = error_response(error)['error']
+
+        id = request.get('id')
+        if id is None or not (id or unicode(id)):
+            return None
+
+        response['id'] = id
+        return response
+
+    def _prefetch(self, requests):
+        """ Execute coalesced reads of batch.
+
+        :param requests: List with JSON-RPC requests.
+        :returns: List with (backend, frame, values) tuples of the coalesced
+            reads which succeeded.
+        """
+        backends = {}
+        for read, unit in filter(None, map(get_read, requests)):
+            try:
+                backend, slave_id = self.router.route(read.slave_id, unit)
+            except NoRoute:
+                continue
+
+            backends.setdefault(backend, []).append(
+                read._replace(slave_id=slave_id))
+
+        prefetched = []
+        for backend, reads in backends.items():
+            # Only frames covering multiple reads save a round trip.
+            frames = [frame
+                      for frame in coalesce.plan(reads, self.max_gap)
+                      if len([r for r in reads
+                              if coalesce.covers(frame, r)]) > 1]
+
+            for frame in frames:
+                try:
+                    values = self._fetch(backend, frame, NORMAL)
+                except (ModbusError, DeadlineExceeded, ServerBusy):
+                    # Merged frame possibly covers addresses which can't be
+                    # read, or some reads of the batch may have a later
+                    # deadline or find room in the queue. The reads are
+                    # executed one by one so every read gets its own
+                    # response.
+                    continue
+
+                prefetched.append((backend, frame, values))
+
+        return prefetched
+
+    def _deadline(self, timeout_ms, received):
+        """ Return time after which request is dropped, or None.
+
+        :param timeout_ms: Number of milliseconds given by client, or None
+            for the default timeout.
+        :param received: Time at which request was received.
+        :raises InvalidParams: When timeout_ms isn't a positive number.
+        """
+        if timeout_ms is None:
+            return None if self.timeout is None else received + self.timeout
+
+        if isinstance(timeout_ms, bool) or \
+                not isinstance(timeout_ms, (int, long, float)) or \
+                timeout_ms <= 0:
+            raise InvalidParams(data='Timeout {0!r} is not a positive number '
+                                'of milliseconds.'.format(timeout_ms))
+
+        return received + timeout_ms / 1000.0
+
+    def _batch_deadline(self, requests, received):
+        """ Return deadline of the coalesced reads of a batch, which is the
+        latest deadline of its requests, or None when one of them has none.
+        """
+        deadlines = []
+        for request in requests:
+            params = request.get('params') \
+                if isinstance(request, dict) else None
+            timeout_ms = params.get('timeout_ms') \
+                if isinstance(params, dict) else None
+
+            try:
+                deadlines.append(self._deadline(timeout_ms, received))
+            except InvalidParams:
+                deadlines.append(None)
+
+        return None if None in deadlines else max(deadlines)
+
+    def _priority(self, priority, default):
+        """ Return priority class of request.
+
+        :param priority: Name or number of priority class, or None.
+        :param default: Priority class when priority is None.
+        :raises InvalidParams: When priority is unknown.
+        """
+        if priority is None:
+            return default
+
+        if priority in PRIORITIES.values():
+            return priority
+
+        try:
+            return PRIORITIES[priority]
+        except (KeyError, TypeError):
+            raise InvalidParams(data='Unknown priority {0!r}.'
+                                .format(priority))
+
+    def _client(self):
+        """ Return id of client of request being dispatched by current
+        thread, or None. """
+        session = getattr(self._local, 'session', None)
+        return None if session is None else session.id
+
+    def _peer(self):
+        """ Return hashable which identifies client of request being
+        dispatched by current thread across connections, so a client can't
+        reset its rate limit by reconnecting. Falls back to the id of the
+        session when the peer is unknown. Returns None for requests without
+        peer and session.
+        """
+        peer = getattr(self._local, 'peer', None)
+        if peer is not None:
+            return peer
+
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            return None
+
+        return session.peer if session.peer is not None else session.id
+
+    def _limit(self, count):
+        """ Take count requests from the rate limit of the peer of request
+        being dispatched by current thread. See :meth:`_peer`.
+
+        :returns: :class:`tolk.exceptions.ServerBusy` error when peer is
+            over its limit, otherwise None.
+        """
+        peer = self._peer()
+        if self.rate_limiter is None or peer is None:
+            return None
+
+        retry_after = self.rate_limiter.take(peer, count)
+        if retry_after:
+            return server_busy(retry_after)
+
+    def _limits(self):
+        """ Return (deadline, cancelled) tuple of request being dispatched by
+        current thread. See :meth:`tolk.bus.Bus.execute`.
+        """
+        session = getattr(self._local, 'session', None)
+        return (getattr(self._local, 'deadline', None),
+                None if session is None else session.disconnected)
+
+    def _context(self):
+        """ Return (client, deadline, cancelled) tuple of request being
+        dispatched by current thread, to pass on to other threads which work
+        on the request. See :meth:`_client` and :meth:`_limits`.
+        """
+        return (self._client(),) + self._limits()
+
+    def _route(self, slave_id, unit):
+        """ Return (backend, slave_id) tuple of request.
+
+        :param slave_id: Number with slave id, already converted by the
+            method.
+        :raises InvalidParams: When request can't be routed.
+        """
+        try:
+            return self.router.route(slave_id, unit)
+        except NoRoute as e:
+            raise InvalidParams(data=str(e))
+
+    def _read(self, slave_id, function_code, starting_address, quantity,
+              unit=None, priority=None, context=None):
+        """ Return values of read, from a coalesced read of current batch,
+        from register image or from cache when possible, otherwise from the
+        bus of the backend the read is routed to.
+
+        :param context: (client, deadline, cancelled) tuple of request when
+            read isn't executed by the thread which dispatches the request,
+            default the one of the current thread. See :meth:`_context`.
+        """
+        priority = self._priority(priority, NORMAL)
+        backend, slave_id = self._route(slave_id, unit)
+        read = coalesce.Read(slave_id, function_code, starting_address,
+                             quantity)
+
+        for b, frame, values in getattr(self._local, 'prefetched', []):
+            if b is backend and coalesce.covers(frame, read):
+                return coalesce.extract(frame, values, read)
+
+        if backend.image is not None:
+            values = backend.image.lookup(*read)
+            if values is not None:
+                return values
+
+        cache = backend.cache
+        if cache is None or not cache.caches(function_code):
+            return self._fetch(backend, read, priority, context)
+
+        values = cache.get(*read)
+        misses = [coalesce.Read(slave_id, function_code,
+                                starting_address + offset, length)
+                  for offset, length in missing_ranges(values)]
+
+        for frame in coalesce.plan(misses, max(self.max_gap, 0)):
+            offset = frame.starting_address - starting_address
+            for i, value in enumerate(self._fetch(backend, frame, priority,
+                                                  context), offset):
+                if values[i] is MISS:
+                    values[i] = value
+
+        return tuple(values)
+
+    def _poll(self, slave_id, function_code, starting_address, quantity,
+              unit=None):
+        """ Read values for subscriptions, with low priority. """
+        return self._read(slave_id, function_code, starting_address, quantity,
+                          unit, LOW)
+
+    def _fetch(self, backend, read, priority, context=None):
+        """ Return values of read from the bus of backend. Identical reads in
+        flight share the same Modbus request, which is executed with the
+        priority and deadline of the first read. When it's dropped because of
+        that deadline, or because its client has disconnected, the other
+        reads are executed with their own.
+
+        Reads which exceed the maximum quantity of the protocol are split in
+        chunks. The chunks are executed concurrently when the bus of the
+        backend can carry multiple transactions at a time.
+
+        :param backend: Instance of :class:`tolk.routing.Backend`.
+        :param read: Instance of :class:`tolk.coalesce.Read`.
+        :param priority: Priority class of read.
+        :param context: (client, deadline, cancelled) tuple of request,
+            default the one of the current thread. See :meth:`_context`.
+        """
+        client, deadline, cancelled = context or self._context()
+        chunks = coalesce.split(read)
+
+        results = execute_all([partial(backend.in_flight.do, chunk,
+                                       self._execute_read, backend, chunk,
+                                       priority, client, deadline, cancelled)
+                               for chunk in chunks],
+                              backend.bus.scheduler.capacity)
+
+        if len(results) == 1:
+            return results[0]
+
+        return tuple(itertools.chain.from_iterable(results))
+
+    def _execute_read(self, backend, read, priority, client, deadline=None,
+                      cancelled=None):
+        """ Execute read on bus and store result in cache. """
+        execute = partial(backend.bus.execute, priority=priority,
+                          client=client, deadline=deadline,
+                          cancelled=cancelled)
+
+        cache = backend.cache
+        if cache is None:
+            return execute(*read)
+
+        generation = cache.generation
+        values = execute(*read)
+        cache.put(read.slave_id, read.function_code, read.starting_address,
+                  values, generation)
+
+        return values
+
+    def _write(self, slave_id, function_code, address, output_value,
+               unit=None, priority=None):
+        """ Execute write request on bus of backend the write is routed to and
+        update cache.
+
+        Writes of multiple values which exceed the maximum quantity of the
+        protocol are split in chunks, like reads are. See :meth:`_fetch`.
+
+        :param output_value: Value to write, or list with values in case of
+            a request which writes multiple values.
+        """
+        priority = self._priority(priority, HIGH)
+        backend, slave_id = self._route(slave_id, unit)
+        table = WRITE_TABLES[function_code]
+
+        # Coalesced reads of the batch which cover the written addresses
+        # are stale.
+        written = coalesce.Read(slave_id, table, address,
+                                len(output_value)
+                                if isinstance(output_value, list) else 1)
+        self._local.prefetched = [
+            (b, frame, values)
+            for b, frame, values in getattr(self._local, 'prefetched', [])
+            if b is not backend or not coalesce.overlaps(frame, written)]
+
+        deadline, cancelled = self._limits()
+        execute = partial(backend.bus.execute, slave_id, function_code,
+                          priority=priority, client=self._client(),
+                          deadline=deadline, cancelled=cancelled)
+        limit = coalesce.MAX_WRITE_QUANTITY.get(function_code)
+
+        try:
+            if limit is None or len(output_value) <= limit:
+                result = execute(address, output_value=output_value)
+            else:
+                execute_all([partial(execute, address + offset,
+                                     output_value=output_value[
+                                         offset:offset + limit])
+                             for offset in range(0, len(output_value),
+                                                 limit)],
+                            backend.bus.scheduler.capacity)
+                result = (address, len(output_value))
+        except:
+            if backend.cache is not None:
+                # Write may or may not have succeeded.
+                backend.cache.invalidate(slave_id, table, address,
+                                         written.quantity)
+            raise
+
+        values = get_written_values(function_code, output_value)
+
+        if backend.cache is not None:
+            backend.cache.update(slave_id, table, address, values)
+
+        if backend.image is not None:
+            backend.image.overwrite(slave_id, table, address, values)
+
+        return result
+
     @rpcmethod
     @json_rpc_error
-    def read_coils(self, starting_address, quantity, slave_id=1):
+    def read_coils(self, starting_address, quantity, slave_id=1,
+                   unit=None, priority=None):
         """ Execute Modbus function code 01: read status of coils.
 
         :param starting_address: Number of starting address.
         :param quantity: Number of coils to read.
         :param slave_id: Number with Slave id, default 1.
+        :param unit: Name of unit to route request to, default None. See
+            :class:`tolk.routing.Router`.
+        :param priority: Priority on bus, either `high`, `normal` or `low`.
+            Default is `normal`.
         :returns: JSON-RPC response containing the status of coils on success JSON-RPC error on failure.
 
         **Example request:**
@@ -50,18 +740,22 @@ class Dispatcher(JsonRpc):
                 ]
             }
         """
-        return self.modbus_master.execute(int(slave_id), READ_COILS,
-                                          int(starting_address),
-                                          int(quantity))
+        return self._read(int(slave_id), READ_COILS, int(starting_address),
+                          int(quantity), unit, priority)
 
     @rpcmethod
     @json_rpc_error
-    def read_discrete_inputs(self, starting_address, quantity, slave_id=1):
+    def read_discrete_inputs(self, starting_address, quantity, slave_id=1,
+                             unit=None, priority=None):
         """ Execute Modbus function code 02: read status of discrete inputs.
 
         :param starting_address: Number of starting address.
         :param quantity: Number of discrete inputs to read.
         :param slave_id: Number with Slave id, default 1.
+        :param unit: Name of unit to route request to, default None. See
+            :class:`tolk.routing.Router`.
+        :param priority: Priority on bus, either `high`, `normal` or `low`.
+            Default is `normal`.
         :returns: JSON-RPC response containing the status of discrete inputs
         on success or JSON-RPC error on failure.
 
@@ -93,19 +787,24 @@ class Dispatcher(JsonRpc):
                 ]
             }
         """
-        return self.modbus_master.execute(int(slave_id), READ_DISCRETE_INPUTS,
-                                          int(starting_address),
-                                          int(quantity))
+        return self._read(int(slave_id), READ_DISCRETE_INPUTS,
+                          int(starting_address), int(quantity), unit,
+                          priority)
 
     @rpcmethod
     @json_rpc_error
-    def read_holding_registers(self, starting_address, quantity, slave_id=1):
+    def read_holding_registers(self, starting_address, quantity, slave_id=1,
+                               unit=None, priority=None):
         """ Execute Modbus function code 03: read contents of contiguous block
         of holding registers.
 
         :param starting_address: Number of starting address.
         :param quantity: Number of holding registers to read.
         :param slave_id: Number with Slave id, default 1.
+        :param unit: Name of unit to route request to, default None. See
+            :class:`tolk.routing.Router`.
+        :param priority: Priority on bus, either `high`, `normal` or `low`.
+            Default is `normal`.
         :returns: JSON-RPC response with the contents of holding registers
         on success or JSON-RPC error on failure.
 
@@ -137,19 +836,24 @@ class Dispatcher(JsonRpc):
                 ]
             }
         """
-        return self.modbus_master.execute(int(slave_id), READ_HOLDING_REGISTERS,
-                                          int(starting_address),
-                                          int(quantity))
+        return self._read(int(slave_id), READ_HOLDING_REGISTERS,
+                          int(starting_address), int(quantity), unit,
+                          priority)
 
     @rpcmethod
     @json_rpc_error
-    def read_input_registers(self, starting_address, quantity, slave_id=1):
+    def read_input_registers(self, starting_address, quantity, slave_id=1,
+                             unit=None, priority=None):
         """ Execute Modbus function code 04: read contents of contiguous block
         of input registers.
 
         :param starting_address: Number of starting address.
         :param quantity: Number of input registers to read.
         :param slave_id: Number with Slave id, default 1.
+        :param unit: Name of unit to route request to, default None. See
+            :class:`tolk.routing.Router`.
+        :param priority: Priority on bus, either `high`, `normal` or `low`.
+            Default is `normal`.
         :returns: JSON-RPC response with the contents of input registers
         on success or JSON-RPC error on failure.
 
@@ -181,18 +885,449 @@ class Dispatcher(JsonRpc):
                 ]
             }
         """
-        return self.modbus_master.execute(int(slave_id), READ_INPUT_REGISTERS,
-                                          int(starting_address),
-                                          int(quantity))
+        return self._read(int(slave_id), READ_INPUT_REGISTERS,
+                          int(starting_address), int(quantity), unit,
+                          priority)
+
+    def _read_as(self, function_code, starting_address, count, dtype,
+                 byte_order, word_order, slave_id, unit, priority):
+        """ Read registers and decode them, see :mod:`tolk.dtypes`. """
+        try:
+            quantity = dtypes.register_count(dtype, int(count))
+            dtypes.check(dtype, byte_order, word_order)
+        except ValueError as e:
+            raise InvalidParams(data=str(e))
+
+        registers = self._read(int(slave_id), function_code,
+                               int(starting_address), quantity, unit,
+                               priority)
+
+        return dtypes.decode(registers, dtype, byte_order, word_order)
 
     @rpcmethod
     @json_rpc_error
-    def write_single_coil(self, address, value, slave_id=1):
+    def read_holding_registers_as(self, starting_address, count, dtype,
+                                  byte_order='big', word_order='big',
+                                  slave_id=1, unit=None, priority=None):
+        """ Read contents of holding registers and decode them into values of
+        a type. See :mod:`tolk.dtypes`.
+
+        :param starting_address: Number of starting address.
+        :param count: Number of values to read, or the number of characters
+            when dtype is `string`.
+        :param dtype: Name of type, one of `int16`, `uint16`, `int32`,
+            `uint32`, `float32`, `int64`, `uint64`, `float64` or `string`.
+        :param byte_order: Order of bytes within a register, either `big` or
+            `little`. Default is `big`.
+        :param word_order: Order of registers within a value, either `big` or
+            `little`. Default is `big`.
+        :param slave_id: Number with Slave id, default 1.
+        :param unit: Name of unit to route request to, default None. See
+            :class:`tolk.routing.Router`.
+        :param priority: Priority on bus, either `high`, `normal` or `low`.
+            Default is `normal`.
+        :returns: JSON-RPC response with list of values, or a string when
+            dtype is `string`. Floats which are NaN or infinite are null.
+
+        **Example request:**
+
+        .. sourcecode:: json
+
+            {
+                "params":{
+                    "starting_address":100,
+                    "count":2,
+                    "dtype":"float32",
+                    "word_order":"little"
+                },
+                "jsonrpc":"2.0",
+                "method":"read_holding_registers_as",
+                "id":1
+            }
+
+        **Example response:**
+
+        .. sourcecode:: json
+
+            {
+                "jsonrpc":"2.0",
+                "id":1,
+                "result":[
+                    21.5,
+                    -3.25
+                ]
+            }
+        """
+        return self._read_as(READ_HOLDING_REGISTERS, starting_address, count,
+                             dtype, byte_order, word_order, slave_id, unit,
+                             priority)
+
+    @rpcmethod
+    @json_rpc_error
+    def read_input_registers_as(self, starting_address, count, dtype,
+                                byte_order='big', word_order='big',
+                                slave_id=1, unit=None, priority=None):
+        """ Read contents of input registers and decode them into values of a
+        type. Accepts the same parameters as
+        :meth:`read_holding_registers_as`.
+
+        **Example request:**
+
+        .. sourcecode:: json
+
+            {
+                "params":{
+                    "starting_address":0,
+                    "count":1,
+                    "dtype":"uint32"
+                },
+                "jsonrpc":"2.0",
+                "method":"read_input_registers_as",
+                "id":1
+            }
+
+        **Example response:**
+
+        .. sourcecode:: json
+
+            {
+                "jsonrpc":"2.0",
+                "id":1,
+                "result":[
+                    87624394
+                ]
+            }
+        """
+        return self._read_as(READ_INPUT_REGISTERS, starting_address, count,
+                             dtype, byte_order, word_order, slave_id, unit,
+                             priority)
+
+    @rpcmethod
+    @json_rpc_error
+    def read_points(self, names, priority=None):
+        """ Read values of named points. Points are read with as few Modbus
+        requests as possible. See :mod:`tolk.points`.
+
+        :param names: List with names of points.
+        :param priority: Priority on bus, either `high`, `normal` or `low`.
+            Default is `normal`.
+        :returns: JSON-RPC response with object which maps names of points to
+            their values.
+
+        **Example request:**
+
+        .. sourcecode:: json
+
+            {
+                "params":{
+                    "names":[
+                        "AHU1.supply_temp",
+                        "AHU1.fan_speed"
+                    ]
+                },
+                "jsonrpc":"2.0",
+                "method":"read_points",
+                "id":1
+            }
+
+        **Example response:**
+
+        .. sourcecode:: json
+
+            {
+                "jsonrpc":"2.0",
+                "id":1,
+                "result":{
+                    "AHU1.supply_temp":18.5,
+                    "AHU1.fan_speed":72.5
+                }
+            }
+        """
+        if self.points is None:
+            raise InvalidParams(data='No points have been defined.')
+
+        if not isinstance(names, list):
+            raise InvalidParams(data='Names must be a list.')
+
+        try:
+            plan = self.points.plan(names)
+        except (KeyError, TypeError) as e:
+            raise InvalidParams(data='Unknown point {0!r}.'.format(e.args[0]))
+
+        # Frames on different units are read concurrently, frames on the
+        # same unit are queued on its bus anyway. The threads which read the
+        # frames don't know the request, so its client and limits are passed
+        # on.
+        context = self._context()
+        results = execute_all([partial(self._read, frame.slave_id,
+                                       frame.function_code,
+                                       frame.starting_address,
+                                       frame.quantity, unit, priority,
+                                       context)
+                               for unit, frame, _ in plan],
+                              len(set(unit for unit, _, _ in plan)))
+
+        values = {}
+        for (_, frame, members), result in zip(plan, results):
+            for offset, point in members:
+                values[point.name] = point.decode(
+                    result[offset:offset + point.read.quantity])
+
+        return values
+
+    @rpcmethod
+    def get_metrics(self):
+        """ Return metrics of requests and of the bus of every backend. See
+        :mod:`tolk.metrics`.
+
+        :returns: JSON-RPC response with the number of seconds since the
+            dispatcher has been created, the requests, errors and latency
+            histogram per method, a histogram of the time spent decoding
+            requests and encoding responses, and per backend the utilization
+            of its bus, its queues and the transactions, errors and latency
+            histogram per slave. Latencies are in seconds.
+
+        **Example request:**
+
+        .. sourcecode:: json
+
+            {
+                "jsonrpc":"2.0",
+                "method":"get_metrics",
+                "id":1
+            }
+
+        **Example response:**
+
+        .. sourcecode:: json
+
+            {
+                "jsonrpc":"2.0",
+                "id":1,
+                "result":{
+                    "uptime":3600.2,
+                    "methods":{
+                        "read_holding_registers":{
+                            "requests":1200,
+                            "errors":{
+                                "IllegalDataAddress":3
+                            },
+                            "latency":{
+                                "count":1200,
+                                "sum":14.1,
+                                "p50":0.01,
+                                "p99":0.05,
+                                "buckets":[[0.0005, 0], [0.001, 2], "..."]
+                            }
+                        }
+                    },
+                    "serialization":{"count":1200, "...": "..."},
+                    "backends":{
+                        "default":{
+                            "utilization":23.5,
+                            "busy_seconds":846.0,
+                            "queue":{"running":1, "...": "..."},
+                            "queue_wait":{"count":1203, "...": "..."},
+                            "slaves":{
+                                "1":{
+                                    "transactions":1203,
+                                    "errors":{},
+                                    "latency":{"count":1203, "...": "..."}
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+        """
+        metrics = self.metrics.snapshot()
+        metrics['backends'] = {}
+
+        for name, backend in self.router:
+            metrics['backends'][name] = backend.bus.metrics.snapshot()
+            metrics['backends'][name]['queue'] = backend.bus.stats()
+
+        return metrics
+
+    @rpcmethod
+    def read_image(self, table, starting_address, quantity, slave_id=1,
+                   unit=None):
+        """ Return values of register image, with their age and quality. The
+        register image is filled by a :class:`tolk.scanner.Scanner`.
+
+        :param table: Name of table, either `coils`, `discrete_inputs`,
+            `holding_registers` or `input_registers`.
+        :param starting_address: Number of starting address.
+        :param quantity: Number of values to read.
+        :param slave_id: Number with Slave id, default 1.
+        :param unit: Name of unit to route request to, default None. See
+            :class:`tolk.routing.Router`.
+        :returns: JSON-RPC response with the values, the time the oldest
+            value has been scanned, its age in seconds and the quality of the
+            values. The quality is `good`, `stale` when values haven't been
+            scanned recently or `bad` when the last scan failed or when
+            addresses aren't scanned at all.
+
+        **Example request:**
+
+        .. sourcecode:: json
+
+            {
+                "params":{
+                    "table":"holding_registers",
+                    "starting_address":100,
+                    "quantity":2,
+                    "slave_id":1
+                },
+                "jsonrpc":"2.0",
+                "method":"read_image",
+                "id":1
+            }
+
+        **Example response:**
+
+        .. sourcecode:: json
+
+            {
+                "jsonrpc":"2.0",
+                "id":1,
+                "result":{
+                    "values":[
+                        1234,
+                        32433
+                    ],
+                    "timestamp":1444132312.482,
+                    "age":0.125,
+                    "quality":"good"
+                }
+            }
+        """
+        backend, slave_id = self._route(int(slave_id), unit)
+
+        if backend.image is None or table not in coalesce.TABLES:
+            raise InvalidParams(data='No register image for table {0!r}.'
+                                .format(table))
+
+        return backend.image.snapshot(slave_id, coalesce.TABLES[table],
+                                      int(starting_address), int(quantity))
+
+    @rpcmethod
+    def subscribe(self, table, starting_address, quantity, interval,
+                  deadband=0, slave_id=1, unit=None):
+        """ Subscribe on changes of a range of addresses. Tolk polls the range
+        and pushes a `notify` notification over the client's connection when
+        a value has changed more than deadband. See
+        :mod:`tolk.subscriptions`.
+
+        :param table: Name of table, either `coils`, `discrete_inputs`,
+            `holding_registers` or `input_registers`.
+        :param starting_address: Number of starting address.
+        :param quantity: Number of values to watch.
+        :param interval: Number of seconds between polls.
+        :param deadband: Minimal change of a value to notify client, default
+            0.
+        :param slave_id: Number with Slave id, default 1.
+        :param unit: Name of unit to route request to, default None. See
+            :class:`tolk.routing.Router`.
+        :returns: JSON-RPC response with the id of the subscription.
+
+        **Example request:**
+
+        .. sourcecode:: json
+
+            {
+                "params":{
+                    "table":"holding_registers",
+                    "starting_address":100,
+                    "quantity":2,
+                    "interval":0.5,
+                    "deadband":10,
+                    "slave_id":1
+                },
+                "jsonrpc":"2.0",
+                "method":"subscribe",
+                "id":1
+            }
+
+        **Example response:**
+
+        .. sourcecode:: json
+
+            {
+                "jsonrpc":"2.0",
+                "id":1,
+                "result":3
+            }
+        """
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            raise InvalidRequest(data='Subscriptions require a persistent '
+                                      'connection.')
+
+        slave_id, interval = int(slave_id), float(interval)
+
+        if table not in coalesce.TABLES or interval <= 0:
+            raise InvalidParams(data='Invalid table or interval.')
+
+        # Fail early on requests which can't be routed.
+        self._route(slave_id, unit)
+
+        return self.subscriptions.subscribe(session, slave_id,
+                                            coalesce.TABLES[table],
+                                            int(starting_address),
+                                            int(quantity), interval,
+                                            float(deadband), unit)
+
+    @rpcmethod
+    def unsubscribe(self, subscription):
+        """ Cancel subscription of client.
+
+        :param subscription: Id of subscription.
+        :returns: JSON-RPC response with true when subscription has been
+            cancelled, or false when client has no such subscription.
+
+        **Example request:**
+
+        .. sourcecode:: json
+
+            {
+                "params":{
+                    "subscription":3
+                },
+                "jsonrpc":"2.0",
+                "method":"unsubscribe",
+                "id":1
+            }
+
+        **Example response:**
+
+        .. sourcecode:: json
+
+            {
+                "jsonrpc":"2.0",
+                "id":1,
+                "result":true
+            }
+        """
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            return False
+
+        return self.subscriptions.unsubscribe(int(subscription), session)
+
+    @rpcmethod
+    @json_rpc_error
+    def write_single_coil(self, address, value, slave_id=1,
+                          unit=None, priority=None):
         """ Execute Modbus function code 05: write value to single coil.
 
         :param address: Address of coil.
         :param value: Value to write to coil.
         :param slave_id: Number with Slave id, default 1.
+        :param unit: Name of unit to route request to, default None. See
+            :class:`tolk.routing.Router`.
+        :param priority: Priority on bus, either `high`, `normal` or `low`.
+            Default is `high`.
         :returns: JSON-RPC response containing the address and value that has been written.
 
         **Example request:**
@@ -223,18 +1358,23 @@ class Dispatcher(JsonRpc):
                 ]
             }
         """
-        return self.modbus_master.execute(int(slave_id), WRITE_SINGLE_COIL,
-                                          int(address), output_value=int(value))
+        return self._write(int(slave_id), WRITE_SINGLE_COIL, int(address),
+                           int(value), unit, priority)
 
     @rpcmethod
     @json_rpc_error
-    def write_single_register(self, address, value, slave_id=1):
+    def write_single_register(self, address, value, slave_id=1,
+                              unit=None, priority=None):
         """ Execute Modbus function code 06: write value to single holding
         register.
 
         :param address: Address of holding register.
         :param value: Value to write to holding register.
         :param slave_id: Number with Slave id, default 1.
+        :param unit: Name of unit to route request to, default None. See
+            :class:`tolk.routing.Router`.
+        :param priority: Priority on bus, either `high`, `normal` or `low`.
+            Default is `high`.
         :returns: JSON-RPC response containing the address and the value that has been written.
 
         **Example request:**
@@ -265,13 +1405,13 @@ class Dispatcher(JsonRpc):
                 ]
             }
         """
-        return self.modbus_master.execute(int(slave_id),
-                                          WRITE_SINGLE_REGISTER, int(address),
-                                          output_value=int(value))
+        return self._write(int(slave_id), WRITE_SINGLE_REGISTER,
+                           int(address), int(value), unit, priority)
 
     @rpcmethod
     @json_rpc_error
-    def write_multiple_coils(self, starting_address, values, slave_id=1):
+    def write_multiple_coils(self, starting_address, values, slave_id=1,
+                             unit=None, priority=None):
         """ Execute Modbus function code 15: write sequence of values to a
         contiguous block of coils.
 
@@ -283,6 +1423,10 @@ class Dispatcher(JsonRpc):
         :param starting_address: Number of starting address.
         :param values: List with values.
         :param slave_id: Number with Slave id, default 1.
+        :param unit: Name of unit to route request to, default None. See
+            :class:`tolk.routing.Router`.
+        :param priority: Priority on bus, either `high`, `normal` or `low`.
+            Default is `high`.
         :returns: JSON-RPC response containing the address and the number of coils that has been written.
 
         **Example request:**
@@ -314,14 +1458,13 @@ class Dispatcher(JsonRpc):
             }
         """
         values = [int(v) for v in values]
-        return self.modbus_master.execute(int(slave_id),
-                                          WRITE_MULTIPLE_COILS,
-                                          int(starting_address),
-                                          output_value=values)
+        return self._write(int(slave_id), WRITE_MULTIPLE_COILS,
+                           int(starting_address), values, unit, priority)
 
     @rpcmethod
     @json_rpc_error
-    def write_multiple_registers(self, starting_address, values, slave_id=1):
+    def write_multiple_registers(self, starting_address, values, slave_id=1,
+                                 unit=None, priority=None):
         """ Execute Modbus function code 16: write sequence of values to a
         contiguous block of holding registers.
 
@@ -333,6 +1476,10 @@ class Dispatcher(JsonRpc):
         :param starting_address: Number of starting address.
         :param values: List with values to write.
         :param slave_id: Number with Slave id, default 1.
+        :param unit: Name of unit to route request to, default None. See
+            :class:`tolk.routing.Router`.
+        :param priority: Priority on bus, either `high`, `normal` or `low`.
+            Default is `high`.
         :returns: JSON-RPC response containing the address and the number of values that has been written.
 
         **Example request:**
@@ -364,7 +1511,190 @@ class Dispatcher(JsonRpc):
             }
         """
         values = [int(v) for v in values]
-        return self.modbus_master.execute(int(slave_id),
-                                          WRITE_MULTIPLE_REGISTERS,
-                                          int(starting_address),
-                                          output_value=values)
+        return self._write(int(slave_id), WRITE_MULTIPLE_REGISTERS,
+                           int(starting_address), values, unit, priority)
+
+    @rpcmethod
+    @json_rpc_error
+    def write_multiple_registers_as(self, starting_address, values, dtype,
+                                    byte_order='big', word_order='big',
+                                    slave_id=1, unit=None, priority=None):
+        """ Encode values of a type and write them to a contiguous block of
+        holding registers. See :mod:`tolk.dtypes`.
+
+        :param starting_address: Number of starting address.
+        :param values: List with values to write, or a string when dtype is
+            `string`.
+        :param dtype: Name of type, see :meth:`read_holding_registers_as`.
+        :param byte_order: Order of bytes within a register, either `big` or
+            `little`. Default is `big`.
+        :param word_order: Order of registers within a value, either `big` or
+            `little`. Default is `big`.
+        :param slave_id: Number with Slave id, default 1.
+        :param unit: Name of unit to route request to, default None. See
+            :class:`tolk.routing.Router`.
+        :param priority: Priority on bus, either `high`, `normal` or `low`.
+            Default is `high`.
+        :returns: JSON-RPC response containing the address and the number of
+            registers that has been written.
+
+        **Example request:**
+
+        .. sourcecode:: json
+
+            {
+                "params":{
+                    "starting_address":100,
+                    "values":[21.5, -3.25],
+                    "dtype":"float32"
+                },
+                "jsonrpc":"2.0",
+                "method":"write_multiple_registers_as",
+                "id":1
+            }
+
+        **Example response:**
+
+        .. sourcecode:: json
+
+            {
+                "jsonrpc":"2.0",
+                "id":1,
+                "result":[
+                    100,
+                    4
+                ]
+            }
+        """
+        try:
+            registers = dtypes.encode(values, dtype, byte_order, word_order)
+        except (ValueError, TypeError) as e:
+            raise InvalidParams(data=str(e))
+
+        return self._write(int(slave_id), WRITE_MULTIPLE_REGISTERS,
+                           int(starting_address), registers, unit, priority)
+
+
+def error_response(error, id=None):
+    """ Return dictionary with JSON-RPC response of error.
+
+    :param error: Instance of :class:`pyjsonrpc.JsonRpcError`.
+    :param id: Id of request, default None.
+    """
+    response = {
+        'jsonrpc': '2.0',
+        'id': id,
+        'error': {'code': error.code, 'message': error.message},
+    }
+
+    if error.data:
+        response['error']['data'] = error.data
+
+    return response
+
+
+def get_read(request):
+    """ Return (read, unit) tuple with :class:`tolk.coalesce.Read` and unit
+    of JSON-RPC request, or None when request isn't a valid read request.
+
+    :param request: Dictionary with JSON-RPC request.
+    """
+    if not isinstance(request, dict):
+        return None
+
+    function_code = READ_METHODS.get(request.get('method'))
+    if function_code is None:
+        return None
+
+    params = request.get('params')
+    try:
+        if isinstance(params, list):
+            params = dict(zip(['starting_address', 'quantity', 'slave_id',
+                               'unit'], params))
+
+        read = coalesce.Read(int(params.get('slave_id', 1)), function_code,
+                             int(params['starting_address']),
+                             int(params['quantity']))
+
+        return read, params.get('unit')
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+def execute_all(calls, concurrency=1):
+    """ Call callables and return list with their results, in order. When
+    concurrency is larger than 1, up to that many callables are called at the
+    same time. When a call fails, the exception of the first failed call is
+    raised after all calls have finished.
+
+    Calls made by other threads are part of the trace of the calling
+    thread, see :mod:`tolk.tracing`.
+
+    :param calls: List with callables without arguments.
+    :param concurrency: Maximum number of concurrent calls, default 1.
+    """
+    if concurrency <= 1 or len(calls) == 1:
+        return [call() for call in calls]
+
+    results = [None] * len(calls)
+    errors = [None] * len(calls)
+    pending = iter(enumerate(calls))
+    lock = threading.Lock()
+    trace = tracing.current()
+
+    def work():
+        while True:
+            with lock:
+                try:
+                    i, call = next(pending)
+                except StopIteration:
+                    return
+
+            try:
+                results[i] = call()
+            except:
+                errors[i] = sys.exc_info()
+
+    def work_traced():
+        tracing.attach(trace)
+        try:
+            work()
+        finally:
+            tracing.attach(None)
+
+    threads = [threading.Thread(target=work_traced)
+               for _ in range(min(concurrency, len(calls)) - 1)]
+    for t in threads:
+        t.start()
+
+    work()
+
+    for t in threads:
+        t.join()
+
+    for error in errors:
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+    return results
+
+
+def get_written_values(function_code, output_value):
+    """ Return list with values as a slave stores them after a write request,
+    like a read request would return them.
+
+    :param function_code: Function code of write request.
+    :param output_value: Value, or list with values, of write request.
+    """
+    if function_code == WRITE_SINGLE_COIL:
+        return [int(output_value != 0)]
+
+    if function_code == WRITE_MULTIPLE_COILS:
+        return [int(v > 0) for v in output_value]
+
+    if function_code == WRITE_SINGLE_REGISTER:
+        output_value = [output_value]
+
+    # Negative values are written as signed integers, but read back as
+    # unsigned integers.
+    return [v & 0xFFFF for v in output_value]
@@ -0,0 +1,367 @@
+""" Metrics of requests and buses.
+
+A :class:`tolk.Dispatcher` counts requests and errors per method and records
+how long requests take. Every :class:`tolk.bus.Bus` counts transactions and
+errors per slave, records how long transactions wait for the bus and how long
+they occupy it, and tracks the utilization of the bus.
+
+The metrics are returned by the JSON-RPC method `get_metrics` and in the
+Prometheus text format by :func:`prometheus`, which
+:class:`tolk.http_handler.HTTPHandler` serves at `/metrics`.
+
+Latencies are recorded in histograms with fixed buckets, so recording costs a
+binary search and a few additions and can be left on in production.
+
+"""
+import math
+import time
+import threading
+from bisect import bisect_left
+
+from modbus_tk.modbus import ModbusError
+
+from tolk.exceptions import modbus_mapping
+
+#: Upper bounds of buckets of latency histograms, in seconds.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0)
+
+#: Number of seconds over which utilization of a bus is averaged.
+UTILIZATION_WINDOW = 60.0
+
+
+class Histogram(object):
+    """ Histogram with fixed buckets. Not thread safe.
+
+    :param bounds: Sorted sequence with upper bounds of buckets, default
+        :data:`BUCKETS`. Values above the last bound are counted in an extra
+        bucket.
+    """
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """ Record value. """
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """ Return estimate of quantile q, the upper bound of the bucket
+        which contains it. Returns None when histogram is empty and the last
+        bound when quantile is above it.
+        """
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+
+        return self.bounds[-1]
+
+    def snapshot(self):
+        """ Return dictionary with count, sum, estimates of 50th and 99th
+        percentile and cumulative counts per upper bound of bucket.
+        """
+        buckets = []
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            buckets.append([bound, total])
+
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'buckets': buckets,
+        }
+
+
+class Metrics(object):
+    """ Counts and latencies of requests per method. Thread safe. """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+        self.requests = {}
+        self.errors = {}
+        self.latency = {}
+        self.serialization = Histogram()
+
+    def observe_request(self, method, duration, error=None):
+        """ Record request.
+
+        :param method: Name of method.
+        :param duration: Number of seconds it took to execute method.
+        :param error: Exception raised by method, default None.
+        """
+        with self.lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+
+            histogram = self.latency.get(method)
+            if histogram is None:
+                histogram = self.latency[method] = Histogram()
+            histogram.observe(duration)
+
+            if error is not None:
+                key = (method, error_name(error))
+                self.errors[key] = self.errors.get(key, 0) + 1
+
+    def observe_serialization(self, duration):
+        """ Record time it took to decode request and encode response. """
+        with self.lock:
+            self.serialization.observe(duration)
+
+    def snapshot(self):
+        """ Return dictionary with metrics of methods. """
+        with self.lock:
+            methods = {}
+            for method, count in self.requests.items():
+                methods[method] = {
+                    'requests': count,
+                    'errors': {},
+                    'latency': self.latency[method].snapshot(),
+                }
+
+            for (method, name), count in self.errors.items():
+                methods[method]['errors'][name] = count
+
+            return {
+                'uptime': time.time() - self.started,
+                'methods': methods,
+                'serialization': self.serialization.snapshot(),
+            }
+
+
+class BusMetrics(object):
+    """ Counts and latencies of transactions on a bus. Thread safe.
+
+    :param capacity: Number of transactions the bus carries at a time,
+        default 1.
+    """
+    def __init__(self, capacity=1):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+
+        self.transactions = {}
+        self.errors = {}
+        self.latency = {}
+        self.queue_wait = Histogram()
+
+        self.busy = 0.0
+        # Busy time decayed exponentially over UTILIZATION_WINDOW.
+        self._recent_busy = 0.0
+        self._updated = time.time()
+
+    def observe(self, slave_id, wait, duration, error=None):
+        """ Record transaction.
+
+        :param slave_id: Number with slave id.
+        :param wait: Number of seconds transaction waited for bus.
+        :param duration: Number of seconds transaction occupied bus.
+        :param error: Exception raised by transaction, default None.
+        """
+        now = time.time()
+
+        with self.lock:
+            self.transactions[slave_id] = \
+                self.transactions.get(slave_id, 0) + 1
+
+            histogram = self.latency.get(slave_id)
+            if histogram is None:
+                histogram = self.latency[slave_id] = Histogram()
+            histogram.observe(duration)
+
+            self.queue_wait.observe(wait)
+
+            if error is not None:
+                key = (slave_id, error_name(error))
+                self.errors[key] = self.errors.get(key, 0) + 1
+
+            self.busy += duration
+            self._decay(now)
+            self._recent_busy += duration
+
+    def _decay(self, now):
+        """ Decay recent busy time. Must be called with lock held. """
+        elapsed = now - self._updated
+        if elapsed > 0:
+            self._recent_busy *= math.exp(-elapsed / UTILIZATION_WINDOW)
+            self._updated = now
+
+    def utilization(self):
+        """ Return percentage of time the bus has been busy, averaged over
+        about :data:`UTILIZATION_WINDOW` seconds.
+        """
+        with self.lock:
+            self._decay(time.time())
+            return min(100.0, 100.0 * self._recent_busy /
+                       (UTILIZATION_WINDOW * self.capacity))
+
+    def snapshot(self):
+        """ Return dictionary with metrics of bus. Slave ids are strings, so
+        the dictionary can be encoded as JSON.
+        """
+        utilization = self.utilization()
+
+        with self.lock:
+            slaves = {}
+            for slave_id, count in self.transactions.items():
+                slaves[str(slave_id)] = {
+                    'transactions': count,
+                    'errors': {},
+                    'latency': self.latency[slave_id].snapshot(),
+                }
+
+            for (slave_id, name), count in self.errors.items():
+                slaves[str(slave_id)]['errors'][name] = count
+
+            return {
+                'utilization': utilization,
+                'busy_seconds': self.busy,
+                'queue_wait': self.queue_wait.snapshot(),
+                'slaves': slaves,
+            }
+
+
+def error_name(error):
+    """ Return name of class of error. Modbus exceptions are named after
+    their JSON-RPC error in :mod:`tolk.exceptions`.
+    """
+    if isinstance(error, ModbusError):
+        cls = modbus_mapping.get(error.get_exception_code())
+        if cls is not None:
+            return cls.__name__
+
+    return type(error).__name__
+
+
+def prometheus(metrics):
+    """ Return string with metrics in the Prometheus text format.
+
+    :param metrics: Dictionary returned by JSON-RPC method `get_metrics`.
+    """
+    lines = []
+
+    def metric(name, kind, help, samples):
+        lines.append('# HELP {0} {1}'.format(name, help))
+        lines.append('# TYPE {0} {1}'.format(name, kind))
+        for suffix, labels, value in samples:
+            lines.append('{0}{1}{2} {3}'.format(name, suffix,
+                                                format_labels(labels),
+                                                format_value(value)))
+
+    def histogram(labels, snapshot):
+        samples = [('_bucket', labels + [('le', bound)], count)
+                   for bound, count in snapshot['buckets']]
+        samples.append(('_bucket', labels + [('le', '+Inf')],
+                        snapshot['count']))
+        samples.append(('_sum', labels, snapshot['sum']))
+        samples.append(('_count', labels, snapshot['count']))
+
+        return samples
+
+    methods = sorted(metrics['methods'].items())
+    backends = sorted(metrics['backends'].items())
+
+    metric('tolk_uptime_seconds', 'gauge', 'Number of seconds since start.',
+           [('', [], metrics['uptime'])])
+
+    metric('tolk_requests_total', 'counter', 'Number of requests.',
+           [('', [('method', m)], values['requests'])
+            for m, values in methods])
+
+    metric('tolk_errors_total', 'counter', 'Number of failed requests.',
+           [('', [('method', m), ('error', e)], count)
+            for m, values in methods
+            for e, count in sorted(values['errors'].items())])
+
+    metric('tolk_request_duration_seconds', 'histogram',
+           'Time to execute request.',
+           [s for m, values in methods
+            for s in histogram([('method', m)], values['latency'])])
+
+    metric('tolk_serialization_duration_seconds', 'histogram',
+           'Time to decode request and encode response.',
+           histogram([], metrics['serialization']))
+
+    metric('tolk_bus_utilization_percent', 'gauge',
+           'Percentage of time bus has been busy recently.',
+           [('', [('backend', b)], values['utilization'])
+            for b, values in backends])
+
+    metric('tolk_bus_busy_seconds_total', 'counter',
+           'Time bus has been busy.',
+           [('', [('backend', b)], values['busy_seconds'])
+            for b, values in backends])
+
+    metric('tolk_bus_queued', 'gauge',
+           'Number of transactions waiting for bus.',
+           [('', [('backend', b), ('priority', p)], count)
+            for b, values in backends
+            for p, count in sorted(values['queue']['queued'].items())])
+
+    metric('tolk_bus_dropped_total', 'counter',
+           'Number of transactions dropped because their deadline passed or '
+           'their client disconnected.',
+           [('', [('backend', b), ('priority', p)], count)
+            for b, values in backends
+            for p, count in sorted(values['queue']['dropped'].items())])
+
+    metric('tolk_bus_rejected_total', 'counter',
+           'Number of transactions rejected because the queue was full.',
+           [('', [('backend', b), ('priority', p)], count)
+            for b, values in backends
+            for p, count in sorted(values['queue']['rejected'].items())])
+
+    metric('tolk_bus_queue_wait_seconds', 'histogram',
+           'Time transaction waited for bus.',
+           [s for b, values in backends
+            for s in histogram([('backend', b)], values['queue_wait'])])
+
+    slaves = [(b, slave_id, values)
+              for b, backend in backends
+              for slave_id, values in sorted(backend['slaves'].items())]
+
+    metric('tolk_bus_transactions_total', 'counter',
+           'Number of Modbus transactions.',
+           [('', [('backend', b), ('slave', s)], values['transactions'])
+            for b, s, values in slaves])
+
+    metric('tolk_bus_errors_total', 'counter',
+           'Number of failed Modbus transactions.',
+           [('', [('backend', b), ('slave', s), ('error', e)], count)
+            for b, s, values in slaves
+            for e, count in sorted(values['errors'].items())])
+
+    metric('tolk_bus_transaction_duration_seconds', 'histogram',
+           'Time transaction occupied bus.',
+           [sample for b, s, values in slaves
+            for sample in histogram([('backend', b), ('slave', s)],
+                                    values['latency'])])
+
+    return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+
+    return '{' + ','.join('{0}="{1}"'.format(
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in labels) + '}'
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+
+    return str(value)
@@ -0,0 +1,398 @@
+""" Modbus TCP master with multiple outstanding transactions.
+
+Every Modbus TCP request carries a transaction id which the slave copies into
+its response. :class:`modbus_tk.modbus_tcp.TcpMaster` doesn't use it: it
+waits for every response before it sends the next request, so a link with a
+round trip of 100 ms never carries more than 10 transactions per second.
+
+:class:`PipelinedTcpMaster` keeps up to `window` requests in flight on a
+single connection and matches responses to requests by their transaction
+id::
+
+    master = PipelinedTcpMaster('10.0.0.1', 502, window=8)
+    dispatcher = Dispatcher(master)
+
+Not every device can handle more than one outstanding request. A window of 1
+gives strict request/response. The master falls back to a window of 1 by
+itself when the slave answers with unknown transaction ids, or when a request
+times out while other requests were outstanding. It tries its full window
+again after `recovery` seconds without such problems.
+
+"""
+import errno
+import socket
+import struct
+import threading
+import time
+from logbook import Logger
+from modbus_tk.defines import (READ_COILS, READ_DISCRETE_INPUTS,
+                               READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS,
+                               WRITE_SINGLE_COIL, WRITE_SINGLE_REGISTER,
+                               WRITE_MULTIPLE_COILS, WRITE_MULTIPLE_REGISTERS)
+from modbus_tk.modbus import (Master, ModbusError,
+                              ModbusFunctionNotSupportedError,
+                              ModbusInvalidResponseError)
+
+from tolk.bus import get_bus
+
+log = Logger(__name__)
+
+# Header of Modbus TCP frames: transaction id, protocol id, length and unit
+# id.
+MBAP = struct.Struct('>HHHB')
+
+
+def build_pdu(function_code, starting_address, quantity_of_x=0,
+              output_value=0):
+    """ Return PDU of request, encoded like
+    :meth:`modbus_tk.modbus.Master.execute` does.
+    """
+    if function_code in (READ_COILS, READ_DISCRETE_INPUTS,
+                         READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS):
+        return struct.pack('>BHH', function_code, starting_address,
+                           quantity_of_x)
+
+    if function_code == WRITE_SINGLE_COIL:
+        return struct.pack('>BHH', function_code, starting_address,
+                           0xFF00 if output_value != 0 else 0)
+
+    if function_code == WRITE_SINGLE_REGISTER:
+        fmt = '>BHh' if output_value < 0 else '>BHH'
+        return struct.pack(fmt, function_code, starting_address, output_value)
+
+    if function_code == WRITE_MULTIPLE_COILS:
+        data = bytearray((len(output_value) + 7) // 8)
+        for i, value in enumerate(output_value):
+            if value > 0:
+                data[i // 8] |= 1 << (i % 8)
+
+        return struct.pack('>BHHB', function_code, starting_address,
+                           len(output_value), len(data)) + str(data)
+
+    if function_code == WRITE_MULTIPLE_REGISTERS:
+        return struct.pack('>BHHB', function_code, starting_address,
+                           len(output_value), 2 * len(output_value)) + \
+            ''.join([struct.pack('>h' if v < 0 else '>H', v)
+                     for v in output_value])
+
+    raise ModbusFunctionNotSupportedError(
+        'The {0} function code is not supported.'.format(function_code))
+
+
+def parse_pdu(function_code, quantity_of_x, pdu):
+    """ Return tuple with result of response PDU, like
+    :meth:`modbus_tk.modbus.Master.execute` does.
+
+    :raises ModbusError: When slave responded with an exception.
+    :raises ModbusInvalidResponseError: When response doesn't match request.
+    """
+    if len(pdu) < 2:
+        raise ModbusInvalidResponseError(
+            'Response PDU is only {0} bytes.'.format(len(pdu)))
+
+    return_code, byte_2 = struct.unpack('>BB', pdu[:2])
+
+    if return_code == function_code | 0x80:
+        raise ModbusError(byte_2)
+
+    if return_code != function_code:
+        raise ModbusInvalidResponseError(
+            'Response has function code {0} instead of {1}.'
+            .format(return_code, function_code))
+
+    if function_code in (READ_COILS, READ_DISCRETE_INPUTS,
+                         READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS):
+        data = pdu[2:]
+        if byte_2 != len(data):
+            raise ModbusInvalidResponseError(
+                'Byte count is {0} while actual number of bytes is {1}.'
+                .format(byte_2, len(data)))
+
+        if function_code in (READ_COILS, READ_DISCRETE_INPUTS):
+            data = bytearray(data)
+            return tuple([(data[i // 8] >> (i % 8)) & 1
+                          for i in range(quantity_of_x)])
+
+        return struct.unpack('>{0}H'.format(len(data) // 2), data)
+
+    if len(pdu) != 5:
+        raise ModbusInvalidResponseError(
+            'Response PDU is {0} bytes instead of 5.'.format(len(pdu)))
+
+    return struct.unpack('>HH', pdu[1:5])
+
+
+class Transaction(object):
+    """ Request waiting for its response. """
+    def __init__(self, slave):
+        self.slave = slave
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class PipelinedTcpMaster(Master):
+    """ Modbus TCP master which keeps up to `window` requests in flight on a
+    single connection. :meth:`execute` can be called from many threads at
+    once.
+
+    :param host: Host of Modbus slave, default '127.0.0.1'.
+    :param port: Port of Modbus slave, default 502.
+    :param timeout_in_sec: Number of seconds to wait for a response, default
+        5.
+    :param window: Maximum number of outstanding requests, default 8.
+    """
+    #: Tells :class:`tolk.bus.Bus` it doesn't need to serialize transactions.
+    thread_safe = True
+
+    #: Number of seconds after falling back to a window of 1 before the full
+    #: window is tried again.
+    recovery = 60.0
+
+    #: Number of seconds after which the id of a request which timed out is
+    #: used again, when its response hasn't arrived by then.
+    abandoned_ttl = 60.0
+
+    def __init__(self, host='127.0.0.1', port=502, timeout_in_sec=5.0,
+                 window=8):
+        Master.__init__(self, timeout_in_sec)
+        self._host = host
+        self._port = port
+        self.window = window
+        self.max_window = window
+
+        # Time at which master fell back to a window of 1.
+        self._degraded = None
+
+        self._sock = None
+        self._cond = threading.Condition()
+        self._send_lock = threading.Lock()
+        self._transaction_id = 0
+
+        # Maps transaction ids to transactions waiting for a response.
+        self._pending = {}
+        # Maps transaction ids of requests which timed out to the time they
+        # timed out.
+        self._abandoned = {}
+
+    def _do_open(self):
+        self._sock = socket.create_connection((self._host, self._port),
+                                              self._timeout or None)
+        self._sock.settimeout(None)
+
+        reader = threading.Thread(target=self._receive, args=(self._sock,),
+                                  name='tolk-pipeline')
+        reader.daemon = True
+        reader.start()
+
+    def _do_close(self):
+        with self._cond:
+            sock, self._sock = self._sock, None
+            self._fail_pending(socket.error(errno.ECONNRESET,
+                                            'Connection has been closed.'))
+
+        if sock is not None:
+            close_socket(sock)
+
+    def execute(self, slave, function_code, starting_address, quantity_of_x=0,
+                output_value=0):
+        """ Execute Modbus request and return result. Accepts the same
+        arguments as :meth:`modbus_tk.modbus.Master.execute`, except for
+        `data_format` and `expected_length`.
+        """
+        pdu = build_pdu(function_code, starting_address, quantity_of_x,
+                        output_value)
+        transaction = Transaction(slave)
+        deadline = time.time() + self._timeout
+
+        with self._cond:
+            while len(self._pending) >= self.window:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise socket.timeout('Timed out waiting for window.')
+                self._cond.wait(remaining)
+
+            self.open()
+            sock = self._sock
+            transaction_id = self._next_transaction_id()
+
+            # Broadcasts don't have a response.
+            if slave != 0:
+                self._pending[transaction_id] = transaction
+
+        request = MBAP.pack(transaction_id, 0, len(pdu) + 1, slave) + pdu
+
+        try:
+            with self._send_lock:
+                sock.sendall(request)
+        except socket.error as e:
+            self._disconnect(sock, e)
+            raise
+
+        if slave == 0:
+            return None
+
+        transaction.done.wait(max(deadline - time.time(), 0))
+
+        if not transaction.done.is_set():
+            self._abandon(transaction_id)
+
+            if not transaction.done.is_set():
+                raise socket.timeout('Timed out waiting for response.')
+
+        if transaction.error is not None:
+            raise transaction.error
+
+        return parse_pdu(function_code, quantity_of_x, transaction.response)
+
+    def _next_transaction_id(self):
+        """ Return unused transaction id. Ids of requests which timed out
+        more than :attr:`abandoned_ttl` seconds ago are used again. Must be
+        called with lock held.
+
+        :raises socket.error: When all ids are in use.
+        """
+        expired = time.time() - self.abandoned_ttl
+
+        for _ in range(0x10000):
+            self._transaction_id = (self._transaction_id + 1) & 0xFFFF
+            transaction_id = self._transaction_id
+
+            if transaction_id in self._pending:
+                continue
+
+            if self._abandoned.get(transaction_id, expired) > expired:
+                continue
+
+            self._abandoned.pop(transaction_id, None)
+            return transaction_id
+
+        raise socket.error(errno.EAGAIN, 'All transaction ids are in use.')
+
+    def _abandon(self, transaction_id):
+        """ Stop waiting for response of transaction which timed out. """
+        with self._cond:
+            if self._pending.pop(transaction_id, None) is None:
+                # Response arrived just in time.
+                return
+
+            self._abandoned[transaction_id] = time.time()
+            self._cond.notify_all()
+
+            if self._pending:
+                self._degrade('request timed out while other requests were '
+                              'outstanding')
+
+    def _degrade(self, reason):
+        """ Fall back to strict request/response. Must be called with lock
+        held.
+        """
+        if self.max_window > 1:
+            self._degraded = time.time()
+
+        if self.window > 1:
+            log.warning('{0}:{1} {2}, fall back to a window of 1.'
+                        .format(self._host, self._port, reason))
+            self._resize(1)
+
+    def _recover(self):
+        """ Restore full window when master hasn't fallen back for
+        :attr:`recovery` seconds. Must be called with lock held.
+        """
+        if self._degraded is None or \
+                time.time() - self._degraded < self.recovery:
+            return
+
+        self._degraded = None
+        log.info('{0}:{1} restore window of {2}.'
+                 .format(self._host, self._port, self.max_window))
+        self._resize(self.max_window)
+        self._cond.notify_all()
+
+    def _resize(self, window):
+        """ Set window and the capacity of the bus of master. """
+        self.window = window
+        get_bus(self).resize(window)
+
+    def _receive(self, sock):
+        """ Receive responses from socket until it's closed. """
+        try:
+            while True:
+                header = recv_exactly(sock, MBAP.size)
+                transaction_id, _, length, unit_id = MBAP.unpack(header)
+                pdu = recv_exactly(sock, length - 1)
+
+                self._complete(transaction_id, unit_id, pdu)
+        except (socket.error, ValueError) as e:
+            self._disconnect(sock, e)
+
+    def _complete(self, transaction_id, unit_id, pdu):
+        with self._cond:
+            transaction = self._pending.pop(transaction_id, None)
+
+            if transaction is None:
+                if transaction_id in self._abandoned:
+                    del self._abandoned[transaction_id]
+                else:
+                    self._degrade('slave responded with unknown transaction '
+                                  'id {0}'.format(transaction_id))
+                return
+
+            self._recover()
+            self._cond.notify_all()
+
+        if unit_id != transaction.slave:
+            transaction.error = ModbusInvalidResponseError(
+                'Response is from unit {0} instead of {1}.'
+                .format(unit_id, transaction.slave))
+
+        transaction.response = pdu
+        transaction.done.set()
+
+    def _disconnect(self, sock, error):
+        """ Close socket and fail all outstanding requests. """
+        with self._cond:
+            if self._sock is not sock:
+                # Already closed.
+                return
+
+            self._sock = None
+            self._is_opened = False
+            self._fail_pending(error)
+
+        close_socket(sock)
+
+    def _fail_pending(self, error):
+        """ Fail outstanding requests. Must be called with lock held. """
+        for transaction in self._pending.values():
+            transaction.error = error
+            transaction.done.set()
+
+        self._pending.clear()
+        self._abandoned.clear()
+        self._cond.notify_all()
+
+
+def recv_exactly(sock, size):
+    """ Receive exactly size bytes from socket.
+
+    :raises socket.error: When connection has been closed.
+    """
+    data = ''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise socket.error(errno.ECONNRESET,
+                               'Connection closed by slave.')
+        data += chunk
+
+    return data
+
+
+def close_socket(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+        pass
+
+    sock.close()
@@ -0,0 +1,237 @@
+""" Named points which map tags to registers and coils.
+
+Integrators think in tags, like `AHU1.supply_temp`, rather than in slave ids
+and addresses. A :class:`PointMap` defines where every point lives and how
+its registers are decoded::
+
+    points = PointMap([
+        Point('AHU1.supply_temp', 'holding_registers', 100, slave_id=3,
+              dtype='float32'),
+        Point('AHU1.fan_speed', 'holding_registers', 104, slave_id=3,
+              scale=0.1),
+    ])
+
+A set of points is turned into the minimal number of Modbus requests. Points
+which are at most `max_gap` addresses apart are read with a single request,
+as long as it doesn't exceed the maximum quantity of the protocol. The plan
+of every unique set of points is computed once and reused::
+
+    >>> points.plan(['AHU1.supply_temp', 'AHU1.fan_speed'])
+    [(None, Read(slave_id=3, function_code=3, starting_address=100,
+                 quantity=5),
+      [(0, Point(name='AHU1.supply_temp', ...)),
+       (4, Point(name='AHU1.fan_speed', ...))])]
+
+"""
+import json
+import threading
+from bisect import bisect_right
+from collections import namedtuple
+
+from modbus_tk.defines import READ_COILS, READ_DISCRETE_INPUTS
+from tolk import coalesce, dtypes
+from tolk.cache import LRU
+
+_Point = namedtuple('Point', ['name', 'table', 'address', 'slave_id', 'unit',
+                              'dtype', 'byte_order', 'word_order', 'scale',
+                              'length'])
+
+
+class Point(_Point):
+    """ Point with a name at an address.
+
+    :param name: Name of point.
+    :param table: Name of table, one of `coils`, `discrete_inputs`,
+        `holding_registers` or `input_registers`.
+    :param address: Number of address of point.
+    :param slave_id: Number of slave id, default 1.
+    :param unit: Name of unit or backend of point, default None. See
+        :class:`tolk.routing.Router`.
+    :param dtype: Type of registers, default `uint16`. See
+        :mod:`tolk.dtypes`. Ignored for coils and discrete inputs.
+    :param byte_order: Order of bytes within a register, default `big`.
+    :param word_order: Order of registers within a value, default `big`.
+    :param scale: Number with which value is multiplied, default 1.
+    :param length: Number of characters of a point with dtype `string`,
+        default 2.
+    :raises ValueError: When point isn't valid.
+    """
+    __slots__ = ()
+
+    def __new__(cls, name, table, address, slave_id=1, unit=None,
+                dtype='uint16', byte_order='big', word_order='big', scale=1,
+                length=2):
+        if table not in coalesce.TABLES:
+            raise ValueError('Point {0!r} has unknown table {1!r}.'
+                             .format(name, table))
+
+        dtypes.check(dtype, byte_order, word_order)
+
+        return _Point.__new__(cls, name, table, address, slave_id, unit,
+                              dtype, byte_order, word_order, scale, length)
+
+    @property
+    def read(self):
+        """ :class:`tolk.coalesce.Read` which covers point. """
+        function_code = coalesce.TABLES[self.table]
+        quantity = 1
+
+        if function_code not in (READ_COILS, READ_DISCRETE_INPUTS):
+            quantity = dtypes.register_count(
+                self.dtype, self.length if self.dtype == 'string' else 1)
+
+        return coalesce.Read(self.slave_id, function_code, self.address,
+                             quantity)
+
+    def decode(self, values):
+        """ Return value of point from values of its read, or None when it's
+        a float which is NaN or infinite.
+        """
+        if self.table in ('coils', 'discrete_inputs'):
+            return values[0]
+
+        value = dtypes.decode(values, self.dtype, self.byte_order,
+                              self.word_order)
+
+        if self.dtype == 'string':
+            return value
+
+        if self.scale != 1 and value[0] is not None:
+            return value[0] * self.scale
+
+        return value[0]
+
+
+class PointMap(object):
+    """ Index of points by name which plans reads of sets of points.
+
+    :param points: Iterable with :class:`Point` instances.
+    :param max_gap: Maximum number of unrequested addresses between 2 points
+        for them to be read with a single request, default 10.
+    :param max_plans: Maximum number of plans to remember, default 1024.
+    :raises ValueError: When names of points aren't unique.
+    """
+    def __init__(self, points, max_gap=10, max_plans=1024):
+        self.max_gap = max_gap
+        self.points = {}
+
+        for point in points:
+            if point.name in self.points:
+                raise ValueError('Point {0!r} is defined twice.'
+                                 .format(point.name))
+
+            self.points[point.name] = point
+
+        # Reads of points are computed once, rather than for every plan.
+        self._reads = dict((name, point.read)
+                           for name, point in self.points.items())
+
+        self._plans = LRU(max_plans)
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        return self.points[name]
+
+    def __contains__(self, name):
+        return name in self.points
+
+    def __len__(self):
+        return len(self.points)
+
+    def plan(self, names):
+        """ Return list with (unit, frame, [(offset, point), ...]) tuples.
+        Every frame is a :class:`tolk.coalesce.Read` which covers its points,
+        the offset is the position of the first value of a point in the
+        result of the frame.
+
+        :param names: Iterable with names of points.
+        :raises KeyError: When a point doesn't exist.
+        """
+        key = frozenset(names)
+
+        with self._lock:
+            plan = self._plans.get(key)
+
+        if plan is None:
+            plan = self._compile(key)
+
+            with self._lock:
+                self._plans.set(key, plan)
+
+        return plan
+
+    def _compile(self, names):
+        units = {}
+        for name in names:
+            if name not in self.points:
+                raise KeyError(name)
+
+            units.setdefault(self.points[name].unit, []).append(name)
+
+        plan = []
+        for unit, unit_names in sorted(units.items()):
+            frames = coalesce.plan([self._reads[name] for name in unit_names],
+                                   self.max_gap)
+            groups = dict((frame, []) for frame in frames)
+
+            # Reads are merged into frames in order of address, so a point
+            # belongs to the last frame which starts at or before it.
+            starts = {}
+            for frame in frames:
+                starts.setdefault(frame[:2], []).append(frame)
+
+            for name in unit_names:
+                read = self._reads[name]
+                candidates = starts[read[:2]]
+                frame = candidates[bisect_right(
+                    [f.starting_address for f in candidates],
+                    read.starting_address) - 1]
+
+                groups[frame].append(
+                    (read.starting_address - frame.starting_address,
+                     self.points[name]))
+
+            plan.extend((unit, frame, sorted(groups[frame]))
+                        for frame in frames)
+
+        return plan
+
+
+def load_points(path, max_gap=10):
+    """ Return :class:`PointMap` defined in a JSON file. The file contains a
+    dictionary which maps names of points to their definition::
+
+        {
+            "AHU1.supply_temp": {
+                "unit": "gateway-1",
+                "slave_id": 3,
+                "table": "holding_registers",
+                "address": 100,
+                "dtype": "float32",
+                "word_order": "little"
+            },
+            "AHU1.fan_speed": {
+                "slave_id": 3,
+                "table": "holding_registers",
+                "address": 104,
+                "scale": 0.1
+            }
+        }
+
+    Only `table` and `address` are required. See :class:`Point` for the
+    options of a point.
+
+    :param path: Path of JSON file.
+    :param max_gap: See :class:`PointMap`.
+    """
+    with open(path) as f:
+        config = json.load(f)
+
+    return PointMap([Point(name, str(point['table']), int(point['address']),
+                           int(point.get('slave_id', 1)), point.get('unit'),
+                           str(point.get('dtype', 'uint16')),
+                           str(point.get('byte_order', 'big')),
+                           str(point.get('word_order', 'big')),
+                           point.get('scale', 1),
+                           int(point.get('length', 2)))
+                     for name, point in config.items()], max_gap)
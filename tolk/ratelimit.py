@@ -0,0 +1,95 @@
+""" Rate limits per client.
+
+A single client which polls too often can fill the queue of a bus and starve
+all other clients. A :class:`RateLimiter` gives every client a token bucket:
+a request takes a token, and tokens are refilled at a fixed rate up to a
+maximum burst::
+
+    limiter = RateLimiter(rate=20, burst=50)
+
+    retry_after = limiter.take(session.peer)
+    if retry_after:
+        raise server_busy(retry_after)
+
+"""
+import time
+import threading
+
+
+class TokenBucket(object):
+    """ Bucket which is refilled with `rate` tokens per second, up to `burst`
+    tokens.
+
+    :param rate: Number of tokens added per second.
+    :param burst: Maximum number of tokens.
+    """
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+
+    def take(self, n=1):
+        """ Take n tokens when they are available.
+
+        Taking more tokens than the burst is allowed when the bucket is
+        full. The bucket runs into debt then, which is paid off by refills.
+
+        :param n: Number of tokens, default 1.
+        :returns: 0 when tokens have been taken, otherwise the number of
+            seconds after which they're available.
+        """
+        now = time.time()
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate,
+                          self.burst)
+        self.updated = now
+
+        needed = min(n, self.burst)
+        if self.tokens >= needed:
+            self.tokens -= n
+            return 0
+
+        return (needed - self.tokens) / self.rate
+
+    @property
+    def full(self):
+        """ Whether bucket has been refilled completely. """
+        return self.tokens + (time.time() - self.updated) * self.rate >= \
+            self.burst
+
+
+class RateLimiter(object):
+    """ Token bucket per client.
+
+    :param rate: Number of requests per second every client may make.
+    :param burst: Number of requests a client may make at once, default
+        `rate`.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = max(burst or rate, 1)
+
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def take(self, client, n=1):
+        """ Take n tokens from bucket of client.
+
+        :param client: Hashable identifying the client.
+        :param n: Number of requests, default 1.
+        :returns: 0 when requests are allowed, otherwise the number of
+            seconds after which client may retry.
+        """
+        with self.lock:
+            bucket = self.buckets.get(client)
+            if bucket is None:
+                if len(self.buckets) > 1000:
+                    # Forget clients which are idle.
+                    self.buckets = dict((c, b)
+                                        for c, b in self.buckets.items()
+                                        if not b.full)
+
+                bucket = self.buckets[client] = TokenBucket(self.rate,
+                                                            self.burst)
+
+            return bucket.take(n)
@@ -0,0 +1,433 @@
+""" Event-driven server which multiplexes many connections in one thread.
+
+:class:`tolk.server.ThreadPoolUnixStreamServer` occupies a thread for every
+open connection, which is costly when many clients keep idle connections
+open. :class:`ReactorServer` waits for all connections in a single event loop
+using :func:`select.epoll` or :func:`select.poll`. Only complete messages are
+handed to a small pool of worker threads, which call the blocking
+:class:`tolk.Dispatcher`::
+
+    from modbus_tk.modbus_tcp import TcpMaster
+
+    from tolk import Dispatcher
+    from tolk.reactor import ReactorServer
+
+    server = ReactorServer('/tmp/tolk.sock', Dispatcher(TcpMaster()),
+                           workers=8)
+    server.serve_forever()
+
+Messages of a connection are dispatched one after another, so responses are
+sent in the order the requests came in. A client which sends requests faster
+than they're dispatched, or which doesn't read its responses, isn't read
+from until its queue of requests and responses has drained below
+`max_pending` messages and `max_outbuf` bytes. Notifications aren't held
+back, so a client which still has `max_outbuf` bytes waiting when it's
+notified is disconnected.
+
+A client which shuts down its side of the connection still gets responses to
+the requests it has sent. When the connection hangs up or fails, requests
+which haven't been dispatched are dropped and the one being dispatched is
+cancelled while it waits for the bus.
+
+"""
+import os
+import errno
+import fcntl
+import select
+import socket
+import threading
+from Queue import Queue
+from collections import deque
+from logbook import Logger
+
+from tolk.framing import Negotiator
+from tolk.server import share_workers
+from tolk.session import Session, SessionClosed, get_peer
+
+log = Logger(__name__)
+
+READ = select.POLLIN | select.POLLPRI
+WRITE = select.POLLOUT
+ERROR = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+
+class WorkerPool(object):
+    """ Run callables in a fixed number of threads.
+
+    :param workers: Number of threads.
+    """
+    def __init__(self, workers):
+        self.queue = Queue()
+        self.threads = []
+
+        for i in range(workers):
+            t = threading.Thread(target=self._work,
+                                 name='tolk-worker-{0}'.format(i))
+            t.daemon = True
+            t.start()
+
+            self.threads.append(t)
+
+    def submit(self, func, *args):
+        """ Queue func for execution by one of the workers. """
+        self.queue.put((func, args))
+
+    def _work(self):
+        while True:
+            func, args = self.queue.get()
+
+            if func is None:
+                return
+
+            try:
+                func(*args)
+            except:
+                log.exception('Worker failed to execute {0}.'.format(func))
+
+    def close(self):
+        """ Stop workers after they've finished queued work. """
+        for _ in self.threads:
+            self.queue.put((None, None))
+
+
+class Poller(object):
+    """ Thin wrapper around :func:`select.epoll` or :func:`select.poll`. Both
+    use the same event masks, but epoll expects timeouts in seconds and poll
+    in milliseconds.
+    """
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self._poller = select.epoll()
+            self._scale = 1
+        else:
+            self._poller = select.poll()
+            self._scale = 1000
+
+    def register(self, fd, mask):
+        self._poller.register(fd, mask)
+
+    def modify(self, fd, mask):
+        self._poller.modify(fd, mask)
+
+    def unregister(self, fd):
+        self._poller.unregister(fd)
+
+    def poll(self, timeout):
+        """ Return list with (fd, event) tuples. """
+        try:
+            return self._poller.poll(timeout * self._scale)
+        except (IOError, OSError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+    def close(self):
+        if hasattr(self._poller, 'close'):
+            self._poller.close()
+
+
+class Connection(object):
+    """ State of a single client connection.
+
+    :param sock: Socket of connection.
+    :param send: Callable which queues a message for sending, used by
+        :attr:`session`.
+    :param peer: Hashable which identifies client, default None. See
+        :func:`tolk.session.get_peer`.
+    """
+    def __init__(self, sock, send, peer=None):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.framer = Negotiator(self._negotiated)
+        self.session = Session(lambda msg: send(self, msg), peer=peer)
+
+        # Messages waiting to be dispatched.
+        self.pending = deque()
+        # Bytes waiting to be sent.
+        self.outbuf = ''
+        # Whether a worker is dispatching a message of this connection.
+        self.busy = False
+        # Whether client has shut down its side of the connection, so
+        # connection should be closed when pending messages have been
+        # dispatched and outbuf has been sent.
+        self.closing = False
+
+    def _negotiated(self, codec, preamble):
+        self.session.codec = codec
+        self.outbuf += preamble
+
+
+class ReactorServer(object):
+    """ Server which waits for all connections in a single thread and
+    dispatches requests in a pool of worker threads.
+
+    :param server_address: Path of Unix Domain Socket or (host, port) tuple.
+    :param dispatcher: Instance of :class:`tolk.Dispatcher`.
+    :param workers: Number of requests to dispatch concurrently, default 8.
+    :param family: Address family, default :data:`socket.AF_UNIX`.
+    """
+    #: Maximum number of bytes to read from socket at once.
+    buffer_size = 4096
+
+    #: Number of connections the OS may queue before they're accepted.
+    request_queue_size = 128
+
+    #: Number of messages of a connection waiting to be dispatched above
+    #: which the connection isn't read from.
+    max_pending = 64
+
+    #: Number of bytes waiting to be sent to a connection above which the
+    #: connection isn't read from.
+    max_outbuf = 1024 * 1024
+
+    def __init__(self, server_address, dispatcher, workers=8,
+                 family=socket.AF_UNIX):
+        self.dispatcher = dispatcher
+        self.family = family
+
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        if family != socket.AF_UNIX:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(server_address)
+        self.socket.listen(self.request_queue_size)
+        self.socket.setblocking(False)
+        self.server_address = self.socket.getsockname()
+
+        self.pool = WorkerPool(workers)
+        share_workers(dispatcher, workers)
+        self.poller = Poller()
+        self.poller.register(self.socket.fileno(), READ)
+
+        # Workers write to this pipe to wake up the event loop when they've
+        # finished a message.
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        for fd in (self._wakeup_r, self._wakeup_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.poller.register(self._wakeup_r, READ)
+        self._done = deque()
+        self._outgoing = deque()
+
+        self.connections = {}
+
+        self._shutdown_request = False
+        self._stopped = threading.Event()
+        self._stopped.set()
+
+    def serve_forever(self, poll_interval=0.5):
+        """ Run event loop until :meth:`shutdown` is called. """
+        self._stopped.clear()
+
+        try:
+            while not self._shutdown_request:
+                for fd, event in self.poller.poll(poll_interval):
+                    if fd == self.socket.fileno():
+                        self._accept()
+                    elif fd == self._wakeup_r:
+                        self._drain_wakeup()
+                    elif fd in self.connections:
+                        self._handle_event(self.connections[fd], event)
+
+                self._process_done()
+        finally:
+            self._shutdown_request = False
+            self._stopped.set()
+
+    def shutdown(self):
+        """ Stop event loop and wait until it has stopped. When the event loop
+        hasn't been started yet, it stops immediately once it is started.
+        """
+        self._shutdown_request = True
+        self._wakeup()
+        self._stopped.wait()
+
+    def server_close(self):
+        """ Close all connections, the listening socket and the workers. """
+        for conn in list(self.connections.values()):
+            self._close(conn)
+
+        self.poller.close()
+        self.socket.close()
+        self.pool.close()
+
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_w, 'x')
+        except OSError:
+            # Pipe is full, so event loop wakes up anyway.
+            pass
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except OSError:
+            pass
+
+    def _accept(self):
+        while True:
+            try:
+                sock, address = self.socket.accept()
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                raise
+
+            sock.setblocking(False)
+            if self.family != socket.AF_UNIX:
+                # Don't delay small responses.
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            conn = Connection(sock, self._send, get_peer(sock, address))
+            self.connections[conn.fd] = conn
+            self.poller.register(conn.fd, READ)
+
+    def _handle_event(self, conn, event):
+        if event & READ:
+            self._read(conn)
+
+        if event & WRITE and self._is_open(conn):
+            self._write(conn)
+
+        if event & ERROR and not event & READ:
+            # Connection hung up or failed. Closing it closes the session,
+            # so requests which haven't been dispatched are dropped and the
+            # one being dispatched is cancelled.
+            self._close(conn)
+
+    def _is_open(self, conn):
+        return self.connections.get(conn.fd) is conn
+
+    def _read(self, conn):
+        try:
+            data = conn.sock.recv(self.buffer_size)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            # Connection has failed, for instance because it was reset.
+            self._close(conn)
+            return
+
+        if not data:
+            # Client won't send more requests, but it may still be waiting
+            # for the responses to the ones it has sent. Closing the
+            # connection is left to a hangup or failure, see
+            # :meth:`_handle_event`.
+            conn.closing = True
+            self._update(conn)
+            return
+
+        try:
+            conn.pending.extend(conn.framer.feed(data))
+        except ValueError as e:
+            log.error('Close connection: {0}'.format(e))
+            self._close(conn)
+            return
+
+        self._dispatch_next(conn)
+
+    def _write(self, conn):
+        try:
+            sent = conn.sock.send(conn.outbuf)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            if e.errno == errno.EPIPE:
+                log.error('[Errno {0}]: Reactor could not send response to '
+                          'client.'.format(errno.EPIPE))
+            self._close(conn)
+            return
+
+        conn.outbuf = conn.outbuf[sent:]
+        self._update(conn)
+
+    def _update(self, conn):
+        """ Close connection when it is done, otherwise register events the
+        connection is interested in.
+        """
+        if conn.closing and not conn.busy and not conn.pending and \
+                not conn.outbuf:
+            self._close(conn)
+            return
+
+        mask = READ
+        if conn.closing or len(conn.pending) >= self.max_pending or \
+                len(conn.outbuf) >= self.max_outbuf:
+            # Backpressure: bytes stay in the socket buffer of the OS until
+            # the connection has caught up.
+            mask = 0
+
+        if conn.outbuf:
+            mask |= WRITE
+
+        self.poller.modify(conn.fd, mask)
+
+    def _close(self, conn):
+        if not self._is_open(conn):
+            return
+
+        del self.connections[conn.fd]
+        self.poller.unregister(conn.fd)
+        conn.sock.close()
+        conn.session.close()
+
+    def _dispatch_next(self, conn):
+        if conn.busy or not conn.pending:
+            self._update(conn)
+            return
+
+        conn.busy = True
+        self.pool.submit(self._dispatch, conn, conn.pending.popleft())
+        self._update(conn)
+
+    def _dispatch(self, conn, msg):
+        """ Dispatch message. Called from a worker thread. """
+        resp = None
+        try:
+            log.debug('<-- {0}'.format(msg))
+            resp = self.dispatcher.call(msg, conn.session)
+            log.debug('--> {0}'.format(resp))
+        finally:
+            self._done.append((conn, resp))
+            self._wakeup()
+
+    def _send(self, conn, msg):
+        """ Queue message for sending to connection. Can be called from any
+        thread.
+        """
+        if not self._is_open(conn):
+            raise SessionClosed('Connection has been closed.')
+
+        self._outgoing.append((conn, msg))
+        self._wakeup()
+
+    def _process_done(self):
+        while self._outgoing:
+            conn, msg = self._outgoing.popleft()
+
+            if not self._is_open(conn):
+                continue
+
+            if len(conn.outbuf) >= self.max_outbuf:
+                # Client doesn't read its notifications.
+                log.error('Close connection: client falls behind.')
+                self._close(conn)
+                continue
+
+            conn.outbuf += conn.framer.encode(msg)
+            self._update(conn)
+
+        while self._done:
+            conn, resp = self._done.popleft()
+            conn.busy = False
+
+            if not self._is_open(conn):
+                continue
+
+            if resp is not None:
+                conn.outbuf += conn.framer.encode(resp)
+
+            self._dispatch_next(conn)
@@ -0,0 +1,209 @@
+""" Routing of requests to multiple Modbus masters.
+
+A single Tolk process can front many Modbus gateways and serial lines. A
+:class:`Router` maps every request to a named :class:`Backend`, either by the
+slave id of the request or by the `unit` parameter every method of
+:class:`tolk.Dispatcher` accepts::
+
+    router = Router({
+        'gateway-1': Backend(TcpMaster('10.0.0.1', 502)),
+        'gateway-2': Backend(TcpMaster('10.0.0.2', 502)),
+    }, routes=[(1, 31, 'gateway-1'), (32, 63, 'gateway-2')])
+
+    dispatcher = Dispatcher(router=router)
+
+Every backend has its own :class:`tolk.bus.Bus`, so requests to different
+backends are executed in parallel while requests to the same backend never
+interleave.
+
+"""
+import json
+
+from modbus_tk.modbus_tcp import TcpMaster
+
+from tolk.bus import get_bus
+from tolk.exceptions import DeadlineExceeded
+from tolk.pipeline import PipelinedTcpMaster
+from tolk.singleflight import SingleFlight
+
+
+class NoRoute(LookupError):
+    """ Raised when no backend has been found for a request. """
+    pass
+
+
+class Backend(object):
+    """ Modbus master with its own bus, cache and register image.
+
+    :param modbus_master: Instance of :class:`modbus_tk.modbus.Master`.
+    :param cache: Instance of :class:`tolk.cache.RegisterCache`, default None.
+    :param image: Instance of :class:`tolk.scanner.RegisterImage`, default
+        None.
+    """
+    def __init__(self, modbus_master, cache=None, image=None):
+        self.modbus_master = modbus_master
+        self.bus = get_bus(modbus_master)
+        self.cache = cache
+        self.image = image
+
+        # Reads in flight are shared per backend, because the same slave id
+        # can exist on different backends. A read which is dropped because
+        # of the deadline or disconnect of its client is retried by the
+        # clients which share it.
+        self.in_flight = SingleFlight(retry=DeadlineExceeded)
+
+
+class Router(object):
+    """ Map requests to backends.
+
+    A request with a `unit` is routed to the unit's backend. Other requests
+    are routed by slave id. Requests which don't match a route are routed to
+    the default backend.
+
+    :param backends: Dictionary which maps names to :class:`Backend`
+        instances.
+    :param routes: List with (first_slave_id, last_slave_id, backend_name)
+        tuples. The range of slave ids is inclusive.
+    :param units: Dictionary which maps names of units to a
+        (backend_name, slave_id) tuple. A slave id of None means the slave id
+        of the request is used. Names of backends are valid units too.
+    :param default: Name of default backend, default None. When there's only
+        one backend it is the default.
+    """
+    def __init__(self, backends, routes=(), units=None, default=None):
+        self.backends = dict(backends)
+        self.routes = list(routes)
+        self.units = dict(units or {})
+
+        if default is None and len(self.backends) == 1:
+            default = list(self.backends)[0]
+
+        self.default = default
+
+        names = [name for _, _, name in self.routes] + \
+            [name for name, _ in self.units.values()]
+
+        if default is not None:
+            names.append(default)
+
+        for name in names:
+            if name not in self.backends:
+                raise ValueError('Unknown backend {0!r}.'.format(name))
+
+    def route(self, slave_id, unit=None):
+        """ Return (backend, slave_id) tuple of request.
+
+        :param slave_id: Number with slave id of request.
+        :param unit: Name of unit of request, default None.
+        :raises NoRoute: When request can't be routed.
+        """
+        if unit is not None:
+            if unit in self.units:
+                name, unit_slave_id = self.units[unit]
+                if unit_slave_id is not None:
+                    slave_id = unit_slave_id
+            elif unit in self.backends:
+                name = unit
+            else:
+                raise NoRoute('Unknown unit {0!r}.'.format(unit))
+
+            return self.backends[name], slave_id
+
+        for first, last, name in self.routes:
+            if first <= slave_id <= last:
+                return self.backends[name], slave_id
+
+        if self.default is None:
+            raise NoRoute('No route to slave {0}.'.format(slave_id))
+
+        return self.backends[self.default], slave_id
+
+    def __iter__(self):
+        """ Iterate over (name, backend) tuples. """
+        return iter(sorted(self.backends.items()))
+
+
+def create_master(config):
+    """ Return Modbus master defined by dictionary. A TCP master is defined
+    by a `host` and a `port`, an RTU master by the path of its
+    `serial_port`, and optionally its `baudrate`, `bytesize`, `parity` and
+    `stopbits`. Both accept a `timeout` in seconds.
+
+    A TCP master with a `window` larger than 1 is a
+    :class:`tolk.pipeline.PipelinedTcpMaster` which keeps that many requests
+    in flight.
+
+    RTU masters require pyserial.
+    """
+    if 'serial_port' in config:
+        import serial
+        from modbus_tk.modbus_rtu import RtuMaster
+
+        master = RtuMaster(serial.Serial(
+            port=config['serial_port'],
+            baudrate=int(config.get('baudrate', 19200)),
+            bytesize=int(config.get('bytesize', 8)),
+            parity=str(config.get('parity', 'N')),
+            stopbits=int(config.get('stopbits', 1))))
+    elif int(config.get('window', 1)) > 1:
+        master = PipelinedTcpMaster(str(config.get('host', 'localhost')),
+                                    int(config.get('port', 502)),
+                                    window=int(config['window']))
+    else:
+        master = TcpMaster(str(config.get('host', 'localhost')),
+                           int(config.get('port', 502)))
+
+    if 'timeout' in config:
+        master.set_timeout(float(config['timeout']))
+
+    return master
+
+
+def load_router(path):
+    """ Return :class:`Router` defined in a JSON file::
+
+        {
+            "backends": {
+                "gateway-1": {"host": "10.0.0.1", "port": 502, "window": 8},
+                "line-1": {"serial_port": "/dev/ttyUSB0", "baudrate": 9600,
+                           "max_queue": 50, "max_queue_wait": 2}
+            },
+            "routes": [
+                {"slave_ids": [1, 31], "backend": "gateway-1"},
+                {"slave_ids": [32, 63], "backend": "line-1"}
+            ],
+            "units": {
+                "boiler": {"backend": "gateway-1", "slave_id": 3}
+            },
+            "default": "gateway-1"
+        }
+
+    Only `backends` is required. See :func:`create_master` for the options
+    of a backend. A backend can bound the queue of its bus with `max_queue`
+    and `max_queue_wait`, see :class:`tolk.scheduler.Scheduler`.
+
+    :param path: Path of JSON file.
+    """
+    with open(path) as f:
+        config = json.load(f)
+
+    backends = {}
+    for name, options in config['backends'].items():
+        backend = backends[name] = Backend(create_master(options))
+
+        scheduler = backend.bus.scheduler
+        if 'max_queue' in options:
+            scheduler.max_queue = int(options['max_queue'])
+        if 'max_queue_wait' in options:
+            scheduler.max_queue_wait = float(options['max_queue_wait'])
+
+    routes = [(int(route['slave_ids'][0]), int(route['slave_ids'][1]),
+               route['backend']) for route in config.get('routes', [])]
+
+    units = {}
+    for name, unit in config.get('units', {}).items():
+        slave_id = unit.get('slave_id')
+        units[name] = (unit['backend'],
+                       None if slave_id is None else int(slave_id))
+
+    return Router(backends, routes, units, config.get('default'))
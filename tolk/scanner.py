@@ -0,0 +1,331 @@
+""" Background scanning of registers into an in-memory image.
+
+A :class:`Scanner` continuously reads a configured set of scan groups from the
+bus and stores the values in a :class:`RegisterImage`. A
+:class:`tolk.Dispatcher` with that image answers reads of scanned addresses
+from memory instead of waiting for the bus::
+
+    from modbus_tk.defines import READ_HOLDING_REGISTERS
+
+    image = RegisterImage()
+    scanner = Scanner(get_bus(modbus_master), [
+        ScanGroup(1, READ_HOLDING_REGISTERS, 100, 10, interval=1),
+        ScanGroup(1, READ_HOLDING_REGISTERS, 112, 4, interval=1),
+    ], image)
+    scanner.start()
+
+    dispatcher = Dispatcher(modbus_master, image=image)
+
+Scan groups with the same interval are merged into as few Modbus requests as
+possible, see :mod:`tolk.coalesce`. Groups larger than the protocol allows
+are split. When a merged request fails with an exception response, for
+instance because an address between 2 groups doesn't exist, its groups are
+scanned one by one from then on. The requests are spread evenly over the
+interval so the bus isn't saturated by bursts. Scans have a low priority on
+the bus, see :mod:`tolk.scheduler`.
+
+"""
+import json
+import time
+import heapq
+import threading
+from collections import namedtuple
+from logbook import Logger
+from modbus_tk.modbus import ModbusError
+
+from tolk import coalesce
+from tolk.scheduler import LOW
+
+log = Logger(__name__)
+
+GOOD = 'good'
+STALE = 'stale'
+BAD = 'bad'
+
+ScanGroup = namedtuple('ScanGroup', ['slave_id', 'function_code',
+                                     'starting_address', 'quantity',
+                                     'interval'])
+
+
+def load_scan_groups(path):
+    """ Return list with :class:`ScanGroup` instances defined in a JSON file.
+    The file contains a list with scan groups::
+
+        [
+            {
+                "slave_id": 1,
+                "table": "holding_registers",
+                "starting_address": 100,
+                "quantity": 10,
+                "interval": 0.5
+            }
+        ]
+
+    Valid tables are `coils`, `discrete_inputs`, `holding_registers` and
+    `input_registers`.
+
+    :param path: Path of JSON file.
+    """
+    with open(path) as f:
+        config = json.load(f)
+
+    return [ScanGroup(int(group.get('slave_id', 1)),
+                      coalesce.TABLES[group['table']],
+                      int(group['starting_address']),
+                      int(group['quantity']),
+                      float(group['interval'])) for group in config]
+
+
+class RegisterImage(object):
+    """ Thread safe store with the last scanned value of every address. For
+    every address the time of the scan and its quality is stored.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Maps (slave_id, function_code, address) to a
+        # [value, timestamp, valid_until, quality] list.
+        self.entries = {}
+
+    def update(self, slave_id, function_code, starting_address, values,
+               timestamp, max_age):
+        """ Store scanned values.
+
+        :param timestamp: Time values have been scanned.
+        :param max_age: Number of seconds values are considered fresh.
+        """
+        valid_until = timestamp + max_age
+
+        with self.lock:
+            for address, value in enumerate(values, starting_address):
+                self.entries[(slave_id, function_code, address)] = \
+                    [value, timestamp, valid_until, GOOD]
+
+    def overwrite(self, slave_id, function_code, starting_address, values):
+        """ Replace values of scanned addresses by values which have been
+        written to slave, so readers see writes before the next scan.
+        """
+        with self.lock:
+            for address, value in enumerate(values, starting_address):
+                entry = self.entries.get((slave_id, function_code, address))
+                if entry is not None:
+                    entry[0] = value
+
+    def mark_bad(self, slave_id, function_code, starting_address, quantity):
+        """ Mark values as bad, because scan has failed. """
+        with self.lock:
+            for address in range(starting_address,
+                                 starting_address + quantity):
+                entry = self.entries.get((slave_id, function_code, address))
+                if entry is not None:
+                    entry[3] = BAD
+
+    def lookup(self, slave_id, function_code, starting_address, quantity):
+        """ Return tuple with values when all addresses have a good and fresh
+        value, otherwise None.
+        """
+        now = time.time()
+        values = []
+
+        with self.lock:
+            for address in range(starting_address,
+                                 starting_address + quantity):
+                entry = self.entries.get((slave_id, function_code, address))
+
+                if entry is None or entry[3] != GOOD or entry[2] < now:
+                    return None
+
+                values.append(entry[0])
+
+        return tuple(values)
+
+    def snapshot(self, slave_id, function_code, starting_address, quantity):
+        """ Return dictionary with values, their age and quality, regardless
+        of their quality. Addresses which haven't been scanned have value None.
+        The timestamp and age are those of the oldest value. The quality is
+        the worst quality of all values.
+        """
+        now = time.time()
+        values = []
+        timestamp = None
+        quality = GOOD
+
+        with self.lock:
+            for address in range(starting_address,
+                                 starting_address + quantity):
+                entry = self.entries.get((slave_id, function_code, address))
+
+                if entry is None:
+                    values.append(None)
+                    quality = BAD
+                    continue
+
+                value, scanned, valid_until, entry_quality = entry
+                values.append(value)
+
+                if timestamp is None or scanned < timestamp:
+                    timestamp = scanned
+
+                if entry_quality == BAD:
+                    quality = BAD
+                elif valid_until < now and quality == GOOD:
+                    quality = STALE
+
+        return {
+            'values': values,
+            'timestamp': timestamp,
+            'age': None if timestamp is None else now - timestamp,
+            'quality': quality,
+        }
+
+
+class Scanner(object):
+    """ Thread which reads scan groups from a bus at their interval.
+
+    :param bus: Instance of :class:`tolk.bus.Bus`.
+    :param groups: List with :class:`ScanGroup` instances.
+    :param image: Instance of :class:`RegisterImage` to store values in.
+    :param max_gap: Maximum number of unrequested addresses between 2 groups
+        for them to be merged, default 10.
+    :param stale_after: Number of intervals after which scanned values aren't
+        fresh anymore, default 2.
+    """
+    def __init__(self, bus, groups, image, max_gap=10, stale_after=2):
+        self.bus = bus
+        self.image = image
+        self.stale_after = stale_after
+        self.groups = list(groups)
+        self.frames = compile_frames(groups, max_gap)
+
+        # Merged frames which failed with an exception response.
+        self._unmerged = set()
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """ Start scanning in a background thread. """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name='tolk-scanner')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stop scanning and wait for thread to finish. """
+        self._stop.set()
+
+        if self._thread is not None:
+            self._thread.join()
+
+    def run(self):
+        """ Scan frames until :meth:`stop` is called. """
+        now = time.time()
+        schedule = [(now + offset, i)
+                    for i, (frame, interval, offset) in enumerate(self.frames)]
+        heapq.heapify(schedule)
+
+        while schedule and not self._stop.is_set():
+            due, i = heapq.heappop(schedule)
+            self._stop.wait(max(due - time.time(), 0))
+
+            if self._stop.is_set():
+                return
+
+            frame, interval, _ = self.frames[i]
+            self.scan(frame, interval)
+
+            # Skip scans which have been missed, to keep the phase of the
+            # frame within its interval.
+            now = time.time()
+            due += interval
+            while due < now:
+                due += interval
+
+            heapq.heappush(schedule, (due, i))
+
+    def scan(self, frame, interval):
+        """ Read frame from bus and store result in image. A merged frame
+        which fails with an exception response is scanned as its groups,
+        from then on.
+
+        :param frame: Instance of :class:`tolk.coalesce.Read`.
+        :param interval: Scan interval of frame in seconds.
+        """
+        reads = [frame]
+        if frame in self._unmerged:
+            reads = self._parts(frame, interval)
+
+        for read in reads:
+            error = self._read(read, interval)
+            if error is None:
+                continue
+
+            if read is frame and isinstance(error, ModbusError) and \
+                    self._parts(frame, interval) != [frame]:
+                log.warning('Failed to scan {0}: {1!r}. Scan its groups one '
+                            'by one.'.format(frame, error))
+                self._unmerged.add(frame)
+                self.scan(frame, interval)
+                return
+
+            log.warning('Failed to scan {0}: {1!r}'.format(read, error))
+            self.image.mark_bad(*read)
+
+    def _read(self, read, interval):
+        """ Read from bus and store result in image. Return the exception
+        when read fails, otherwise None.
+        """
+        try:
+            values = self.bus.execute(*read, priority=LOW)
+        except Exception as e:
+            return e
+
+        self.image.update(read.slave_id, read.function_code,
+                          read.starting_address, values, time.time(),
+                          interval * self.stale_after)
+
+    def _parts(self, frame, interval):
+        """ Return list with reads of the groups which have been merged into
+        frame, limited to the addresses of frame. A group which has been split
+        over multiple frames has a part in each of them.
+        """
+        parts = []
+        for group in self.groups:
+            read = coalesce.Read(*group[:4])
+            if group.interval != interval or \
+                    not coalesce.overlaps(frame, read):
+                continue
+
+            start = max(frame.starting_address, read.starting_address)
+            end = min(frame.starting_address + frame.quantity,
+                      read.starting_address + read.quantity)
+            parts.append(read._replace(starting_address=start,
+                                       quantity=end - start))
+
+        return parts
+
+
+def compile_frames(groups, max_gap=10):
+    """ Return list with (frame, interval, offset) tuples. Groups with the
+    same interval are merged into frames, which are split when they exceed the
+    maximum quantity of the protocol. Frames with the same interval get
+    offsets which spread them evenly over the interval.
+
+    :param groups: List with :class:`ScanGroup` instances.
+    :param max_gap: Maximum number of unrequested addresses between 2 groups
+        for them to be merged.
+    """
+    intervals = {}
+    for group in groups:
+        intervals.setdefault(group.interval, []).append(
+            coalesce.Read(*group[:4]))
+
+    frames = []
+    for interval, reads in sorted(intervals.items()):
+        planned = [chunk for frame in coalesce.plan(reads, max_gap)
+                   for chunk in coalesce.split(frame)]
+
+        for i, frame in enumerate(planned):
+            frames.append((frame, interval,
+                           interval * i / float(len(planned))))
+
+    return frames
@@ -0,0 +1,280 @@
+""" Scheduling of transactions on a bus by priority.
+
+Without scheduling, transactions reach the Modbus master in arrival order, so
+an operator's write can wait behind hundreds of queued bulk reads. A
+:class:`Scheduler` hands out the bus to waiting transactions by priority
+class::
+
+    scheduler = Scheduler()
+
+    scheduler.acquire(HIGH, client=session.id)
+    try:
+        modbus_master.execute(1, WRITE_SINGLE_COIL, 100, output_value=1)
+    finally:
+        scheduler.release()
+
+Within a priority class, clients get their share of the bus by weighted fair
+queuing, so a client which queues many requests can't crowd out others.
+Transactions age: every `aging` seconds a transaction waits it is promoted one
+priority class, so low priority transactions never starve.
+
+Transactions can have a deadline and a callable which tells whether the
+client is still waiting for them. Transactions whose deadline passes, or
+whose client has gone, are dropped from the queue before they reach the bus.
+
+The queue can be bounded. Transactions which arrive when `max_queue`
+transactions are waiting, or which wait longer than `max_queue_wait` seconds,
+are rejected with :class:`tolk.exceptions.ServerBusy`, which tells the client
+when to retry, so a burst of requests doesn't make latency spiral for
+everyone::
+
+    scheduler = Scheduler(max_queue=100, max_queue_wait=2)
+
+"""
+import time
+import itertools
+import threading
+
+from tolk.exceptions import DeadlineExceeded, RequestCancelled, server_busy
+
+HIGH = 0
+NORMAL = 1
+LOW = 2
+
+#: Priority classes per name.
+PRIORITIES = {
+    'high': HIGH,
+    'normal': NORMAL,
+    'low': LOW,
+}
+
+#: Number of seconds between checks whether a waiting transaction has been
+#: cancelled.
+POLL_INTERVAL = 0.05
+
+#: Number of seconds a transaction is assumed to use the bus, until the
+#: duration of transactions has been measured.
+SERVICE_TIME = 0.05
+
+
+class Ticket(object):
+    """ Transaction waiting for the bus. """
+    def __init__(self, priority, client, seq, start, finish):
+        self.priority = priority
+        self.client = client
+        self.seq = seq
+        self.start = start
+        self.finish = finish
+        self.enqueued = time.time()
+        self.event = threading.Event()
+
+
+class Scheduler(object):
+    """ Grant access to a bus to one or more transactions at a time, by
+    priority.
+
+    :param capacity: Number of transactions which may run concurrently,
+        default 1.
+    :param aging: Number of seconds after which a waiting transaction is
+        promoted to the next priority class, default 1.
+    :param weights: Dictionary which maps clients to their weight, default
+        None. Clients have weight 1 by default. A client with weight 2 gets
+        twice as many transactions as a client with weight 1 when both are
+        waiting.
+    :param max_queue: Maximum number of waiting transactions, default None,
+        which means no limit.
+    :param max_queue_wait: Maximum number of seconds a transaction waits,
+        default None, which means no limit.
+    """
+    def __init__(self, capacity=1, aging=1, weights=None, max_queue=None,
+                 max_queue_wait=None):
+        self.capacity = capacity
+        self.aging = aging
+        self.weights = dict(weights or {})
+        self.max_queue = max_queue
+        self.max_queue_wait = max_queue_wait
+
+        # Moving average of the number of seconds transactions use the bus.
+        self.service_time = SERVICE_TIME
+
+        self.lock = threading.Lock()
+        self.running = 0
+        self.waiting = []
+
+        # Virtual time of weighted fair queuing and the virtual finish time
+        # of the last queued transaction of every client.
+        self._virtual_time = 0.0
+        self._finish = {}
+        self._seq = itertools.count()
+
+        self.served = dict.fromkeys(PRIORITIES.values(), 0)
+        self.max_wait = dict.fromkeys(PRIORITIES.values(), 0.0)
+        self.dropped = dict.fromkeys(PRIORITIES.values(), 0)
+        self.rejected = dict.fromkeys(PRIORITIES.values(), 0)
+
+    def acquire(self, priority=NORMAL, client=None, deadline=None,
+                cancelled=None):
+        """ Wait until transaction may use the bus.
+
+        :param priority: Priority class, default :data:`NORMAL`.
+        :param client: Hashable identifying the client, default None.
+        :param deadline: Time, as returned by :func:`time.time`, after which
+            transaction is no longer needed, default None.
+        :param cancelled: Callable which returns True when transaction is no
+            longer needed, for instance because the client has disconnected,
+            default None. It's called every :data:`POLL_INTERVAL` seconds
+            while transaction waits.
+        :raises DeadlineExceeded: When deadline passes before transaction
+            has been granted the bus.
+        :raises RequestCancelled: When transaction is cancelled before it has
+            been granted the bus.
+        :raises ServerBusy: When queue is full, or when transaction has waited
+            `max_queue_wait` seconds.
+        """
+        if deadline is not None and time.time() >= deadline:
+            with self.lock:
+                self.dropped[priority] += 1
+            raise DeadlineExceeded()
+
+        with self.lock:
+            if self.max_queue is not None and \
+                    len(self.waiting) >= self.max_queue and \
+                    self.running >= self.capacity:
+                self.rejected[priority] += 1
+                raise self._busy()
+
+            start = max(self._virtual_time, self._finish.get(client, 0.0))
+            finish = start + 1.0 / self.weights.get(client, 1)
+            self._finish[client] = finish
+
+            ticket = Ticket(priority, client, next(self._seq), start, finish)
+            self.waiting.append(ticket)
+            self._dispatch()
+
+        limit = None if self.max_queue_wait is None \
+            else ticket.enqueued + self.max_queue_wait
+        expires = [t for t in (deadline, limit) if t is not None]
+
+        if not expires and cancelled is None:
+            ticket.event.wait()
+            return
+
+        while True:
+            timeout = POLL_INTERVAL
+            if expires:
+                timeout = min(expires) - time.time()
+                if cancelled is not None:
+                    timeout = min(timeout, POLL_INTERVAL)
+
+            if timeout > 0:
+                ticket.event.wait(timeout)
+
+            # :meth:`threading.Event.wait` returns None on Python 2.6.
+            if ticket.event.is_set():
+                return
+
+            now = time.time()
+            if deadline is not None and now >= deadline:
+                error, counts = DeadlineExceeded(), self.dropped
+            elif limit is not None and now >= limit:
+                error, counts = None, self.rejected
+            elif cancelled is not None and cancelled():
+                error, counts = RequestCancelled(), self.dropped
+            else:
+                continue
+
+            with self.lock:
+                # Bus may have been granted in the meantime.
+                if ticket.event.is_set():
+                    return
+
+                self.waiting.remove(ticket)
+                counts[priority] += 1
+                error = error or self._busy()
+
+            raise error
+
+    def release(self, duration=None):
+        """ Release bus after transaction has finished.
+
+        :param duration: Number of seconds transaction has used the bus,
+            default None. Used to estimate when rejected transactions can be
+            retried.
+        """
+        with self.lock:
+            self.running -= 1
+            if duration is not None:
+                self.service_time += 0.1 * (duration - self.service_time)
+            self._dispatch()
+
+    def resize(self, capacity):
+        """ Change number of transactions which may run concurrently.
+        Transactions which run already aren't interrupted.
+        """
+        with self.lock:
+            self.capacity = capacity
+            self._dispatch()
+
+    def _busy(self):
+        """ Return :class:`tolk.exceptions.ServerBusy` error with the time it
+        takes to work off the queue. Must be called with lock held.
+        """
+        return server_busy(self.service_time * (len(self.waiting) + 1) /
+                           self.capacity)
+
+    def _dispatch(self):
+        """ Grant bus to waiting transactions while there's capacity. Must be
+        called with lock held.
+        """
+        while self.waiting and self.running < self.capacity:
+            now = time.time()
+            ticket = min(self.waiting, key=lambda t: self._rank(t, now))
+            self.waiting.remove(ticket)
+
+            self.running += 1
+            self._virtual_time = max(self._virtual_time, ticket.start)
+
+            wait = now - ticket.enqueued
+            self.served[ticket.priority] += 1
+            self.max_wait[ticket.priority] = \
+                max(self.max_wait[ticket.priority], wait)
+
+            ticket.event.set()
+
+        if not self.waiting and len(self._finish) > 1000:
+            # Forget clients which are idle.
+            self._finish = dict((c, f) for c, f in self._finish.items()
+                                if f > self._virtual_time)
+
+    def _rank(self, ticket, now):
+        """ Return sort key of ticket, lowest is served first. """
+        promotions = int((now - ticket.enqueued) / self.aging) \
+            if self.aging else 0
+
+        return (max(ticket.priority - promotions, HIGH), ticket.finish,
+                ticket.seq)
+
+    def stats(self):
+        """ Return dictionary with number of transactions waiting, served,
+        dropped and rejected and the longest time a transaction has waited,
+        per priority class, and the number of transactions running.
+        """
+        with self.lock:
+            queued = dict.fromkeys(PRIORITIES.values(), 0)
+            for ticket in self.waiting:
+                queued[ticket.priority] += 1
+
+            return {
+                'running': self.running,
+                'queued': name_keys(queued),
+                'served': name_keys(self.served),
+                'dropped': name_keys(self.dropped),
+                'rejected': name_keys(self.rejected),
+                'max_wait': name_keys(self.max_wait),
+            }
+
+
+def name_keys(values):
+    """ Return dictionary with names of priority classes as keys. """
+    return dict((name, values[priority])
+                for name, priority in PRIORITIES.items())
@@ -0,0 +1,144 @@
+""" Servers which handle multiple clients concurrently.
+
+:class:`SocketServer.UnixStreamServer` handles one connection at a time, so a
+single slow Modbus slave blocks all other clients. The servers in this module
+read every connection in its own thread and dispatch at most `workers`
+requests at a time::
+
+    from modbus_tk.modbus_tcp import TcpMaster
+
+    from tolk import Dispatcher, Handler
+    from tolk.server import ThreadPoolUnixStreamServer
+
+    server = ThreadPoolUnixStreamServer('/tmp/tolk.sock', Handler)
+    server.dispatcher = Dispatcher(TcpMaster('localhost', 502))
+    server.workers = 16
+
+    server.serve_forever()
+
+Transactions on the same Modbus master are serialized by
+:class:`tolk.bus.Bus`, transactions on different masters run in parallel.
+When the dispatcher routes to multiple backends, every backend gets its own
+share of the workers, see :func:`share_workers`, so a slow or dead backend
+can't occupy all workers and starve the other backends.
+
+Remote clients can connect over TCP to a :class:`ThreadPoolTCPServer`, with
+:class:`tolk.Handler` for the same framing as on a Unix Domain Socket or with
+:class:`tolk.http_handler.HTTPHandler` for JSON-RPC over HTTP. Several servers
+can share one dispatcher, each serving in its own thread::
+
+    dispatcher = Dispatcher(TcpMaster('localhost', 502))
+
+    for server in [ThreadPoolUnixStreamServer('/tmp/tolk.sock', Handler),
+                   ThreadPoolTCPServer(('0.0.0.0', 8502), Handler),
+                   ThreadPoolTCPServer(('0.0.0.0', 8080), HTTPHandler)]:
+        server.dispatcher = dispatcher
+        threading.Thread(target=server.serve_forever).start()
+
+"""
+import socket
+import threading
+from SocketServer import TCPServer, UnixStreamServer
+
+from tolk.routing import Router
+
+
+def share_workers(dispatcher, workers):
+    """ Limit the number of requests every backend of dispatcher holds to its
+    share of workers.
+
+    A backend holds the transactions its bus carries plus the ones waiting
+    in the queue of its scheduler. The queue of every backend is limited, see
+    :attr:`tolk.scheduler.Scheduler.max_queue`, and requests over the limit
+    are rejected with :class:`tolk.exceptions.ServerBusy` right away instead
+    of occupying a worker. Smaller limits which have been configured are
+    kept. A dispatcher with a single backend isn't limited.
+
+    :param dispatcher: Instance of :class:`tolk.Dispatcher`.
+    :param workers: Number of requests dispatched concurrently.
+    """
+    router = getattr(dispatcher, 'router', None)
+    if not isinstance(router, Router):
+        return
+
+    backends = [backend for _, backend in router]
+    if len(backends) < 2:
+        return
+
+    share = max(workers // len(backends), 1)
+    for backend in backends:
+        scheduler = backend.bus.scheduler
+        limit = max(share - scheduler.capacity, 0)
+
+        if scheduler.max_queue is None or scheduler.max_queue > limit:
+            scheduler.max_queue = limit
+
+
+class ThreadPoolMixIn:
+    """ Mix-in class to handle each connection in its own thread, while at
+    most `workers` requests are dispatched at a time.
+
+    Connections are persistent, so a connection can't occupy a worker for as
+    long as it's open: an idle client would lock out all others once there
+    are more clients than workers. Instead, handlers dispatch every request
+    with :meth:`dispatch`, which waits while all workers are busy. Backends
+    of the dispatcher share the workers, see :func:`share_workers`.
+    """
+    #: Number of requests which are dispatched concurrently.
+    workers = 8
+
+    #: Whether connection threads should not prevent the process from
+    #: exiting.
+    daemon_threads = True
+
+    _workers = None
+
+    def process_request(self, request, client_address):
+        """ Start thread which handles connection. """
+        if self._workers is None:
+            self._workers = threading.BoundedSemaphore(self.workers)
+            share_workers(self.dispatcher, self.workers)
+
+        t = threading.Thread(target=self.process_request_thread,
+                             args=(request, client_address))
+        t.daemon = self.daemon_threads
+        t.start()
+
+    def process_request_thread(self, request, client_address):
+        """ Handle connection until client closes it. """
+        try:
+            self.finish_request(request, client_address)
+        except:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def dispatch(self, msg, session=None, peer=None):
+        """ Dispatch request with dispatcher of server once a worker is
+        available. See :meth:`tolk.Dispatcher.call`.
+        """
+        if self._workers is None:
+            return self.dispatcher.call(msg, session, peer)
+
+        with self._workers:
+            return self.dispatcher.call(msg, session, peer)
+
+
+class ThreadPoolUnixStreamServer(ThreadPoolMixIn, UnixStreamServer):
+    """ :class:`SocketServer.UnixStreamServer` which dispatches requests of
+    all connections in a bounded number of workers. """
+    pass
+
+
+class ThreadPoolTCPServer(ThreadPoolMixIn, TCPServer):
+    """ :class:`SocketServer.TCPServer` which dispatches requests of all
+    connections in a bounded number of workers. """
+    allow_reuse_address = True
+
+    def get_request(self):
+        sock, client_address = TCPServer.get_request(self)
+
+        # Don't delay small responses.
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        return sock, client_address
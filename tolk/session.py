@@ -0,0 +1,173 @@
+""" Sessions of connected clients.
+
+A :class:`Session` represents the connection of a client for as long as it
+is open. Besides responses, Tolk can push JSON-RPC notifications to the
+client over its session, see :mod:`tolk.subscriptions`.
+
+"""
+import sys
+import json
+import socket
+import struct
+import itertools
+import threading
+from collections import deque
+
+_ids = itertools.count(1)
+
+# Python 2 doesn't define SO_PEERCRED, its value on Linux is 17.
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED',
+                      17 if sys.platform.startswith('linux') else None)
+
+
+class SessionClosed(IOError):
+    """ Raised when sending over a session which has been closed. """
+    pass
+
+
+class Session(object):
+    """ Connection of a client.
+
+    :param send: Callable which sends a serialized message to the client.
+        Raises :class:`socket.error` or :class:`IOError` on failure.
+    :param connected: Callable which returns False when the client has closed
+        the connection, default None. See :meth:`disconnected`.
+    :param max_notifications: Maximum number of notifications waiting to be
+        sent, default None. See :meth:`notify`.
+    :param peer: Hashable which identifies client across connections,
+        default None. See :func:`get_peer`.
+    """
+    def __init__(self, send, connected=None, max_notifications=None,
+                 peer=None):
+        self.id = next(_ids)
+        self.closed = False
+
+        #: Client of session, which outlives the session. Requests are rate
+        #: limited per peer, see :mod:`tolk.ratelimit`.
+        self.peer = peer
+
+        #: :class:`tolk.codec.Codec` negotiated by client, or None for JSON.
+        #: See :class:`tolk.framing.Negotiator`.
+        self.codec = None
+
+        self._send = send
+        self._connected = connected
+        self._lock = threading.Lock()
+
+        self.max_notifications = max_notifications
+        self._outbox = deque()
+        self._outbox_lock = threading.Lock()
+        self._sender = None
+
+    def send(self, msg):
+        """ Send serialized message to client. Messages sent from different
+        threads never interleave.
+
+        :param msg: String with serialized message.
+        :raises SessionClosed: When session has been closed.
+        """
+        with self._lock:
+            if self.closed:
+                raise SessionClosed('Session {0} has been closed.'
+                                    .format(self.id))
+
+            try:
+                self._send(msg)
+            except (IOError, OSError):
+                self.closed = True
+                raise
+
+    def notify(self, method, params):
+        """ Send JSON-RPC notification to client.
+
+        Without :attr:`max_notifications` the notification is sent right
+        away, so `send` must not block. Otherwise it is queued and sent by a
+        background thread. A client which doesn't read its connection can't
+        block whoever notifies then: when the queue is full the session is
+        closed.
+
+        :param method: Name of method.
+        :param params: Dictionary or list with parameters.
+        :raises SessionClosed: When session has been closed.
+        """
+        dumps = json.dumps if self.codec is None else self.codec.dumps
+        msg = dumps({
+            'jsonrpc': '2.0',
+            'method': method,
+            'params': params,
+        })
+
+        if self.max_notifications is None:
+            self.send(msg)
+            return
+
+        with self._outbox_lock:
+            if self.closed:
+                raise SessionClosed('Session {0} has been closed.'
+                                    .format(self.id))
+
+            if len(self._outbox) >= self.max_notifications:
+                self.close()
+                raise SessionClosed('Session {0} falls behind on '
+                                    'notifications.'.format(self.id))
+
+            self._outbox.append(msg)
+
+            if self._sender is None:
+                self._sender = threading.Thread(target=self._send_outbox,
+                                                name='tolk-session')
+                self._sender.daemon = True
+                self._sender.start()
+
+    def _send_outbox(self):
+        """ Send queued notifications until queue is empty. """
+        while True:
+            with self._outbox_lock:
+                if not self._outbox or self.closed:
+                    self._outbox.clear()
+                    self._sender = None
+                    return
+
+                msg = self._outbox.popleft()
+
+            try:
+                self.send(msg)
+            except (IOError, OSError):
+                # Session has been closed.
+                pass
+
+    def disconnected(self):
+        """ Return True when session has been closed or when client has
+        closed its connection, even if that hasn't been noticed yet by
+        whoever reads from the connection.
+        """
+        return self.closed or \
+            (self._connected is not None and not self._connected())
+
+    def close(self):
+        """ Mark session as closed. """
+        self.closed = True
+
+
+def get_peer(sock, address):
+    """ Return hashable which identifies client of a connection, so a client
+    which reconnects is recognized: the host of a TCP client, or the process
+    id of a client of a Unix Domain Socket. Returns None when the client
+    can't be identified.
+
+    :param sock: Socket of connection.
+    :param address: Address of client, as returned by :meth:`socket.accept`.
+    """
+    if isinstance(address, tuple):
+        return address[0]
+
+    if SO_PEERCRED is None:
+        return None
+
+    try:
+        pid, _, _ = struct.unpack('3i', sock.getsockopt(
+            socket.SOL_SOCKET, SO_PEERCRED, struct.calcsize('3i')))
+    except (socket.error, struct.error):
+        return None
+
+    return 'pid', pid
@@ -0,0 +1,98 @@
+""" Deduplication of identical calls which are in flight at the same time.
+
+Clients often read the same registers at nearly the same moment. Instead of
+putting an identical request on the bus for every client, concurrent callers
+with the same key share a single call::
+
+    >>> in_flight = SingleFlight()
+    >>> in_flight.do((1, 3, 100, 2), bus.execute, 1, 3, 100, 2)
+    (1337, 2345)
+
+Only calls which overlap in time are shared, results aren't cached. The
+phases of a shared call are recorded in the traces of all its callers, see
+:mod:`tolk.tracing`.
+
+"""
+import sys
+import threading
+
+from tolk import tracing
+
+
+class Call(object):
+    """ A call which is in flight. """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+        self.waiters = 0
+
+        # Traces of callers, see :class:`tolk.tracing.SharedTrace`.
+        self.traces = []
+
+
+class SingleFlight(object):
+    """ Table with calls in flight, keyed by a hashable key.
+
+    :param retry: Exception class, or tuple with classes, of failures which
+        are particular to the caller which made the call, default (). Other
+        callers make the call themselves instead of sharing such a failure.
+    """
+    def __init__(self, retry=()):
+        self.retry = retry
+
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        """ Call func, unless a call with same key is already in flight. In
+        that case wait for that call and return its result, or raise its
+        exception.
+
+        :param key: Hashable which identifies call.
+        :param func: Callable to call.
+        :returns: Result of func.
+        """
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+
+                if leader:
+                    call = self._calls[key] = Call()
+                else:
+                    call.waiters += 1
+
+                trace = tracing.current()
+                if trace is not None:
+                    call.traces.append(trace)
+
+            if leader:
+                break
+
+            call.done.wait()
+
+            if call.exc_info is None:
+                return call.result
+
+            if not issubclass(call.exc_info[0], self.retry):
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+
+        previous = tracing.attach(tracing.SharedTrace(call.traces))
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            tracing.attach(previous)
+
+            with self._lock:
+                del self._calls[key]
+
+            call.done.set()
+
+    def __len__(self):
+        """ Return number of calls in flight. """
+        return len(self._calls)
@@ -0,0 +1,320 @@
+""" Subscriptions on changes of registers and coils.
+
+Instead of polling constantly, a client can subscribe on a range of addresses
+with the JSON-RPC method `subscribe`. Tolk polls the range at the requested
+interval and pushes a notification over the client's connection when a value
+has changed more than the deadband::
+
+    {
+        "jsonrpc": "2.0",
+        "method": "notify",
+        "params": {
+            "subscription": 1,
+            "values": [1337, 2345],
+            "timestamp": 1444132312.482
+        }
+    }
+
+When a poll fails the notification carries an `error` with the same code
+and message as the error of a read request, instead of `values`.
+
+Subscriptions on the same range and unit share a single poll, no matter how
+many clients have subscribed. The range is polled at the smallest interval of
+its subscriptions, but a subscription is notified at most once per its own
+interval.
+
+Every backend is polled by its own thread, so a slow gateway doesn't delay
+the subscriptions of other backends. Notifications are sent without waiting
+for the client, see :meth:`tolk.session.Session.notify`.
+
+"""
+import time
+import heapq
+import itertools
+import threading
+from logbook import Logger
+from modbus_tk.modbus import ModbusError
+from pyjsonrpc import InternalError, JsonRpcError
+
+from tolk.exceptions import modbus_mapping
+
+log = Logger(__name__)
+
+#: Name of method of notifications.
+NOTIFY = 'notify'
+
+
+class Subscription(object):
+    """ Subscription of a session on a poll.
+
+    :param session: Instance of :class:`tolk.session.Session`.
+    :param interval: Minimal number of seconds between notifications.
+    :param deadband: Minimal change of a value to notify session.
+    """
+    def __init__(self, id, session, interval, deadband):
+        self.id = id
+        self.session = session
+        self.interval = interval
+        self.deadband = deadband
+
+        # Values and error last notified to session, and when.
+        self.values = None
+        self.error = None
+        self.notified = None
+
+    def due(self, timestamp, poll_interval):
+        """ Return whether session may be notified of poll at timestamp. A
+        poll which is late by less than its interval counts as on time.
+        """
+        return self.notified is None or \
+            timestamp - self.notified >= self.interval - poll_interval
+
+    def changed(self, values):
+        """ Return whether values differ more than deadband from values which
+        have been notified last. """
+        if self.values is None or len(values) != len(self.values):
+            return True
+
+        for old, new in zip(self.values, values):
+            if abs(new - old) > self.deadband:
+                return True
+
+        return False
+
+
+class Poll(object):
+    """ Range of addresses polled at an interval, shared by subscriptions.
+
+    :param poller: :class:`Poller` of backend of range.
+    """
+    def __init__(self, key, poller):
+        self.key = key
+        self.poller = poller
+        self.subscriptions = {}
+
+        # Time at which range is polled next.
+        self.due = None
+
+    @property
+    def interval(self):
+        """ Smallest interval of subscriptions. """
+        return min(s.interval for s in self.subscriptions.values())
+
+
+class Poller(object):
+    """ Schedule of polls of a single backend, polled by its own thread. """
+    def __init__(self, group):
+        self.group = group
+        self.schedule = []
+        self.thread = None
+
+
+class SubscriptionManager(object):
+    """ Poll subscribed ranges in background threads and notify sessions of
+    changes.
+
+    :param read: Callable which reads a range. It is called with slave id,
+        function code, starting address, quantity and unit and returns a
+        sequence with values.
+    :param group: Callable which is called with slave id and unit and
+        returns the backend the range is read from, default None. Ranges of
+        different backends are polled by different threads.
+    """
+    def __init__(self, read, group=None):
+        self.read = read
+        self.group = group
+        self.polls = {}
+
+        self._ids = itertools.count(1)
+        self._seq = itertools.count()
+        self._by_id = {}
+        self._pollers = {}
+        self._cond = threading.Condition()
+        self._stopped = False
+
+    def subscribe(self, session, slave_id, function_code, starting_address,
+                  quantity, interval, deadband=0, unit=None):
+        """ Subscribe session on range and return id of subscription.
+
+        :param session: Instance of :class:`tolk.session.Session`.
+        :param interval: Number of seconds between polls.
+        :param deadband: Minimal change of a value to notify session.
+        :param unit: Name of unit of range, default None. See
+            :class:`tolk.routing.Router`.
+        """
+        key = (slave_id, function_code, starting_address, quantity, unit)
+        group = self.group(slave_id, unit) if self.group is not None else None
+
+        with self._cond:
+            subscription = Subscription(next(self._ids), session, interval,
+                                        deadband)
+
+            poll = self.polls.get(key)
+            if poll is None:
+                poll = self.polls[key] = Poll(key, self._poller(group))
+                poll.subscriptions[subscription.id] = subscription
+                self._push(time.time(), poll)
+            else:
+                poll.subscriptions[subscription.id] = subscription
+
+                # Poll sooner when subscription has a smaller interval.
+                due = time.time() + interval
+                if due < poll.due:
+                    self._push(due, poll)
+
+            self._by_id[subscription.id] = (poll, session)
+            self._cond.notify_all()
+
+        return subscription.id
+
+    def _poller(self, group):
+        """ Return poller of group, started when it's new. Must be called
+        with lock held.
+        """
+        poller = self._pollers.get(group)
+        if poller is None:
+            poller = self._pollers[group] = Poller(group)
+            poller.thread = threading.Thread(target=self.run, args=(poller,),
+                                             name='tolk-subscriptions')
+            poller.thread.daemon = True
+            poller.thread.start()
+
+        return poller
+
+    def unsubscribe(self, subscription_id, session=None):
+        """ Remove subscription. Polls without subscriptions are stopped.
+
+        :param session: When given, subscription is only removed when it
+            belongs to session.
+        :returns: True when subscription has been removed, otherwise False.
+        """
+        with self._cond:
+            poll, owner = self._by_id.get(subscription_id, (None, None))
+
+            if poll is None or (session is not None and session is not owner):
+                return False
+
+            self._remove(poll, subscription_id)
+
+        return True
+
+    def _push(self, due, poll):
+        """ Schedule poll at due. Earlier schedules of poll are dropped. """
+        poll.due = due
+        heapq.heappush(poll.poller.schedule, (due, next(self._seq), poll))
+
+    def _remove(self, poll, subscription_id):
+        del self._by_id[subscription_id]
+        del poll.subscriptions[subscription_id]
+
+        if not poll.subscriptions:
+            del self.polls[poll.key]
+
+    def stop(self):
+        """ Stop polling threads. """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+            pollers = list(self._pollers.values())
+
+        for poller in pollers:
+            poller.thread.join()
+
+    def run(self, poller):
+        """ Poll ranges of poller when they're due until :meth:`stop` is
+        called.
+        """
+        while True:
+            with self._cond:
+                poll = self._next_due(poller)
+                if poll is None:
+                    return
+
+            self.poll(poll)
+
+    def _next_due(self, poller):
+        """ Wait for next poll of poller which is due and return it. Returns
+        None when manager has been stopped. Must be called with lock held.
+        """
+        schedule = poller.schedule
+
+        while not self._stopped:
+            if not schedule:
+                self._cond.wait()
+                continue
+
+            due, _, poll = schedule[0]
+            now = time.time()
+
+            if due > now:
+                self._cond.wait(due - now)
+                continue
+
+            heapq.heappop(schedule)
+
+            if self.polls.get(poll.key) is not poll or due != poll.due:
+                # Nobody is subscribed anymore, or poll has been rescheduled.
+                continue
+
+            while due <= now:
+                due += poll.interval
+            self._push(due, poll)
+
+            return poll
+
+        return None
+
+    def poll(self, poll):
+        """ Read range of poll and notify its subscriptions. """
+        slave_id, function_code, starting_address, quantity, unit = poll.key
+
+        values = error = None
+        try:
+            values = list(self.read(slave_id, function_code, starting_address,
+                                    quantity, unit))
+        except ModbusError as e:
+            error = modbus_mapping[e.get_exception_code()]()
+        except JsonRpcError as e:
+            error = e
+        except Exception as e:
+            log.warning('Failed to poll {0}: {1!r}'.format(poll.key, e))
+            error = InternalError()
+
+        timestamp = time.time()
+
+        with self._cond:
+            subscriptions = list(poll.subscriptions.values())
+            interval = poll.interval if subscriptions else 0
+
+        for subscription in subscriptions:
+            if subscription.session.closed:
+                self.unsubscribe(subscription.id)
+                continue
+
+            if not subscription.due(timestamp, interval):
+                continue
+
+            params = {'subscription': subscription.id, 'timestamp': timestamp}
+
+            if error is not None:
+                if subscription.error == error.code:
+                    continue
+
+                subscription.error = error.code
+                subscription.values = None
+                params['error'] = {'code': error.code,
+                                   'message': error.message}
+            else:
+                if not subscription.changed(values):
+                    continue
+
+                subscription.error = None
+                subscription.values = values
+                params['values'] = values
+
+            subscription.notified = timestamp
+
+            try:
+                subscription.session.notify(NOTIFY, params)
+            except (IOError, OSError):
+                self.unsubscribe(subscription.id)
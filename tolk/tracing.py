@@ -0,0 +1,184 @@
+""" Tracing of requests and a log of slow requests.
+
+A :class:`Tracer` follows a sample of requests through their phases and logs
+the ones which take longer than a threshold, with the time spent in every
+phase::
+
+    dispatcher = Dispatcher(TcpMaster('localhost', 502),
+                            tracer=Tracer(sample_rate=0.1,
+                                          slow_threshold=0.5))
+
+A slow request is logged like this::
+
+    Slow request 5c1f0e9a3b2d4f71 read_holding_registers (id 1) took
+    812.4 ms: read 0.1 ms, parse 0.0 ms, queue 701.9 ms, modbus 110.1 ms,
+    encode 0.0 ms, send 0.1 ms, other 0.2 ms
+
+The phases are:
+
+* `read`: receiving the request from the socket.
+* `parse`: decoding the request.
+* `queue`: waiting for the bus, behind transactions of other clients.
+* `modbus`: round trips on the bus.
+* `encode`: encoding the response.
+* `send`: sending the response to the socket.
+
+Phases which occur more than once, like the round trips of a batch, are
+summed. Requests which aren't sampled only cost a call to :func:`random`.
+
+The trace of a request is kept per thread. Work done for the request in
+other threads is traced by handing the trace to those threads with
+:func:`attach`.
+
+"""
+import time
+import random
+import threading
+from logbook import Logger
+
+log = Logger(__name__)
+
+_local = threading.local()
+
+
+class Trace(object):
+    """ Phases of a single request.
+
+    :param id: String which identifies trace.
+    """
+    def __init__(self, id):
+        self.id = id
+        self.started = time.time()
+        self.finished = None
+
+        self.phases = []
+        self.methods = []
+        self.request_ids = []
+
+    def add(self, phase, duration):
+        """ Record that phase took duration seconds. Can be called from any
+        thread.
+        """
+        self.phases.append((phase, duration))
+
+    @property
+    def duration(self):
+        """ Number of seconds trace took, or has taken so far. """
+        return (self.finished or time.time()) - self.started
+
+    def breakdown(self):
+        """ Return list with (phase, duration) tuples, in order of first
+        occurrence, with the duration of repeated phases summed. The time
+        which isn't covered by any phase is reported as `other`.
+        """
+        durations = {}
+        order = []
+        for phase, duration in self.phases:
+            if phase not in durations:
+                durations[phase] = 0.0
+                order.append(phase)
+            durations[phase] += duration
+
+        breakdown = [(phase, durations[phase]) for phase in order]
+        breakdown.append(('other', max(self.duration -
+                                       sum(durations.values()), 0.0)))
+
+        return breakdown
+
+
+class SharedTrace(object):
+    """ Records phases in every trace of a list, for work which is shared by
+    multiple requests, like a read in flight for multiple clients. Traces can
+    be appended to the list while phases are recorded.
+
+    :param traces: List with :class:`Trace` instances.
+    """
+    def __init__(self, traces):
+        self.traces = traces
+
+    def add(self, phase, duration):
+        """ Record that phase took duration seconds in every trace. """
+        for trace in list(self.traces):
+            trace.add(phase, duration)
+
+
+class Tracer(object):
+    """ Trace a sample of requests and log slow requests.
+
+    :param sample_rate: Fraction of requests to trace, between 0 and 1,
+        default 1.
+    :param slow_threshold: Number of seconds above which a traced request is
+        logged, default None, which disables logging.
+    """
+    def __init__(self, sample_rate=1.0, slow_threshold=None):
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+
+    def begin(self):
+        """ Start trace of request handled by current thread and return it,
+        or return None when request isn't sampled. Either way :meth:`end`
+        must be called when request has been handled, see :func:`decided`.
+        """
+        _local.decided = True
+
+        if random.random() >= self.sample_rate:
+            return None
+
+        trace = Trace('{0:016x}'.format(random.getrandbits(64)))
+        _local.trace = trace
+
+        return trace
+
+    def end(self, trace):
+        """ Finish trace and log it when request was slow.
+
+        :param trace: :class:`Trace` returned by :meth:`begin`, or None.
+        """
+        _local.trace = None
+        _local.decided = False
+
+        if trace is None:
+            return
+
+        trace.finished = time.time()
+
+        if self.slow_threshold is not None and \
+                trace.duration >= self.slow_threshold:
+            log.warning(format_trace(trace))
+
+
+def current():
+    """ Return trace of request handled by current thread, or None. """
+    return getattr(_local, 'trace', None)
+
+
+def decided():
+    """ Return whether :meth:`Tracer.begin` has decided whether to trace the
+    request handled by current thread, so it isn't sampled twice.
+    """
+    return getattr(_local, 'decided', False)
+
+
+def attach(trace):
+    """ Make trace the trace of current thread and return the trace it had.
+    Used to trace work for a request in another thread than the one which
+    began the trace.
+
+    :param trace: :class:`Trace`, :class:`SharedTrace` or None.
+    """
+    previous = current()
+    _local.trace = trace
+
+    return previous
+
+
+def format_trace(trace):
+    """ Return string with summary of trace. """
+    methods = ', '.join(trace.methods) or 'request'
+    ids = ', '.join(str(id) for id in trace.request_ids)
+
+    return 'Slow request {0} {1}{2} took {3:.1f} ms: {4}'.format(
+        trace.id, methods, ' (id {0})'.format(ids) if ids else '',
+        trace.duration * 1000,
+        ', '.join('{0} {1:.1f} ms'.format(phase, duration * 1000)
+                  for phase, duration in trace.breakdown()))